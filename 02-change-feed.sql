@@ -0,0 +1,19 @@
+-- Change sequence for the incremental QR code feed (GET /api/qrcodes/changes)
+USE waterDB;
+
+-- Single-row counter; incremented with LAST_INSERT_ID(seq + n) inside each
+-- writing transaction so sequence numbers become visible in commit order.
+CREATE TABLE IF NOT EXISTS qr_change_counter (
+    id TINYINT PRIMARY KEY,
+    seq BIGINT UNSIGNED NOT NULL
+);
+
+ALTER TABLE qr_codes
+    ADD COLUMN change_seq BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    ADD INDEX idx_qr_codes_change_seq (change_seq);
+
+-- Number the existing rows so a client starting at cursor 0 receives them all
+SET @seq := 0;
+UPDATE qr_codes SET change_seq = (@seq := @seq + 1) ORDER BY creation_date, qrcode_id;
+
+INSERT INTO qr_change_counter (id, seq) VALUES (1, @seq);
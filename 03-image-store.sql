@@ -0,0 +1,13 @@
+-- Deduplicated storage for compact (1-bit PNG) QR images
+USE waterDB;
+
+-- One row per distinct image, keyed by the SHA-256 of its bytes
+CREATE TABLE IF NOT EXISTS qr_image_blobs (
+    image_hash BINARY(32) PRIMARY KEY,
+    data MEDIUMBLOB NOT NULL
+);
+
+-- qr_codes.qr_image stays for rows not yet migrated by compact_qr_images.py
+ALTER TABLE qr_codes
+    ADD COLUMN image_hash BINARY(32) NULL,
+    ADD INDEX idx_qr_codes_image_hash (image_hash);
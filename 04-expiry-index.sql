@@ -0,0 +1,5 @@
+-- Index used by the expiry sweeper to find outstanding codes by age
+USE waterDB;
+
+ALTER TABLE qr_codes
+    ADD INDEX idx_qr_codes_state_creation (state, creation_date);
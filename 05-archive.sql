@@ -0,0 +1,17 @@
+-- Archive for codes in a final state (usado, expirado, invalidado)
+USE waterDB;
+
+-- Same columns as qr_codes; rows are moved here by the archiver job
+CREATE TABLE IF NOT EXISTS qr_codes_archive (
+    qrcode_id VARCHAR(10) PRIMARY KEY,
+    value DECIMAL(10, 2),
+    state VARCHAR(45),
+    creation_date DATE,
+    used_date DATETIME,
+    qr_image MEDIUMBLOB,
+    image_hash BINARY(32) NULL,
+    change_seq BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    archived_at DATETIME NOT NULL,
+    INDEX idx_qr_codes_archive_creation (creation_date),
+    INDEX idx_qr_codes_archive_image_hash (image_hash)
+);
@@ -0,0 +1,9 @@
+-- Last journal entry applied by each server-side redemption journal
+USE waterDB;
+
+-- Updated in the same transaction as each batch of redemptions, so a batch
+-- replayed after a crash is recognised and applied only once
+CREATE TABLE IF NOT EXISTS qr_redemption_watermark (
+    journal VARCHAR(64) PRIMARY KEY,
+    last_entry BIGINT UNSIGNED NOT NULL
+);
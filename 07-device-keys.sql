@@ -0,0 +1,16 @@
+-- API keys of the readers (vending machines)
+USE waterDB;
+
+-- A key is presented as "<key_id>.<secret>"; only an HMAC of the secret is
+-- stored. Rotating a key creates a new row and gives the old one an
+-- expires_at, so both work during the changeover.
+CREATE TABLE IF NOT EXISTS device_keys (
+    key_id VARCHAR(16) PRIMARY KEY,
+    machine_id VARCHAR(64) NOT NULL,
+    secret_digest BINARY(32) NOT NULL,
+    description VARCHAR(255) NULL,
+    created_at DATETIME NOT NULL,
+    expires_at DATETIME NULL,
+    revoked_at DATETIME NULL,
+    INDEX idx_device_keys_machine (machine_id)
+);
@@ -0,0 +1,7 @@
+-- Index for the dashboard list filtered by state and paged by qrcode_id
+USE waterDB;
+
+-- GET /api/qrcodes?state=...&cursor=... reads a range of this index in
+-- qrcode_id order instead of filtering the whole primary key
+ALTER TABLE qr_codes
+    ADD INDEX idx_qr_codes_state_id (state, qrcode_id);
@@ -0,0 +1,37 @@
+-- Registry of sites and vending machines, and machine scoping of QR codes
+USE waterDB;
+
+CREATE TABLE IF NOT EXISTS sites (
+    site_id VARCHAR(32) PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    created_at DATETIME NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS machines (
+    machine_id VARCHAR(64) PRIMARY KEY,
+    site_id VARCHAR(32) NOT NULL,
+    name VARCHAR(255) NULL,
+    created_at DATETIME NOT NULL,
+    INDEX idx_machines_site (site_id),
+    CONSTRAINT fk_machines_site FOREIGN KEY (site_id) REFERENCES sites (site_id)
+);
+
+-- site_id / machine_id: where a code may be redeemed (NULL = anywhere).
+-- redeemed_machine_id: the machine that redeemed it.
+-- The (scope, state, qrcode_id) indexes serve the per-site and per-machine
+-- list pages and GROUP BY state counts without touching other sites' rows.
+ALTER TABLE qr_codes
+    ADD COLUMN site_id VARCHAR(32) NULL,
+    ADD COLUMN machine_id VARCHAR(64) NULL,
+    ADD COLUMN redeemed_machine_id VARCHAR(64) NULL,
+    ADD INDEX idx_qr_codes_site_state_id (site_id, state, qrcode_id),
+    ADD INDEX idx_qr_codes_machine_state_id (machine_id, state, qrcode_id),
+    ADD INDEX idx_qr_codes_redeemed_machine (redeemed_machine_id, used_date);
+
+ALTER TABLE qr_codes_archive
+    ADD COLUMN site_id VARCHAR(32) NULL,
+    ADD COLUMN machine_id VARCHAR(64) NULL,
+    ADD COLUMN redeemed_machine_id VARCHAR(64) NULL,
+    ADD INDEX idx_qr_codes_archive_site (site_id, creation_date),
+    ADD INDEX idx_qr_codes_archive_machine (machine_id, creation_date),
+    ADD INDEX idx_qr_codes_archive_redeemed_machine (redeemed_machine_id, used_date);
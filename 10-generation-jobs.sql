@@ -0,0 +1,39 @@
+-- Background bulk generation of QR codes
+USE waterDB;
+
+CREATE TABLE IF NOT EXISTS generation_jobs (
+    job_id VARCHAR(32) PRIMARY KEY,
+    status VARCHAR(16) NOT NULL,
+    count INT NOT NULL,
+    value DECIMAL(10, 2) NOT NULL,
+    state VARCHAR(45) NOT NULL,
+    site_id VARCHAR(32) NULL,
+    machine_id VARCHAR(64) NULL,
+    -- Sheet options as JSON (NULL = no sheet)
+    sheet TEXT NULL,
+    -- Codes committed so far; updated in the same transaction as each chunk
+    generated INT NOT NULL DEFAULT 0,
+    pages_total INT NOT NULL DEFAULT 0,
+    pages_done INT NOT NULL DEFAULT 0,
+    result_file VARCHAR(255) NULL,
+    cancel_requested TINYINT(1) NOT NULL DEFAULT 0,
+    failures INT NOT NULL DEFAULT 0,
+    error TEXT NULL,
+    -- host:pid of the worker processing the job; a stale heartbeat lets
+    -- another worker take the job over after a crash
+    worker VARCHAR(128) NULL,
+    heartbeat_at DATETIME NULL,
+    created_by VARCHAR(255) NULL,
+    created_at DATETIME NOT NULL,
+    started_at DATETIME NULL,
+    finished_at DATETIME NULL,
+    INDEX idx_generation_jobs_status (status, created_at)
+);
+
+-- Job that generated each code, to list or print the codes of a job
+ALTER TABLE qr_codes
+    ADD COLUMN job_id VARCHAR(32) NULL,
+    ADD INDEX idx_qr_codes_job (job_id, qrcode_id);
+
+ALTER TABLE qr_codes_archive
+    ADD COLUMN job_id VARCHAR(32) NULL;
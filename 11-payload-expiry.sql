@@ -0,0 +1,9 @@
+-- Expiry signed into the QR payload, fixed when the code is created so that
+-- later changes to EXPIRY_MAX_AGE_DAYS do not change printed codes
+USE waterDB;
+
+ALTER TABLE qr_codes
+    ADD COLUMN expires_on DATE NULL;
+
+ALTER TABLE qr_codes_archive
+    ADD COLUMN expires_on DATE NULL;
@@ -0,0 +1,15 @@
+-- Replies to redeems received on the reader ingest channel, shared by all
+-- API workers so a retry that lands on another worker gets the same reply
+USE waterDB;
+
+-- A row is claimed (response NULL) before the redeem runs and holds the
+-- JSON reply once it is done. Rows older than DEVICE_REPLY_TTL_HOURS are purged.
+CREATE TABLE IF NOT EXISTS device_replies (
+    machine_id VARCHAR(64) NOT NULL,
+    seq BIGINT NOT NULL,
+    qrcode_id VARCHAR(64) NOT NULL,
+    response TEXT NULL,
+    claimed_at DATETIME NOT NULL,
+    PRIMARY KEY (machine_id, seq, qrcode_id),
+    INDEX idx_device_replies_claimed (claimed_at)
+);
@@ -20,6 +20,8 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # Esquema OAuth2 para tokens
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# Igual, pero sin error si falta el token (endpoints que también aceptan clave de dispositivo)
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 # Usuarios de prueba (en producción, esto debería estar en la base de datos)
 USERS_DB = {
@@ -86,7 +88,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
-        if username is None:
+        # Los tickets SSE no sirven como token de acceso
+        if username is None or payload.get("purpose") is not None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
@@ -108,4 +111,35 @@ def check_admin_role(current_user: Dict = Depends(get_current_active_user)):
             status_code=status.HTTP_403_FORBIDDEN,
             detail="No tiene permisos suficientes para realizar esta acción"
         )
-    return current_user 
\ No newline at end of file
+    return current_user 
+
+
+# Tickets de /api/events: EventSource no permite cabeceras y el ticket va en
+# la URL, que acaba en los logs de acceso; por eso dura segundos y no sirve
+# para nada más
+SSE_TICKET_PURPOSE = "sse"
+SSE_TICKET_EXPIRE_SECONDS = int(os.getenv("SSE_TICKET_EXPIRE_SECONDS", "30"))
+
+def create_sse_ticket(username: str) -> str:
+    """Crea un ticket de corta duración que solo permite abrir el stream de eventos"""
+    return create_access_token(
+        {"sub": username, "purpose": SSE_TICKET_PURPOSE},
+        expires_delta=timedelta(seconds=SSE_TICKET_EXPIRE_SECONDS)
+    )
+
+async def get_current_user_from_ticket(ticket: str):
+    """Obtiene el usuario activo a partir del ticket SSE recibido en la query"""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Ticket de eventos no válido o caducado",
+    )
+    try:
+        payload = jwt.decode(ticket, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise credentials_exception
+    if payload.get("purpose") != SSE_TICKET_PURPOSE:
+        raise credentials_exception
+    user = get_user(payload.get("sub"))
+    if user is None:
+        raise credentials_exception
+    return await get_current_active_user(user)
@@ -0,0 +1,208 @@
+"""
+Benchmark: detector de QR del ESP32-CAM ejecutado en el escritorio.
+
+Carga ``qrcode_reader_esp32_cam/qr_motion_detector.py`` con los módulos
+simulados de ``qrcode_reader_esp32_cam/sim`` (``camera`` reproduce fotos del
+disco) y pasa por el detector un corpus de fotos de vales:
+
+- ``full``: ``detect_qr_in_image`` sobre el fotograma a resolución completa;
+- ``low``: el mismo sobre el fotograma de baja resolución (``LOW_RES_SCAN_STEP``);
+- ``scan_once``: el escaneo adaptativo completo (baja resolución, región
+  recordada, comprobación a resolución completa), como en la placa.
+
+Para cada modo muestra la tasa de detección en las fotos con código, los
+falsos positivos en las fotos sin código, el tiempo por fotograma (media,
+p50, p95) y el pico de memoria reservada por fotograma (tracemalloc). El
+fotograma ya está en memoria antes de medir, igual que el buffer del driver
+de la cámara en la placa. CPython es bastante más rápido que MicroPython en
+el ESP32, así que los tiempos sirven para comparar versiones del detector,
+no como tiempos absolutos del dispositivo.
+
+Estructura del corpus: fotos con código en ``<corpus>/qr/`` y sin código en
+``<corpus>/empty/``; si no hay subdirectorios, todas se cuentan como fotos
+con código. Con ``--synthetic`` se genera un corpus de vales sintéticos.
+
+Uso:
+    python benchmarks/bench_esp32_detector.py <corpus> [repeticiones]
+    python benchmarks/bench_esp32_detector.py --synthetic [imágenes] [repeticiones]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from typing import Callable, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+READER_DIR = os.path.join(ROOT, "qrcode_reader_esp32_cam")
+sys.path[:0] = [os.path.join(READER_DIR, "sim"), READER_DIR]
+
+import camera  # noqa: E402  (módulo simulado)
+import qr_motion_detector as detector  # noqa: E402
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".pgm", ".bmp")
+
+
+def list_images(directory: str) -> List[str]:
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+def load_corpus(corpus: str) -> List[Tuple[str, bool]]:
+    """(ruta, tiene código) de cada foto del corpus."""
+    positives = os.path.join(corpus, "qr")
+    negatives = os.path.join(corpus, "empty")
+    if not os.path.isdir(positives) and not os.path.isdir(negatives):
+        return [(path, True) for path in list_images(corpus)]
+    frames = []
+    if os.path.isdir(positives):
+        frames += [(path, True) for path in list_images(positives)]
+    if os.path.isdir(negatives):
+        frames += [(path, False) for path in list_images(negatives)]
+    return frames
+
+
+def make_synthetic_corpus(directory: str, count: int) -> str:
+    """Fotos sintéticas de vales sobre un fondo, la mitad sin código."""
+    import qrcode
+    from PIL import Image, ImageDraw, ImageFilter
+
+    rng = random.Random(42)
+    for sub in ("qr", "empty"):
+        os.makedirs(os.path.join(directory, sub), exist_ok=True)
+    for i in range(count):
+        has_code = i % 2 == 0
+        background = rng.randint(60, 170)
+        photo = Image.new("L", (800, 600), background)
+        card_w, card_h = rng.randint(360, 560), rng.randint(300, 420)
+        card_x, card_y = rng.randint(0, 800 - card_w), rng.randint(0, 600 - card_h)
+        card = Image.new("L", (card_w, card_h), rng.randint(215, 250))
+        draw = ImageDraw.Draw(card)
+        for line in range(4):
+            draw.text((16, 16 + line * 18), f"Vale {i:04d} - linea {line}", fill=rng.randint(20, 80))
+        if has_code:
+            code = qrcode.make(f"QR{i:06d}", box_size=rng.randint(4, 8), border=2).get_image().convert("L")
+            side = min(code.size[0], card_h - 100, card_w - 32)
+            card.paste(code.resize((side, side)), (rng.randint(16, card_w - side - 16), card_h - side - 16))
+        card = card.rotate(rng.uniform(-8, 8), expand=True, fillcolor=background)
+        photo.paste(card, (card_x, card_y))
+        photo = photo.filter(ImageFilter.GaussianBlur(rng.uniform(0, 1.2)))
+        noise = Image.effect_noise((800, 600), rng.uniform(4, 16))
+        photo = Image.blend(photo, noise, 0.15)
+        photo.save(os.path.join(directory, "qr" if has_code else "empty", f"vale_{i:04d}.png"))
+    return directory
+
+
+def capture(path: str, framesize: int) -> bytes:
+    camera.replay([path])
+    detector.current_framesize[0] = None
+    return detector.capture_frame(framesize, *camera.FRAMESIZES[framesize])
+
+
+def modes(frames: List[Tuple[str, bool]]) -> List[Tuple[str, Callable[[int], bool]]]:
+    """Modos a medir: función (índice de fotograma) -> detectado."""
+    full_w, full_h = detector.CAMERA_RESOLUTION
+    low_w, low_h = detector.LOW_RES_RESOLUTION
+    full_frames = [capture(path, detector.FULL_RES_FRAMESIZE) for path, _ in frames]
+    low_frames = [capture(path, detector.LOW_RES_FRAMESIZE) for path, _ in frames]
+    paths = [path for path, _ in frames]
+
+    def full(i: int) -> bool:
+        return bool(detector.detect_qr_in_image(full_frames[i], full_w, full_h))
+
+    def low(i: int) -> bool:
+        return bool(detector.detect_qr_in_image(low_frames[i], low_w, low_h, step=detector.LOW_RES_SCAN_STEP))
+
+    def scan_once(i: int) -> bool:
+        camera.replay([paths[i]])
+        return bool(detector.scan_once())
+
+    # Los fotogramas de scan_once se convierten antes de medir (caché del simulador)
+    for path in paths:
+        for size in (detector.LOW_RES_FRAMESIZE, detector.FULL_RES_FRAMESIZE):
+            camera.replay([path])
+            camera.framesize(size)
+            camera.capture()
+    detector.current_framesize[0] = None
+    return [("full", full), ("low", low), ("scan_once", scan_once)]
+
+
+def run_mode(fn: Callable[[int], bool], count: int, repeat: int):
+    """Detecciones, mejor tiempo de cada fotograma y pico de memoria de cada fotograma."""
+    times = [float("inf")] * count
+    detected = [False] * count
+    for _ in range(repeat):
+        detector.last_roi[0] = None
+        for i in range(count):
+            started = time.perf_counter()
+            detected[i] = fn(i)
+            times[i] = min(times[i], time.perf_counter() - started)
+
+    peaks = []
+    detector.last_roi[0] = None
+    tracemalloc.start()
+    try:
+        for i in range(count):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            fn(i)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return detected, times, peaks
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    args = sys.argv[1:]
+    tmp = tempfile.TemporaryDirectory()
+    if args and args[0] == "--synthetic":
+        count = int(args[1]) if len(args) > 1 else 40
+        repeat = int(args[2]) if len(args) > 2 else 3
+        corpus = make_synthetic_corpus(os.path.join(tmp.name, "corpus"), count)
+    elif args:
+        corpus = args[0]
+        repeat = int(args[1]) if len(args) > 1 else 3
+    else:
+        print(__doc__)
+        sys.exit(1)
+
+    frames = load_corpus(corpus)
+    if not frames:
+        print(f"No hay imágenes en {corpus}")
+        sys.exit(1)
+    # La región confirmada no se escribe en el directorio actual
+    detector.ROI_FILE = os.path.join(tmp.name, "roi.json")
+    camera.init(0, format=camera.GRAYSCALE)
+
+    positives = [has_code for _, has_code in frames]
+    n_pos = sum(positives)
+    n_neg = len(frames) - n_pos
+    print(f"{len(frames)} fotogramas ({n_pos} con código, {n_neg} sin código), {repeat} repeticiones")
+    print(f"{'modo':<10} {'detección':>10} {'falsos +':>9} {'media ms':>9} {'p50 ms':>8} {'p95 ms':>8} {'pico KB':>8}")
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        results = [(name, run_mode(fn, len(frames), repeat)) for name, fn in modes(frames)]
+    for name, (detected, times, peaks) in results:
+        hits = sum(1 for d, p in zip(detected, positives) if d and p)
+        false_hits = sum(1 for d, p in zip(detected, positives) if d and not p)
+        detection = f"{hits / n_pos:.0%}" if n_pos else "-"
+        false_rate = f"{false_hits / n_neg:.0%}" if n_neg else "-"
+        print(
+            f"{name:<10} {detection:>10} {false_rate:>9} {sum(times) / len(times) * 1000:9.2f} "
+            f"{percentile(times, 0.5) * 1000:8.2f} {percentile(times, 0.95) * 1000:8.2f} "
+            f"{max(peaks) / 1024:8.1f}"
+        )
+    tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
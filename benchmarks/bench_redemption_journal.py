@@ -0,0 +1,92 @@
+"""
+Benchmark: canjes por segundo en una ráfaga de lectores concurrentes.
+
+Compara un commit con fsync por canje (lo que hacía cada ``exchange_qr``,
+aquí sobre SQLite con synchronous=FULL para medir solo el coste del commit)
+con el journal de canjes, que agrupa en un solo commit todos los canjes que
+llegan mientras se hace el fsync anterior.
+
+Uso:
+    python benchmarks/bench_redemption_journal.py [canjes] [lectores concurrentes]
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from redemption_journal import RedemptionJournal
+
+
+def bench_commit_per_scan(path: str, total: int, concurrency: int) -> float:
+    """Cada canje abre su transacción y hace su propio commit."""
+    setup = sqlite3.connect(path, isolation_level=None)
+    setup.execute("PRAGMA journal_mode=WAL")
+    setup.execute("CREATE TABLE redemptions (id INTEGER PRIMARY KEY, qrcode_id TEXT UNIQUE, redeemed_at TEXT)")
+    setup.close()
+    local = threading.local()
+
+    def redeem(i: int):
+        if not hasattr(local, "conn"):
+            local.conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+            local.conn.execute("PRAGMA synchronous=FULL")
+        local.conn.execute("BEGIN IMMEDIATE")
+        local.conn.execute(
+            "INSERT INTO redemptions (qrcode_id, redeemed_at) VALUES (?, ?)",
+            (f"QR{i:07d}", datetime.now().isoformat())
+        )
+        local.conn.execute("COMMIT")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(redeem, range(total)))
+    return time.perf_counter() - started
+
+
+def bench_group_commit(path: str, total: int, concurrency: int):
+    """Canjes a través de RedemptionJournal (commit en grupo)."""
+    journal = RedemptionJournal(path)
+    groups = []
+    commit_group = journal._commit_group
+
+    def counting_commit(conn, group):
+        groups.append(len(group))
+        commit_group(conn, group)
+
+    journal._commit_group = counting_commit
+
+    def redeem(i: int):
+        return journal.append(f"QR{i:07d}", 1.0).result()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        accepted = sum(executor.map(redeem, range(total)))
+    elapsed = time.perf_counter() - started
+    journal.close()
+    assert accepted == total
+    return elapsed, groups
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+
+    with tempfile.TemporaryDirectory() as tmp:
+        per_scan = bench_commit_per_scan(os.path.join(tmp, "per_scan.db"), total, concurrency)
+        grouped, groups = bench_group_commit(os.path.join(tmp, "journal.db"), total, concurrency)
+
+    print(f"{total} canjes, {concurrency} lectores concurrentes")
+    print(f"Un commit por canje:  {per_scan:7.2f} s  {total / per_scan:9.0f} canjes/s")
+    print(f"Commit en grupo:      {grouped:7.2f} s  {total / grouped:9.0f} canjes/s  "
+          f"({len(groups)} commits, {total / len(groups):.1f} canjes por commit)")
+    print(f"Mejora: x{per_scan / grouped:.1f}")
+
+
+if __name__ == "__main__":
+    main()
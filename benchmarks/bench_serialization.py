@@ -0,0 +1,100 @@
+"""
+Benchmark: coste de CPU por fila al serializar listados de códigos QR.
+
+Compara el camino anterior (un objeto QRCode por fila, revalidado y
+serializado de nuevo por FastAPI a través de response_model=List[QRCode]) con
+el actual (fila -> dict con row_to_dict y una sola codificación con
+FastJSONResponse).
+
+Uso:
+    python benchmarks/bench_serialization.py [filas] [repeticiones]
+"""
+
+import asyncio
+import base64
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from qrcode_generator import QRCode
+from serialization import FastJSONResponse, orjson, row_to_dict
+
+
+def make_rows(count: int):
+    """Filas con la misma forma que devuelve mysql.connector para QR_COLUMNS."""
+    image = os.urandom(600)
+    today = date.today()
+    rows = []
+    for i in range(count):
+        used = i % 3 == 0
+        rows.append((
+            f"ID{i:06d}",
+            Decimal("0.00") if used else Decimal("10.00"),
+            "usado" if used else "valido",
+            today - timedelta(days=i % 30),
+            datetime.now() if used else None,
+            f"SITE{i % 4}",
+            None,
+            f"VM{i % 20:03d}" if used else None,
+            image,
+        ))
+    return rows
+
+
+def old_path(rows, field):
+    qr_codes = [
+        QRCode(
+            qrcode_id=row[0],
+            value=float(row[1]),
+            state=row[2],
+            creation_date=row[3],
+            used_date=row[4],
+            site_id=row[5],
+            machine_id=row[6],
+            redeemed_machine_id=row[7],
+            qr_image=base64.b64encode(row[8]).decode('utf-8') if row[8] else None,
+        )
+        for row in rows
+    ]
+    content = asyncio.run(serialize_response(field=field, response_content=qr_codes))
+    return JSONResponse(content).body
+
+
+def new_path(rows, field):
+    return FastJSONResponse([row_to_dict(row) for row in rows]).body
+
+
+def measure(func, rows, field, repeat: int) -> float:
+    func(rows, field)  # calentamiento
+    start = time.process_time()
+    for _ in range(repeat):
+        func(rows, field)
+    return (time.process_time() - start) / (repeat * len(rows))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rows = make_rows(count)
+    field = create_response_field(name="Response_get_all_qrcodes", type_=List[QRCode])
+
+    old = measure(old_path, rows, field, repeat)
+    new = measure(new_path, rows, field, repeat)
+    encoder = "orjson" if orjson is not None else "json (stdlib)"
+    print(f"{count} filas x {repeat} repeticiones, codificador: {encoder}")
+    print(f"  QRCode + response_model : {old * 1e6:8.2f} us/fila")
+    print(f"  row_to_dict + FastJSON  : {new * 1e6:8.2f} us/fila")
+    print(f"  mejora                  : {old / new:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Secuencia de cambios de la tabla qr_codes.
+
+Cada alta, canje o cambio de estado asigna a la fila un ``change_seq`` nuevo
+tomado de un contador de una sola fila (``qr_change_counter``). El contador se
+incrementa con ``LAST_INSERT_ID(expr)`` dentro de la misma transacción que
+modifica los códigos, así que el bloqueo de su fila se mantiene hasta el
+commit: los números se hacen visibles en el mismo orden en que se asignan y
+un cliente que lee ``change_seq > cursor`` nunca se salta un cambio.
+"""
+
+from datetime import date, datetime
+from typing import Any, Dict, List, Sequence, Tuple
+
+# Columnas que se envían en el feed (sin la imagen). El ámbito va al final
+# para que change_seq siga en la posición 5; los lectores lo usan para
+# comprobar sin red dónde se puede canjear cada código.
+CHANGE_COLUMNS = (
+    "qrcode_id, value, state, creation_date, used_date, change_seq, site_id, machine_id, redeemed_machine_id"
+)
+
+
+def stamp_changes(cursor, qrcode_ids: Sequence[str]) -> int:
+    """
+    Asigna un número de secuencia nuevo a cada código de la lista.
+    Debe llamarse dentro de la transacción que modifica esas filas.
+    Devuelve el último número asignado.
+    """
+    count = len(qrcode_ids)
+    if count == 0:
+        return 0
+    cursor.execute(
+        'UPDATE qr_change_counter SET seq = LAST_INSERT_ID(seq + %s) WHERE id = 1',
+        (count,)
+    )
+    cursor.execute('SELECT LAST_INSERT_ID()')
+    last_seq = cursor.fetchone()[0]
+    first_seq = last_seq - count + 1
+    placeholders = ", ".join(["%s"] * count)
+    cursor.execute(
+        f'UPDATE qr_codes SET change_seq = %s + FIELD(qrcode_id, {placeholders}) - 1 '
+        f'WHERE qrcode_id IN ({placeholders})',
+        (first_seq, *qrcode_ids, *qrcode_ids)
+    )
+    return last_seq
+
+
+def fetch_changes(cursor, since: int, limit: int) -> Tuple[List[tuple], bool]:
+    """
+    Devuelve las filas con ``change_seq > since`` en orden de secuencia,
+    como mucho ``limit``, y si quedan más cambios por leer.
+    """
+    cursor.execute(
+        f'SELECT {CHANGE_COLUMNS} FROM qr_codes WHERE change_seq > %s '
+        'ORDER BY change_seq LIMIT %s',
+        (since, limit + 1)
+    )
+    rows = cursor.fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+def change_row_to_dict(row: Sequence[Any]) -> Dict[str, Any]:
+    """Convierte una fila de CHANGE_COLUMNS al formato de QRCodeChange."""
+    creation_date = row[3]
+    if isinstance(creation_date, date) and not isinstance(creation_date, datetime):
+        creation_date = datetime.combine(creation_date, datetime.min.time())
+    return {
+        "qrcode_id": row[0],
+        "value": float(row[1]),
+        "state": row[2],
+        "creation_date": creation_date,
+        "used_date": row[4],
+        "change_seq": row[5],
+        "site_id": row[6],
+        "machine_id": row[7],
+        "redeemed_machine_id": row[8],
+    }
@@ -0,0 +1,283 @@
+"""
+Backfill: recodifica y deduplica las imágenes QR guardadas en qr_codes y en
+qr_codes_archive.
+
+Recorre qr_codes y después qr_codes_archive (las filas que el Archiver ya
+movió conservan su imagen en línea) en orden de qrcode_id por lotes. Cada
+imagen en línea (qr_image) se recodifica como PNG de 1 bit y se guarda una
+sola vez en qr_image_blobs; la fila pasa a referenciarla por image_hash. Con
+--drop las imágenes se eliminan sin más, porque el QR se puede regenerar a
+partir de qrcode_id.
+
+El progreso de cada tabla se guarda en su fichero de checkpoint
+(--checkpoint, --archive-checkpoint) tras cada lote, así que el proceso se
+puede interrumpir y reanudar. Entre lotes se espera --sleep
+segundos para no cargar la base de datos. Los duplicados se cuentan contra
+qr_image_blobs, no contra lo visto en esta ejecución, y el resumen final sale
+de la base de datos, así que las cifras son correctas tras reanudar.
+
+Con --sweep-orphans se borran además, por lotes, las imágenes de
+qr_image_blobs a las que ya no apunta ninguna fila de qr_codes ni de
+qr_codes_archive (por ejemplo, si falló la inserción que la iba a usar).
+
+Uso:
+    python compact_qr_images.py [--batch-size 200] [--sleep 0.5] [--drop] [--dry-run]
+    python compact_qr_images.py --sweep-orphans [--dry-run]
+"""
+
+import argparse
+import logging
+import os
+import time
+
+import mysql.connector
+from dotenv import load_dotenv
+
+from image_store import image_hash, store_image, try_compact_png
+
+load_dotenv()
+
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# Tablas recorridas, en este orden
+TABLES = ("qr_codes", "qr_codes_archive")
+
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST", "localhost"),
+    "user": os.getenv("DB_USER", "root"),
+    "password": os.getenv("DB_PASSWORD", ""),
+    "database": os.getenv("DB_NAME", "waterDB")
+}
+
+
+def read_checkpoint(path: str) -> str:
+    if os.path.exists(path):
+        with open(path) as f:
+            return f.read().strip()
+    return ""
+
+
+def write_checkpoint(path: str, last_id: str):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(last_id)
+    os.replace(tmp_path, path)
+
+
+def stored_hashes(cursor, digests) -> set:
+    """Hashes de la lista que ya están en qr_image_blobs."""
+    digests = list(set(digests))
+    if not digests:
+        return set()
+    placeholders = ", ".join(["%s"] * len(digests))
+    cursor.execute(f'SELECT image_hash FROM qr_image_blobs WHERE image_hash IN ({placeholders})', digests)
+    return {bytes(row[0]) for row in cursor.fetchall()}
+
+
+def compact_batch(cursor, table: str, rows, drop: bool, dry_run: bool, seen_hashes: set, stats: dict):
+    """
+    Procesa un lote de filas (qrcode_id, qr_image) de table. Una imagen cuenta como
+    duplicada si su hash ya está en qr_image_blobs; en una simulación, que no
+    guarda nada, también si ya apareció antes en esta ejecución.
+    """
+    updates = []
+    images = []
+    for qrcode_id, data in rows:
+        stats["rows"] += 1
+        stats["bytes_before"] += len(data)
+        if drop:
+            updates.append((None, qrcode_id))
+            continue
+        compact = try_compact_png(data)
+        if compact is None:
+            # No es una imagen legible: se deduplica tal cual
+            logging.warning(f"Imagen de {qrcode_id} no legible; se guarda sin recodificar")
+            compact = data
+        images.append((qrcode_id, compact, image_hash(compact)))
+
+    known = stored_hashes(cursor, [digest for _, _, digest in images])
+    for qrcode_id, compact, digest in images:
+        if digest in known or digest in seen_hashes:
+            stats["duplicates"] += 1
+        else:
+            stats["bytes_after"] += len(compact)
+            if dry_run:
+                seen_hashes.add(digest)
+            else:
+                known.add(digest)
+        if not dry_run:
+            store_image(cursor, compact)
+        updates.append((digest, qrcode_id))
+    if not dry_run:
+        cursor.executemany(
+            f'UPDATE {table} SET qr_image = NULL, image_hash = %s WHERE qrcode_id = %s',
+            updates
+        )
+
+
+def image_totals(cursor) -> dict:
+    """Estado actual del almacén de imágenes, leído de la base de datos."""
+    cursor.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM qr_image_blobs')
+    blobs, blob_bytes = cursor.fetchone()
+    cursor.execute(
+        'SELECT COUNT(*), COUNT(DISTINCT image_hash) FROM ('
+        'SELECT image_hash FROM qr_codes WHERE image_hash IS NOT NULL '
+        'UNION ALL '
+        'SELECT image_hash FROM qr_codes_archive WHERE image_hash IS NOT NULL) AS refs'
+    )
+    references, distinct = cursor.fetchone()
+    inline = {}
+    for table in TABLES:
+        cursor.execute(f'SELECT COUNT(*), COALESCE(SUM(LENGTH(qr_image)), 0) FROM {table} WHERE qr_image IS NOT NULL')
+        count, size = cursor.fetchone()
+        inline[table] = (count, int(size))
+    return {
+        "blobs": blobs,
+        "blob_bytes": int(blob_bytes),
+        "references": references,
+        "duplicates": references - distinct,
+        "inline": inline,
+    }
+
+
+def new_stats() -> dict:
+    return {"rows": 0, "bytes_before": 0, "bytes_after": 0, "duplicates": 0}
+
+
+def backfill(db, cursor, table: str, checkpoint: str, args, seen_hashes: set, stats: dict):
+    """Recorre las imágenes en línea de table por lotes, guardando el progreso en checkpoint."""
+    last_id = "" if args.restart or args.dry_run else read_checkpoint(checkpoint)
+    if last_id:
+        logging.info(f"{table}: reanudando después de {last_id}")
+    while True:
+        cursor.execute(
+            f'SELECT qrcode_id, qr_image FROM {table} '
+            'WHERE qrcode_id > %s AND qr_image IS NOT NULL '
+            'ORDER BY qrcode_id LIMIT %s',
+            (last_id, args.batch_size)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        compact_batch(cursor, table, rows, args.drop, args.dry_run, seen_hashes, stats)
+        last_id = rows[-1][0]
+        if not args.dry_run:
+            db.commit()
+            write_checkpoint(checkpoint, last_id)
+
+        saved = stats["bytes_before"] - stats["bytes_after"]
+        logging.info(
+            f"{table}: {stats['rows']} filas procesadas (hasta {last_id}), "
+            f"{saved / 1024:.1f} KiB ahorrados"
+        )
+        time.sleep(args.sleep)
+
+
+def print_stats(title: str, stats: dict):
+    saved = stats["bytes_before"] - stats["bytes_after"]
+    ratio = (saved / stats["bytes_before"] * 100) if stats["bytes_before"] else 0
+    print(title)
+    print(f"  Filas procesadas:    {stats['rows']}")
+    print(f"  Imágenes duplicadas: {stats['duplicates']}")
+    print(f"  Bytes antes:         {stats['bytes_before']}")
+    print(f"  Bytes después:       {stats['bytes_after']}")
+    print(f"  Bytes ahorrados:     {saved} ({ratio:.1f}%)")
+
+
+def sweep_orphans(db, cursor, batch_size: int, pause: float, dry_run: bool) -> int:
+    """
+    Borra las imágenes de qr_image_blobs sin ninguna fila que las use. El
+    DELETE vuelve a comprobar las referencias, así que una imagen que alguien
+    empiece a usar entre la consulta y el borrado se conserva.
+    """
+    orphan_sql = (
+        'SELECT b.image_hash FROM qr_image_blobs b '
+        'WHERE b.image_hash > %s '
+        'AND NOT EXISTS (SELECT 1 FROM qr_codes c WHERE c.image_hash = b.image_hash) '
+        'AND NOT EXISTS (SELECT 1 FROM qr_codes_archive a WHERE a.image_hash = b.image_hash) '
+        'ORDER BY b.image_hash LIMIT %s'
+    )
+    last_hash = b""
+    removed = 0
+    while True:
+        cursor.execute(orphan_sql, (last_hash, batch_size))
+        orphans = [bytes(row[0]) for row in cursor.fetchall()]
+        if not orphans:
+            break
+        last_hash = orphans[-1]
+        if dry_run:
+            removed += len(orphans)
+            continue
+        placeholders = ", ".join(["%s"] * len(orphans))
+        cursor.execute(
+            f'DELETE FROM qr_image_blobs WHERE image_hash IN ({placeholders}) '
+            'AND NOT EXISTS (SELECT 1 FROM qr_codes c WHERE c.image_hash = qr_image_blobs.image_hash) '
+            'AND NOT EXISTS (SELECT 1 FROM qr_codes_archive a WHERE a.image_hash = qr_image_blobs.image_hash)',
+            orphans
+        )
+        removed += cursor.rowcount
+        db.commit()
+        logging.info(f"{removed} imágenes huérfanas borradas")
+        time.sleep(pause)
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recodifica y deduplica las imágenes de qr_codes")
+    parser.add_argument("--batch-size", type=int, default=200, help="Filas por lote")
+    parser.add_argument("--sleep", type=float, default=0.5, help="Pausa entre lotes en segundos")
+    parser.add_argument("--drop", action="store_true", help="Eliminar las imágenes en lugar de recodificarlas")
+    parser.add_argument("--dry-run", action="store_true", help="Calcular el ahorro sin modificar la base de datos")
+    parser.add_argument("--checkpoint", default=".compact_qr_images.checkpoint", help="Fichero de progreso")
+    parser.add_argument("--archive-checkpoint", default=".compact_qr_images.archive.checkpoint",
+                        help="Fichero de progreso de qr_codes_archive")
+    parser.add_argument("--restart", action="store_true", help="Ignorar los checkpoints y empezar desde el principio")
+    parser.add_argument("--sweep-orphans", action="store_true", help="Borrar las imágenes de qr_image_blobs que ninguna fila usa")
+    args = parser.parse_args()
+
+    if args.sweep_orphans:
+        db = mysql.connector.connect(**DB_CONFIG)
+        cursor = db.cursor()
+        try:
+            removed = sweep_orphans(db, cursor, args.batch_size, args.sleep, args.dry_run)
+        finally:
+            cursor.close()
+            db.close()
+        print(f"Imágenes huérfanas {'encontradas' if args.dry_run else 'borradas'}: {removed}")
+        return
+
+    checkpoints = {"qr_codes": args.checkpoint, "qr_codes_archive": args.archive_checkpoint}
+    results = {table: new_stats() for table in TABLES}
+    seen_hashes = set()
+    db = mysql.connector.connect(**DB_CONFIG)
+    cursor = db.cursor()
+    try:
+        try:
+            for table in TABLES:
+                backfill(db, cursor, table, checkpoints[table], args, seen_hashes, results[table])
+        except KeyboardInterrupt:
+            # El lote a medias se descarta; el checkpoint apunta al último confirmado
+            db.rollback()
+            logging.info("Interrumpido; se puede reanudar desde el checkpoint")
+        totals = image_totals(cursor)
+    finally:
+        cursor.close()
+        db.close()
+
+    print_stats("En esta ejecución, qr_codes:", results["qr_codes"])
+    print_stats("En esta ejecución, qr_codes_archive:", results["qr_codes_archive"])
+    print("En la base de datos:")
+    print(f"  Imágenes distintas:  {totals['blobs']} ({totals['blob_bytes']} bytes)")
+    print(f"  Filas que las usan:  {totals['references']} ({totals['duplicates']} duplicadas)")
+    for table, (count, size) in totals["inline"].items():
+        print(f"  En línea en {table}: {count} ({size} bytes, sin migrar)")
+    if args.dry_run:
+        print("(simulación: no se ha modificado la base de datos)")
+
+
+if __name__ == "__main__":
+    main()
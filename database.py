@@ -0,0 +1,309 @@
+"""
+Pool de conexiones MySQL por proceso.
+
+Con varios workers (gunicorn, ``WEB_CONCURRENCY``) cada proceso tiene su
+propio pool, así que el tamaño se calcula a partir del presupuesto total de
+conexiones: ``DB_CONNECTION_BUDGET // WEB_CONCURRENCY``. La suma de todos los
+workers nunca supera el presupuesto aunque se añadan procesos.
+
+El pool se crea en el primer uso, es decir, ya dentro del worker después del
+fork, para que ningún socket se comparta entre procesos. ``close()`` sobre una
+conexión del pool la devuelve al pool (y deshace lo que no se haya
+confirmado), de modo que el código que llama a ``get_connection()`` se usa
+igual que con ``mysql.connector.connect()``.
+
+Réplicas de lectura (``DB_REPLICA_HOSTS``, lista ``host[:puerto]`` separada
+por comas): ``get_read_connection()`` devuelve una conexión a una réplica
+para las lecturas que toleran datos algo atrasados (listados, estadísticas,
+exportación). Las escrituras y las lecturas que deben ver lo que se acaba de
+escribir (canjes, consultas de un código, feed de cambios) siguen usando
+``get_connection()``, que va siempre al primario. Un hilo mide cada
+``DB_REPLICA_CHECK_INTERVAL`` segundos el retraso de cada réplica
+(``SHOW REPLICA STATUS``); una réplica que no responde, con la replicación
+parada o con más retraso que el admitido no se usa y la lectura va al
+primario.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import mysql.connector
+from dotenv import load_dotenv
+from mysql.connector import pooling
+
+from diagnostics import TimedConnection, instrument_connection
+
+load_dotenv()
+
+# mysql-connector no admite pools de más de 32 conexiones
+MAX_POOL_SIZE = pooling.CNX_POOL_MAXSIZE
+
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST", "localhost"),
+    "user": os.getenv("DB_USER", "root"),
+    "password": os.getenv("DB_PASSWORD", ""),
+    "database": os.getenv("DB_NAME", "waterDB")
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def worker_count() -> int:
+    return max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+
+def pool_size() -> int:
+    """Conexiones de este proceso: su parte del presupuesto total."""
+    explicit = int(os.getenv("DB_POOL_SIZE", "0"))
+    if explicit:
+        return min(explicit, MAX_POOL_SIZE)
+    budget = int(os.getenv("DB_CONNECTION_BUDGET", "60"))
+    return max(1, min(budget // worker_count(), MAX_POOL_SIZE))
+
+
+def get_pool() -> pooling.MySQLConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                size = pool_size()
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name=f"qr-api-{os.getpid()}",
+                    pool_size=size,
+                    pool_reset_session=True,
+                    **DB_CONFIG
+                )
+                logging.info(f"Pool de base de datos creado: {size} conexiones (pid {os.getpid()})")
+    return _pool
+
+
+def get_connection():
+    """
+    Devuelve una conexión del pool. Si están todas en uso espera hasta
+    ``DB_POOL_TIMEOUT`` segundos antes de lanzar ``mysql.connector.errors.PoolError``.
+    Con el registro de consultas lentas activo la conexión va envuelta en un
+    ``diagnostics.TimedConnection``.
+
+    La espera bloquea el hilo: los endpoints que usan la base de datos son
+    ``def`` (threadpool de FastAPI) y el código ``async`` la llama con
+    ``run_in_threadpool``. Si aun así se llama desde el hilo del event loop,
+    no se espera: con el pool agotado falla en el acto en lugar de congelar
+    todas las conexiones SSE y de los lectores.
+    """
+    return _pooled_connection(get_pool(), _pool_timeout())
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def _pool_timeout() -> float:
+    if _on_event_loop():
+        return 0.0
+    return float(os.getenv("DB_POOL_TIMEOUT", "5"))
+
+
+def _pooled_connection(pool: pooling.MySQLConnectionPool, timeout: float):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return instrument_connection(pool.get_connection())
+        except mysql.connector.errors.PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.01)
+
+
+def discard_connection(connection):
+    """
+    Cierra una conexión del pool en lugar de devolverla, para cuando queda en
+    un estado que no se puede reutilizar (un cursor sin buffer con filas sin
+    leer: ``reset_session`` falla y el pool la guardaría igual). El pool
+    recibe una conexión nueva en su lugar.
+    """
+    if isinstance(connection, TimedConnection):
+        connection = connection._connection
+    if not isinstance(connection, pooling.PooledMySQLConnection):
+        connection.close()
+        return
+    cnx, pool = connection._cnx, connection._cnx_pool
+    # Sin _cnx, PooledMySQLConnection ya no la devuelve al pool
+    connection._cnx = None
+    try:
+        # Con la extensión C descarta las filas pendientes; el conector puro
+        # cierra el socket sin leerlas
+        cnx.close()
+    except mysql.connector.Error:
+        pass
+    try:
+        pool.add_connection()
+    except mysql.connector.Error as e:
+        logging.error(f"No se pudo reponer la conexión descartada del pool {pool.pool_name}: {e}")
+
+
+class Replica:
+    """Una réplica de lectura con su propio pool y el último retraso medido."""
+
+    def __init__(self, address: str):
+        host, _, port = address.strip().partition(":")
+        self.name = address.strip()
+        self.config = {
+            **DB_CONFIG,
+            "host": host,
+            "port": int(port or 3306),
+            "user": os.getenv("DB_REPLICA_USER", DB_CONFIG["user"]),
+            "password": os.getenv("DB_REPLICA_PASSWORD", DB_CONFIG["password"]),
+        }
+        self._pool: Optional[pooling.MySQLConnectionPool] = None
+        self._lock = threading.Lock()
+        # Segundos de retraso; None = sin medir, caída o replicación parada
+        self.lag: Optional[float] = None
+        self.error: Optional[str] = None
+        self.checked_at: Optional[datetime] = None
+
+    def pool(self) -> pooling.MySQLConnectionPool:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    size = int(os.getenv("DB_REPLICA_POOL_SIZE", "0")) or pool_size()
+                    self._pool = pooling.MySQLConnectionPool(
+                        pool_name=f"qr-replica-{re.sub(r'[^A-Za-z0-9.]', '-', self.name)}-{os.getpid()}",
+                        pool_size=min(size, MAX_POOL_SIZE),
+                        pool_reset_session=True,
+                        **self.config
+                    )
+        return self._pool
+
+    def check(self):
+        """Mide el retraso de la réplica."""
+        try:
+            db = self.pool().get_connection()
+        except mysql.connector.Error as e:
+            self.mark_down(e)
+            return
+        cursor = db.cursor(dictionary=True)
+        try:
+            try:
+                cursor.execute("SHOW REPLICA STATUS")
+            except mysql.connector.Error:
+                # MySQL anterior a 8.0.22
+                cursor.execute("SHOW SLAVE STATUS")
+            status = cursor.fetchone()
+            if status is None:
+                # No es una réplica (por ejemplo, el mismo servidor en desarrollo)
+                self.lag, self.error = 0.0, None
+            else:
+                lag = status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+                if lag is None:
+                    self.lag, self.error = None, "replicación parada"
+                else:
+                    self.lag, self.error = float(lag), None
+        except mysql.connector.Error as e:
+            self.mark_down(e)
+        finally:
+            cursor.close()
+            db.close()
+            self.checked_at = datetime.now()
+
+    def mark_down(self, error: Exception):
+        if self.lag is not None:
+            logging.warning(f"Réplica {self.name} no disponible: {error}")
+        self.lag, self.error = None, str(error)
+
+
+class ReplicaRouter:
+    """Reparte las lecturas entre las réplicas que no superan el retraso admitido."""
+
+    def __init__(self, replicas: List[Replica], max_lag: float = 5, check_interval: float = 2):
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._next = itertools.count()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls) -> "ReplicaRouter":
+        hosts = [host for host in os.getenv("DB_REPLICA_HOSTS", "").split(",") if host.strip()]
+        return cls(
+            [Replica(host) for host in hosts],
+            max_lag=float(os.getenv("DB_REPLICA_MAX_LAG", "5")),
+            check_interval=float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "2"))
+        )
+
+    def start(self):
+        if self.replicas and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="db-replicas", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            for replica in self.replicas:
+                replica.check()
+            self._stop.wait(self.check_interval)
+
+    def get_connection(self, max_lag: Optional[float] = None):
+        """Conexión a una réplica con retraso <= max_lag, o None si no hay ninguna."""
+        max_lag = self.max_lag if max_lag is None else max_lag
+        healthy = [r for r in self.replicas if r.lag is not None and r.lag <= max_lag]
+        if not healthy:
+            return None
+        start = next(self._next)
+        for i in range(len(healthy)):
+            replica = healthy[(start + i) % len(healthy)]
+            try:
+                # Un solo intento: una réplica saturada no hace esperar, se
+                # prueba la siguiente y, al final, el primario
+                return instrument_connection(replica.pool().get_connection())
+            except mysql.connector.errors.PoolError:
+                continue
+            except mysql.connector.Error as e:
+                replica.mark_down(e)
+        return None
+
+    def status(self) -> List[Dict]:
+        return [
+            {
+                "replica": r.name,
+                "lag_seconds": r.lag,
+                "usable": r.lag is not None and r.lag <= self.max_lag,
+                "error": r.error,
+                "checked_at": r.checked_at,
+            }
+            for r in self.replicas
+        ]
+
+
+replicas = ReplicaRouter.from_env()
+
+
+def get_read_connection(max_lag: Optional[float] = None):
+    """
+    Conexión para lecturas que admiten hasta ``max_lag`` segundos de retraso
+    (``DB_REPLICA_MAX_LAG`` por defecto): una réplica si hay alguna al día,
+    si no el primario. ``max_lag=0`` va siempre al primario.
+    """
+    if replicas.replicas and (max_lag is None or max_lag > 0):
+        connection = replicas.get_connection(max_lag)
+        if connection is not None:
+            return connection
+    return get_connection()
@@ -0,0 +1,211 @@
+"""
+Autenticación de los lectores (máquinas) con claves de API.
+
+Los lectores no pueden hacer el login con usuario y contraseña de ``auth.py``
+(bcrypt en cada arranque, tokens que caducan a los 30 minutos), así que cada
+máquina recibe una clave propia:
+
+    <key_id>.<secreto>
+
+que envía en la cabecera ``X-Device-Key`` junto con ``X-Machine-Id``. En la
+base de datos (``device_keys``) solo se guarda el HMAC-SHA256 del secreto con
+la clave del servidor (``DEVICE_KEY_PEPPER``). Cada worker mantiene en memoria
+la tabla de claves activas y la recarga cada ``refresh_interval`` segundos,
+así que validar una petición es una búsqueda en un diccionario, un HMAC y un
+``hmac.compare_digest``: microsegundos y ninguna consulta.
+
+- Rotación: ``rotate`` crea una clave nueva para la misma máquina y deja la
+  antigua válida durante un periodo de gracia.
+- Revocación: ``revoke`` la retira de inmediato en el worker que la revoca y
+  en los demás en la siguiente recarga.
+- Cada clave está ligada a un ``machine_id`` y solo vale con esa máquina.
+"""
+
+import hashlib
+import hmac
+import logging
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+KEY_HEADER = "X-Device-Key"
+MACHINE_HEADER = "X-Machine-Id"
+
+
+class DeviceAuthError(Exception):
+    """La clave no existe, no es válida, ha caducado o no corresponde a la máquina."""
+
+
+class DeviceKey(NamedTuple):
+    key_id: str
+    machine_id: str
+    secret_digest: bytes
+    expires_at: Optional[datetime]
+
+
+class DeviceKeyStore:
+    """Tabla en memoria de las claves activas, recargada desde ``device_keys``."""
+
+    def __init__(self, connect: Callable, pepper: bytes, refresh_interval: float = 30,
+                 min_refresh_gap: float = 5):
+        self.connect = connect
+        self.pepper = pepper
+        self.refresh_interval = refresh_interval
+        # Una clave desconocida adelanta la recarga, como mucho una vez cada min_refresh_gap
+        self.min_refresh_gap = min_refresh_gap
+        self.loaded_at: Optional[datetime] = None
+        self._keys: Dict[str, DeviceKey] = {}
+        self._last_refresh = 0.0
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def digest(self, secret: str) -> bytes:
+        return hmac.new(self.pepper, secret.encode("utf-8"), hashlib.sha256).digest()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="device-keys", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                # Se siguen usando las claves cargadas la última vez
+                logging.error(f"Error recargando las claves de dispositivo: {e}")
+            self._wake.wait(self.refresh_interval)
+            self._wake.clear()
+
+    def refresh(self):
+        self._last_refresh = time.monotonic()
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'SELECT key_id, machine_id, secret_digest, expires_at FROM device_keys '
+                'WHERE revoked_at IS NULL AND (expires_at IS NULL OR expires_at > NOW())'
+            )
+            keys = {row[0]: DeviceKey(row[0], row[1], bytes(row[2]), row[3]) for row in cursor.fetchall()}
+        finally:
+            cursor.close()
+            db.close()
+        self._keys = keys
+        self.loaded_at = datetime.now()
+
+    def authenticate(self, presented: Optional[str], machine_id: Optional[str]) -> DeviceKey:
+        """Valida la clave presentada por una máquina. Lanza DeviceAuthError."""
+        if not presented or "." not in presented:
+            raise DeviceAuthError("Falta la clave de dispositivo o está mal formada")
+        key_id, _, secret = presented.partition(".")
+        key = self._keys.get(key_id)
+        if key is None:
+            if time.monotonic() - self._last_refresh > self.min_refresh_gap:
+                # Puede ser una clave creada en otro worker después de la última recarga
+                self._wake.set()
+            # El HMAC se calcula igualmente para no distinguir por tiempo
+            hmac.compare_digest(self.digest(secret), bytes(32))
+            raise DeviceAuthError("Clave de dispositivo no válida")
+        if not hmac.compare_digest(self.digest(secret), key.secret_digest):
+            raise DeviceAuthError("Clave de dispositivo no válida")
+        if key.expires_at is not None and key.expires_at <= datetime.now():
+            raise DeviceAuthError("Clave de dispositivo caducada")
+        if machine_id != key.machine_id:
+            raise DeviceAuthError("La clave no corresponde a esta máquina")
+        return key
+
+    def create(self, machine_id: str, description: Optional[str] = None) -> Tuple[DeviceKey, str]:
+        """Crea una clave para la máquina. Devuelve (clave, clave completa); el secreto no se guarda."""
+        key_id = secrets.token_hex(6)
+        secret = secrets.token_urlsafe(32)
+        digest = self.digest(secret)
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'INSERT INTO device_keys (key_id, machine_id, secret_digest, description, created_at) '
+                'VALUES (%s, %s, %s, %s, %s)',
+                (key_id, machine_id, digest, description, datetime.now())
+            )
+            db.commit()
+        finally:
+            cursor.close()
+            db.close()
+        key = DeviceKey(key_id, machine_id, digest, None)
+        self._keys = {**self._keys, key_id: key}
+        return key, f"{key_id}.{secret}"
+
+    def rotate(self, key_id: str, grace: timedelta) -> Optional[Tuple[DeviceKey, str]]:
+        """Nueva clave para la misma máquina; la antigua caduca tras ``grace``. None si no existe."""
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'SELECT machine_id, description FROM device_keys WHERE key_id = %s AND revoked_at IS NULL',
+                (key_id,)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                db.rollback()
+                return None
+            expires_at = datetime.now() + grace
+            cursor.execute(
+                'UPDATE device_keys SET expires_at = LEAST(COALESCE(expires_at, %s), %s) WHERE key_id = %s',
+                (expires_at, expires_at, key_id)
+            )
+            db.commit()
+        finally:
+            cursor.close()
+            db.close()
+        old = self._keys.get(key_id)
+        if old is not None:
+            self._keys = {**self._keys, key_id: old._replace(
+                expires_at=min(old.expires_at or expires_at, expires_at)
+            )}
+        return self.create(row[0], row[1])
+
+    def revoke(self, key_id: str) -> bool:
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'UPDATE device_keys SET revoked_at = %s WHERE key_id = %s AND revoked_at IS NULL',
+                (datetime.now(), key_id)
+            )
+            revoked = cursor.rowcount > 0
+            db.commit()
+        finally:
+            cursor.close()
+            db.close()
+        self._keys = {k: v for k, v in self._keys.items() if k != key_id}
+        return revoked
+
+    def list_keys(self, machine_id: Optional[str] = None) -> List[Dict]:
+        """Claves registradas (sin secretos), de una máquina o de todas."""
+        query = ('SELECT key_id, machine_id, description, created_at, expires_at, revoked_at '
+                 'FROM device_keys')
+        params = ()
+        if machine_id is not None:
+            query += ' WHERE machine_id = %s'
+            params = (machine_id,)
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(query + ' ORDER BY machine_id, created_at', params)
+            columns = ("key_id", "machine_id", "description", "created_at", "expires_at", "revoked_at")
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+            db.close()
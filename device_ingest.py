@@ -0,0 +1,303 @@
+"""
+Canal persistente de los lectores: TCP con mensajes con prefijo de longitud.
+
+Cada petición HTTP desde un ESP32 abre una conexión (y TLS) nueva, lo que es
+lento y consume mucha memoria en el chip. Por este canal el lector abre una
+sola conexión, se autentica una vez y envía sus mensajes sin esperar a las
+respuestas; cada respuesta lleva el ``seq`` del mensaje al que contesta y
+puede llegar en otro orden.
+
+Formato de cada mensaje, en ambos sentidos:
+
+    <longitud: 4 bytes, big-endian><JSON UTF-8>
+
+El primer mensaje es ``{"seq": 1, "op": "hello", "key": "<key_id>.<secreto>",
+"machine_id": "..."}`` con la clave de dispositivo (``device_auth``). Después:
+
+- ``{"seq": n, "op": "redeem", "qrcode_id": "..."}``: canjea un código.
+- ``{"seq": n, "op": "lookup", "qrcode_id": "..."}``: estado y valor.
+- ``{"seq": n, "op": "ping"}``: mantiene viva la conexión.
+
+Las respuestas son ``{"seq": n, "ok": true|false, "status": <código HTTP>,
+...}`` con los mismos códigos y ``detail`` que la API HTTP.
+
+El ``seq`` de cada lector sigue creciendo entre reconexiones. Si se cae la
+conexión antes de la respuesta de un canje, el lector lo reenvía con el mismo
+``seq`` y recibe la respuesta guardada en vez de un "ya canjeado". Las
+respuestas de ``redeem`` se guardan por ``(machine_id, seq, qrcode_id)`` en
+``reply_store`` (``device_replies.DeviceReplyStore``, en MySQL), porque el
+reintento llega por una conexión nueva y el kernel puede dársela a otro
+worker. Cada worker recuerda además las suyas recientes en memoria. Los
+errores 5xx no se guardan, para que el reintento vuelva a ejecutarse.
+
+El servidor es asyncio y una conexión inactiva solo cuesta su socket y una
+corrutina, así que miles de lectores conectados no ocupan hilos ni
+conexiones de base de datos. Los handlers que van a MySQL corren en el
+threadpool y, entre todas las conexiones, como mucho ``max_concurrency`` a la
+vez, para no agotar el pool de la API HTTP. Con varios workers cada uno abre el puerto con
+``SO_REUSEPORT`` y el kernel reparte las conexiones.
+"""
+
+import asyncio
+import json
+import logging
+import struct
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from device_auth import DeviceAuthError, DeviceKey
+from device_replies import CLAIMED, DONE, DeviceReplyStore
+from serialization import dumps
+
+HEADER = struct.Struct(">I")
+
+Handler = Callable[[DeviceKey, Dict], Awaitable[Dict]]
+
+
+class ProtocolError(Exception):
+    """Mensaje mal formado o demasiado grande."""
+
+
+async def read_message(reader: asyncio.StreamReader, max_size: int) -> Optional[Dict]:
+    """Lee un mensaje; None si el lector cerró la conexión entre mensajes."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise
+    (length,) = HEADER.unpack(header)
+    if length > max_size:
+        raise ProtocolError(f"Mensaje de {length} bytes (máximo {max_size})")
+    body = await reader.readexactly(length)
+    try:
+        message = json.loads(body)
+    except ValueError:
+        raise ProtocolError("JSON no válido")
+    if not isinstance(message, dict):
+        raise ProtocolError("El mensaje debe ser un objeto JSON")
+    return message
+
+
+def encode_message(message: Dict) -> bytes:
+    body = dumps(message)
+    return HEADER.pack(len(body)) + body
+
+
+class DeviceIngestServer:
+    """Servidor asyncio del canal de lectores."""
+
+    def __init__(self, authenticate: Callable[[str, str], DeviceKey], handlers: Dict[str, Handler],
+                 host: str = "0.0.0.0", port: int = 7000, idle_timeout: float = 300,
+                 hello_timeout: float = 10, max_in_flight: int = 16, max_message_size: int = 16384,
+                 max_concurrency: int = 8, replay_ops=("redeem",), replay_size: int = 4096,
+                 reply_store: Optional[DeviceReplyStore] = None, replay_poll: float = 0.2):
+        self.authenticate = authenticate
+        self.handlers = handlers
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.hello_timeout = hello_timeout
+        # Mensajes de una conexión procesándose a la vez (el resto espera en el socket)
+        self.max_in_flight = max_in_flight
+        self.max_message_size = max_message_size
+        # Handlers ejecutándose a la vez entre todas las conexiones (sin contar ping)
+        self.max_concurrency = max_concurrency
+        self._slots = asyncio.Semaphore(max_concurrency)
+        # Respuestas recientes de las operaciones que cambian estado, por
+        # (machine_id, seq, qrcode_id); mientras se procesa, el Future de la respuesta
+        self.replay_ops = set(replay_ops)
+        self.replay_size = replay_size
+        self._replies: "OrderedDict[Tuple[str, object, object], asyncio.Future]" = OrderedDict()
+        # Las mismas respuestas, compartidas con los demás workers
+        self.reply_store = reply_store
+        self.replay_poll = replay_poll
+        self.connections = 0
+        self.messages = 0
+        self.replayed = 0
+        self._server: Optional[asyncio.base_events.Server] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port, reuse_port=True
+        )
+        logging.info(f"Canal de lectores escuchando en {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def status(self) -> Dict:
+        return {
+            "port": self.port,
+            "connections": self.connections,
+            "messages": self.messages,
+            "replayed": self.replayed
+        }
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername")
+        self.connections += 1
+        write_lock = asyncio.Lock()
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+
+        async def send(message: Dict):
+            async with write_lock:
+                writer.write(encode_message(message))
+                await writer.drain()
+
+        try:
+            device = await self._hello(reader, send)
+            if device is None:
+                return
+            while True:
+                message = await asyncio.wait_for(
+                    read_message(reader, self.max_message_size), self.idle_timeout
+                )
+                if message is None:
+                    break
+                self.messages += 1
+                await in_flight.acquire()
+                task = asyncio.create_task(self._dispatch(device, message, send, in_flight))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except asyncio.TimeoutError:
+            logging.info(f"Canal de lectores: {peer} inactivo, se cierra la conexión")
+        except ProtocolError as e:
+            logging.warning(f"Canal de lectores: {peer}: {e}")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # Los canjes ya empezados terminan aunque la respuesta no llegue
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            self.connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _hello(self, reader: asyncio.StreamReader, send) -> Optional[DeviceKey]:
+        message = await asyncio.wait_for(read_message(reader, self.max_message_size), self.hello_timeout)
+        if message is None:
+            return None
+        seq = message.get("seq")
+        if message.get("op") != "hello":
+            await send({"seq": seq, "ok": False, "status": 401, "detail": "Se esperaba hello"})
+            return None
+        try:
+            device = self.authenticate(message.get("key"), message.get("machine_id"))
+        except DeviceAuthError as e:
+            await send({"seq": seq, "ok": False, "status": 401, "detail": str(e)})
+            return None
+        await send({"seq": seq, "ok": True, "status": 200, "idle_timeout": self.idle_timeout})
+        return device
+
+    async def _dispatch(self, device: DeviceKey, message: Dict, send, in_flight: asyncio.Semaphore):
+        try:
+            response = await self._respond(device, message)
+        finally:
+            in_flight.release()
+        response = {**response, "seq": message.get("seq")}
+        try:
+            await send(response)
+        except ConnectionError:
+            pass
+
+    async def _respond(self, device: DeviceKey, message: Dict) -> Dict:
+        op = message.get("op")
+        seq = message.get("seq")
+        if op not in self.replay_ops or seq is None:
+            return await self._call(device, message)
+        # Con el código en la clave, un lector que se reinicia y vuelve a
+        # empezar los seq no recibe la respuesta de otro canje
+        key = (device.machine_id, seq, message.get("qrcode_id"))
+        reply = self._replies.get(key)
+        if reply is not None:
+            # Reintento de un mensaje ya recibido: misma respuesta, sin repetir el canje
+            self.replayed += 1
+            return await asyncio.shield(reply)
+        reply = asyncio.get_running_loop().create_future()
+        self._replies[key] = reply
+        while len(self._replies) > self.replay_size:
+            self._replies.popitem(last=False)
+        shared = self.reply_store is not None and isinstance(seq, int) and isinstance(key[2], str)
+        try:
+            claimed, response = (await self._claim(key)) if shared else (False, None)
+            if response is None:
+                response = await self._call(device, message)
+                if claimed:
+                    await self._store(key, response)
+        except BaseException:
+            # Cancelado (cierre del worker): el reintento volverá a ejecutarse;
+            # en otro worker, cuando caduque la reclamación
+            self._forget(key, reply)
+            reply.cancel()
+            raise
+        if response["status"] >= 500:
+            self._forget(key, reply)
+        reply.set_result(response)
+        return response
+
+    async def _claim(self, key) -> Tuple[bool, Optional[Dict]]:
+        """
+        Reclama el mensaje en reply_store. Devuelve (True, None) si lo ejecuta
+        este worker y (False, respuesta) si ya lo respondió otro; mientras otro
+        worker lo procesa, espera. Si MySQL falla, se ejecuta sin guardar.
+        """
+        while True:
+            try:
+                async with self._slots:
+                    state, response = await run_in_threadpool(self.reply_store.claim, key)
+            except Exception as e:
+                logging.error(f"Canal de lectores: no se pudo reclamar {key}: {e}")
+                return False, None
+            if state == CLAIMED:
+                return True, None
+            if state == DONE:
+                self.replayed += 1
+                return False, response
+            await asyncio.sleep(self.replay_poll)
+
+    async def _store(self, key, response: Dict):
+        try:
+            async with self._slots:
+                if response["status"] >= 500:
+                    await run_in_threadpool(self.reply_store.release, key)
+                else:
+                    await run_in_threadpool(self.reply_store.save, key, response)
+        except Exception as e:
+            logging.error(f"Canal de lectores: no se pudo guardar la respuesta de {key}: {e}")
+
+    def _forget(self, key, reply: asyncio.Future):
+        if self._replies.get(key) is reply:
+            del self._replies[key]
+
+    async def _call(self, device: DeviceKey, message: Dict) -> Dict:
+        op = message.get("op")
+        handler = self.handlers.get(op)
+        if handler is None:
+            return {"ok": False, "status": 400, "detail": "Operación desconocida"}
+        try:
+            if op == "ping":
+                result = await handler(device, message)
+            else:
+                async with self._slots:
+                    result = await handler(device, message)
+            return {**result, "ok": True, "status": 200}
+        except HTTPException as e:
+            return {"ok": False, "status": e.status_code, "detail": e.detail}
+        except Exception as e:
+            logging.error(f"Canal de lectores: error en {op} de {device.machine_id}: {e}")
+            return {"ok": False, "status": 500, "detail": "Error interno"}
+
+
+async def ping(device: DeviceKey, message: Dict) -> Dict:
+    return {}
@@ -0,0 +1,137 @@
+"""
+Respuestas de los canjes del canal de lectores, guardadas en MySQL
+(``device_replies``) para que las vean todos los workers.
+
+Cada worker abre el puerto del canal con ``SO_REUSEPORT``, así que el
+reintento de un lector que se ha reconectado puede llegar a otro worker que
+el mensaje original. Antes de canjear, el worker reclama la fila
+``(machine_id, seq, qrcode_id)``; al terminar guarda en ella la respuesta.
+Un reintento que llega a otro worker encuentra la respuesta guardada o, si
+el canje original todavía se está procesando, espera a que termine. Una
+reclamación sin respuesta durante más de ``pending_timeout`` segundos (el
+worker murió a mitad) la puede retomar otro worker.
+"""
+
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+import mysql.connector
+from mysql.connector import errorcode
+
+from serialization import dumps
+
+# Resultado de claim
+CLAIMED = "claimed"     # este worker ejecuta el canje
+DONE = "done"           # ya hay respuesta guardada
+PENDING = "pending"     # otro worker lo está procesando
+
+ReplyKey = Tuple[str, int, str]
+
+
+class DeviceReplyStore:
+    """Reclamaciones y respuestas de los canjes, por (machine_id, seq, qrcode_id)."""
+
+    def __init__(self, connect: Callable, ttl_hours: float = 24, pending_timeout: float = 30,
+                 purge_interval: float = 600):
+        self.connect = connect
+        self.ttl = timedelta(hours=ttl_hours)
+        self.pending_timeout = timedelta(seconds=pending_timeout)
+        self.purge_interval = purge_interval
+        self._last_purge = time.monotonic()
+        self._purge_lock = threading.Lock()
+
+    def claim(self, key: ReplyKey) -> Tuple[str, Optional[Dict]]:
+        """
+        Reclama el canje para este worker. Devuelve (CLAIMED, None), (DONE,
+        respuesta guardada) o (PENDING, None) si otro worker lo está procesando.
+        """
+        self._maybe_purge()
+        now = datetime.now()
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            try:
+                cursor.execute(
+                    'INSERT INTO device_replies (machine_id, seq, qrcode_id, claimed_at) VALUES (%s, %s, %s, %s)',
+                    (*key, now)
+                )
+                db.commit()
+                return CLAIMED, None
+            except mysql.connector.IntegrityError as e:
+                db.rollback()
+                if e.errno != errorcode.ER_DUP_ENTRY:
+                    raise
+            cursor.execute(
+                'SELECT response, claimed_at FROM device_replies '
+                'WHERE machine_id = %s AND seq = %s AND qrcode_id = %s',
+                key
+            )
+            row = cursor.fetchone()
+            if row is None:
+                # Purgada entre el INSERT y el SELECT: se vuelve a intentar
+                return PENDING, None
+            response, claimed_at = row
+            if response is not None:
+                return DONE, json.loads(response)
+            if claimed_at < now - self.pending_timeout:
+                # El worker que la reclamó no respondió: se retoma
+                cursor.execute(
+                    'UPDATE device_replies SET claimed_at = %s '
+                    'WHERE machine_id = %s AND seq = %s AND qrcode_id = %s '
+                    'AND response IS NULL AND claimed_at = %s',
+                    (now, *key, claimed_at)
+                )
+                db.commit()
+                if cursor.rowcount == 1:
+                    return CLAIMED, None
+            return PENDING, None
+        finally:
+            cursor.close()
+            db.close()
+
+    def save(self, key: ReplyKey, response: Dict):
+        """Guarda la respuesta del canje reclamado."""
+        self._execute(
+            'UPDATE device_replies SET response = %s WHERE machine_id = %s AND seq = %s AND qrcode_id = %s',
+            (dumps(response).decode("utf-8"), *key)
+        )
+
+    def release(self, key: ReplyKey):
+        """Suelta la reclamación sin respuesta (error 5xx): el reintento vuelve a ejecutarse."""
+        self._execute(
+            'DELETE FROM device_replies WHERE machine_id = %s AND seq = %s AND qrcode_id = %s '
+            'AND response IS NULL',
+            key
+        )
+
+    def purge(self) -> int:
+        """Borra las filas más antiguas que ttl; devuelve cuántas."""
+        return self._execute('DELETE FROM device_replies WHERE claimed_at < %s', (datetime.now() - self.ttl,))
+
+    def _maybe_purge(self):
+        if time.monotonic() - self._last_purge < self.purge_interval or not self._purge_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_purge = time.monotonic()
+            removed = self.purge()
+            if removed:
+                logging.info(f"{removed} respuestas antiguas del canal de lectores borradas")
+        except mysql.connector.Error as e:
+            logging.error(f"Error borrando respuestas antiguas del canal de lectores: {e}")
+        finally:
+            self._purge_lock.release()
+
+    def _execute(self, sql: str, params) -> int:
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(sql, params)
+            db.commit()
+            return cursor.rowcount
+        finally:
+            cursor.close()
+            db.close()
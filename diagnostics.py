@@ -0,0 +1,244 @@
+"""
+Diagnóstico en producción: perfiles de peticiones y registro de consultas lentas.
+
+Ambos están desactivados por defecto y se activan en caliente, sin reiniciar:
+la configuración vive en un fichero JSON (``DIAGNOSTICS_SETTINGS_PATH``) que
+escribe el endpoint de administración y que cada worker vuelve a leer cuando
+cambia su fecha de modificación (se comprueba como mucho una vez por segundo).
+
+- ``ProfilingMiddleware`` perfila con cProfile una de cada
+  ``profile_sample_rate`` peticiones y guarda el ``.prof`` en
+  ``DIAGNOSTICS_PROFILE_DIR`` con la ruta y la duración en el nombre. Con
+  ``profile_slow_ms`` solo se guardan los perfiles de las peticiones que
+  superan ese tiempo. Toda petición más lenta que ``profile_slow_ms`` queda
+  además en el log, esté o no perfilada. cProfile ve todo lo que se ejecuta
+  en el hilo del event loop mientras dura la petición, incluidas otras
+  peticiones concurrentes.
+- ``TimedConnection`` envuelve una conexión MySQL y registra en el logger
+  ``slow_queries`` cada ``execute`` que tarde más de ``slow_query_ms``, con la
+  forma de la consulta (sin valores), el número de parámetros y la duración.
+"""
+
+import cProfile
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict
+
+from starlette.routing import Match
+
+DEFAULT_SETTINGS = {
+    # Perfilar 1 de cada N peticiones (0 = desactivado)
+    "profile_sample_rate": 0,
+    # Guardar perfiles solo de peticiones más lentas (0 = todos los muestreados)
+    "profile_slow_ms": 0,
+    # Registrar consultas más lentas que esto (0 = desactivado)
+    "slow_query_ms": 0,
+}
+
+slow_query_logger = logging.getLogger("slow_queries")
+
+
+class SettingsStore:
+    """Configuración compartida por los workers a través de un fichero JSON."""
+
+    def __init__(self, path: str, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._settings = dict(DEFAULT_SETTINGS)
+        self._mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self._reload()
+        return self._settings
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            if self._mtime is not None:
+                self._settings, self._mtime = dict(DEFAULT_SETTINGS), None
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path) as f:
+                loaded = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"No se pudo leer {self.path}: {e}")
+            return
+        self._settings = {**DEFAULT_SETTINGS, **{k: v for k, v in loaded.items() if k in DEFAULT_SETTINGS}}
+        self._mtime = mtime
+        logging.info(f"Configuración de diagnóstico cargada: {self._settings}")
+
+    def update(self, changes: Dict[str, Any]) -> Dict[str, Any]:
+        """Guarda la nueva configuración; los demás workers la leen por mtime."""
+        with self._lock:
+            settings = {**self.get(), **changes}
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(settings, f)
+            os.replace(tmp_path, self.path)
+            self._next_check = 0.0
+            return self.get()
+
+
+settings_store = SettingsStore(os.getenv("DIAGNOSTICS_SETTINGS_PATH", "diagnostics.json"))
+
+
+# Literales de la consulta y listas de marcadores, para agrupar por forma
+_STRING_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBER_RE = re.compile(r"\b\d+\b")
+_PLACEHOLDER_LIST_RE = re.compile(r"%s(?:\s*,\s*%s)+")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def query_shape(sql: str) -> str:
+    """Normaliza una consulta: sin literales, con las listas IN colapsadas."""
+    shape = _STRING_RE.sub("?", sql)
+    shape = _NUMBER_RE.sub("?", shape)
+    shape = _PLACEHOLDER_LIST_RE.sub("%s, ...", shape)
+    return _SPACE_RE.sub(" ", shape).strip()
+
+
+class TimedCursor:
+    """Cursor que mide cada consulta y registra las lentas."""
+
+    def __init__(self, cursor, threshold_ms: float):
+        self._cursor = cursor
+        self._threshold_ms = threshold_ms
+
+    def _log(self, operation: str, param_count: int, started: float):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms >= self._threshold_ms:
+            slow_query_logger.warning(
+                f"Consulta lenta: {elapsed_ms:.1f} ms, {param_count} parámetros: {query_shape(operation)}"
+            )
+
+    def execute(self, operation, params=(), *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, params, *args, **kwargs)
+        finally:
+            self._log(operation, len(params or ()), started)
+
+    def executemany(self, operation, seq_params):
+        seq_params = list(seq_params)
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(operation, seq_params)
+        finally:
+            self._log(operation, sum(len(params) for params in seq_params), started)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class TimedConnection:
+    """Conexión cuyos cursores registran las consultas lentas."""
+
+    def __init__(self, connection, threshold_ms: float):
+        self._connection = connection
+        self._threshold_ms = threshold_ms
+
+    def cursor(self, *args, **kwargs):
+        return TimedCursor(self._connection.cursor(*args, **kwargs), self._threshold_ms)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def instrument_connection(connection):
+    """Envuelve la conexión si el registro de consultas lentas está activo."""
+    threshold_ms = settings_store.get()["slow_query_ms"]
+    if threshold_ms and threshold_ms > 0:
+        return TimedConnection(connection, threshold_ms)
+    return connection
+
+
+def _route_template(scope) -> str:
+    """
+    Plantilla de la ruta que atendió la petición (``/api/qrcodes/{qrcode_id}``),
+    para agrupar perfiles y logs por endpoint. Starlette 0.27 no guarda la ruta
+    en el scope, así que se busca en el router de la app la que coincide con la
+    petición; si ninguna coincide, se usa la ruta de la URL.
+    """
+    app = scope.get("app")
+    for route in getattr(getattr(app, "router", None), "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", scope["path"])
+    return scope["path"]
+
+
+def _route_slug(path: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_") or "root"
+
+
+class ProfilingMiddleware:
+    """Perfila una muestra de las peticiones HTTP según settings_store."""
+
+    def __init__(self, app, output_dir: str = "profiles"):
+        self.app = app
+        self.output_dir = output_dir
+        self._counter = itertools.count(1)
+        # cProfile no admite dos perfiladores activos a la vez
+        self._profiling = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        settings = settings_store.get()
+        sample_rate = settings["profile_sample_rate"]
+        slow_ms = settings["profile_slow_ms"]
+        if not sample_rate and not slow_ms:
+            await self.app(scope, receive, send)
+            return
+
+        profiler = None
+        if sample_rate and not self._profiling and next(self._counter) % sample_rate == 0:
+            profiler = cProfile.Profile()
+            self._profiling = True
+            profiler.enable()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+            route = _route_template(scope)
+            if slow_ms and elapsed_ms >= slow_ms:
+                logging.warning(f"Petición lenta: {scope['method']} {route} {elapsed_ms:.1f} ms")
+            if profiler is not None and (not slow_ms or elapsed_ms >= slow_ms):
+                self._save(profiler, scope["method"], route, elapsed_ms)
+
+    def _save(self, profiler: cProfile.Profile, method: str, route: str, elapsed_ms: float):
+        os.makedirs(self.output_dir, exist_ok=True)
+        filename = (
+            f"{datetime.now():%Y%m%d-%H%M%S-%f}_{method}_{_route_slug(route)}_"
+            f"{elapsed_ms:.0f}ms_{os.getpid()}.prof"
+        )
+        path = os.path.join(self.output_dir, filename)
+        try:
+            profiler.dump_stats(path)
+            logging.info(f"Perfil guardado: {path} ({method} {route}, {elapsed_ms:.1f} ms)")
+        except OSError as e:
+            logging.error(f"No se pudo guardar el perfil {path}: {e}")
@@ -0,0 +1,157 @@
+"""
+Publicador en proceso de eventos de códigos QR (Server-Sent Events).
+
+Un único ``EventBroker`` por proceso recibe los eventos (altas, canjes,
+cambios de estado) y los reparte a todas las conexiones abiertas de los
+dashboards. Cada evento se serializa una sola vez y se encola ya formateado
+en la cola de cada suscriptor.
+
+Si un suscriptor no consume sus eventos y su cola se llena, se le desconecta:
+el navegador reconecta automáticamente enviando ``Last-Event-ID`` y recupera
+lo perdido desde el feed de cambios.
+
+Con varios workers, un cambio hecho en un proceso no llega a los dashboards
+conectados a otro. En ese modo cada worker arranca un ``ChangeFeedRelay``
+que lee el feed de cambios (``change_seq``) y reparte lo nuevo a sus propios
+suscriptores; las publicaciones directas se ignoran para no duplicar eventos.
+"""
+
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Optional, Set
+
+from change_feed import change_row_to_dict, fetch_changes
+from serialization import dumps
+
+
+def format_sse(event: str, data: Dict[str, Any], event_id: Optional[int] = None) -> str:
+    """Formatea un evento según el protocolo text/event-stream."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {dumps(data).decode('utf-8')}")
+    return "\n".join(lines) + "\n\n"
+
+
+class EventBroker:
+    """Reparte eventos a las colas de todos los suscriptores conectados."""
+
+    def __init__(self, queue_size: int = 100):
+        self._queue_size = queue_size
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # True cuando los eventos llegan por ChangeFeedRelay
+        self.from_feed = False
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> asyncio.Queue:
+        """Registra un suscriptor nuevo. Debe llamarse desde el event loop."""
+        self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self._queue_size)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, event: str, data: Dict[str, Any], event_id: Optional[int] = None):
+        """
+        Publica un evento. Se puede llamar desde el event loop o desde otro
+        hilo (por ejemplo, tareas en segundo plano).
+        """
+        if self.from_feed:
+            return
+        self.broadcast(event, data, event_id)
+
+    def broadcast(self, event: str, data: Dict[str, Any], event_id: Optional[int] = None):
+        """Reparte un evento a los suscriptores de este proceso."""
+        if not self._subscribers or self._loop is None:
+            return
+        message = format_sse(event, data, event_id)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._fanout(message)
+        else:
+            self._loop.call_soon_threadsafe(self._fanout, message)
+
+    def _fanout(self, message: str):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Suscriptor lento: vaciar su cola y cerrar su stream
+                logging.warning("Suscriptor de eventos lento desconectado")
+                self._subscribers.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+
+class ChangeFeedRelay:
+    """Sondea el feed de cambios y publica lo nuevo en el broker del proceso."""
+
+    def __init__(self, broker: EventBroker, connect: Callable, interval: float = 1.0, batch_size: int = 500):
+        self.broker = broker
+        self.connect = connect
+        self.interval = interval
+        self.batch_size = batch_size
+        self.last_seq: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.broker.from_feed = True
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.broker.subscriber_count:
+                # Sin dashboards conectados no hace falta leer nada; al volver a
+                # haberlos se empieza desde el cambio actual (los clientes que
+                # reconectan recuperan lo perdido con Last-Event-ID).
+                self.last_seq = None
+                continue
+            try:
+                await loop.run_in_executor(None, self._poll)
+            except Exception as e:
+                logging.error(f"Error leyendo el feed de cambios: {e}")
+
+    def _poll(self):
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            if self.last_seq is None:
+                cursor.execute('SELECT seq FROM qr_change_counter WHERE id = 1')
+                self.last_seq = cursor.fetchone()[0]
+                return
+            has_more = True
+            while has_more:
+                rows, has_more = fetch_changes(cursor, self.last_seq, self.batch_size)
+                for row in rows:
+                    self.broker.broadcast("change", change_row_to_dict(row), row[5])
+                if rows:
+                    self.last_seq = rows[-1][5]
+            db.commit()
+        finally:
+            cursor.close()
+            db.close()
+
+
+broker = EventBroker()
@@ -0,0 +1,145 @@
+"""
+Exportación en streaming del libro de códigos QR (CSV o NDJSON).
+
+La consulta se lee con un cursor sin buffer: MySQL envía las filas a medida
+que se piden y el conector no las acumula en memoria. Las filas se recogen en
+bloques de ``chunk_size`` con ``fetchmany`` y cada bloque se codifica y se
+entrega a la respuesta antes de leer el siguiente, así que la memoria usada
+no depende del número total de filas. Si la descarga se corta a mitad, la
+conexión se descarta en lugar de volver al pool con filas sin leer.
+"""
+
+import csv
+import io
+import logging
+from datetime import date
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from database import discard_connection
+from serialization import dumps
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+EXPORT_FIELDS = (
+    "qrcode_id", "value", "state", "creation_date", "used_date",
+    "site_id", "machine_id", "redeemed_machine_id",
+)
+
+
+def build_export_query(
+    state: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    site_id: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    redeemed_machine_id: Optional[str] = None
+) -> Tuple[str, List]:
+    """
+    Construye la consulta de exportación con los filtros opcionales.
+    Incluye los códigos archivados en qr_codes_archive.
+    """
+    conditions = []
+    params = []
+    for column, value in (
+        ("site_id", site_id), ("machine_id", machine_id), ("redeemed_machine_id", redeemed_machine_id)
+    ):
+        if value:
+            conditions.append(f"{column} = %s")
+            params.append(value)
+    if state:
+        conditions.append("state = %s")
+        params.append(state)
+    if date_from:
+        conditions.append("creation_date >= %s")
+        params.append(date_from)
+    if date_to:
+        conditions.append("creation_date <= %s")
+        params.append(date_to)
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    fields = ", ".join(EXPORT_FIELDS)
+    query = (
+        f'SELECT {fields} FROM qr_codes{where} '
+        f'UNION ALL SELECT {fields} FROM qr_codes_archive{where}'
+    )
+    return query, params + params
+
+
+def _encode_csv(rows, header: bool) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        writer.writerow([
+            row[0],
+            row[1],
+            row[2],
+            row[3].isoformat() if row[3] else "",
+            row[4].isoformat() if row[4] else "",
+            row[5] or "",
+            row[6] or "",
+            row[7] or "",
+        ])
+    return buffer.getvalue().encode("utf-8")
+
+
+def _encode_ndjson(rows) -> bytes:
+    return b"".join(
+        dumps({
+            "qrcode_id": row[0],
+            "value": float(row[1]) if row[1] is not None else None,
+            "state": row[2],
+            "creation_date": row[3],
+            "used_date": row[4],
+            "site_id": row[5],
+            "machine_id": row[6],
+            "redeemed_machine_id": row[7],
+        }) + b"\n"
+        for row in rows
+    )
+
+
+def iter_export_chunks(
+    connect: Callable,
+    export_format: str,
+    state: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    chunk_size: int = 1000,
+    site_id: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    redeemed_machine_id: Optional[str] = None
+) -> Iterator[bytes]:
+    """Genera la exportación por bloques. Abre y cierra su propia conexión."""
+    query, params = build_export_query(state, date_from, date_to, site_id, machine_id, redeemed_machine_id)
+    db = connect()
+    cursor = db.cursor(buffered=False)
+    exported = 0
+    completed = False
+    try:
+        cursor.execute(query, params)
+        if export_format == "csv":
+            yield _encode_csv([], header=True)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            exported += len(rows)
+            if export_format == "csv":
+                yield _encode_csv(rows, header=False)
+            else:
+                yield _encode_ndjson(rows)
+        completed = True
+        logging.info(f"Exportación {export_format} completada: {exported} códigos QR")
+    finally:
+        if completed:
+            cursor.close()
+            db.close()
+        else:
+            # El cliente cortó la descarga (o falló la consulta): pueden quedar
+            # filas sin leer y la conexión no se puede devolver al pool así
+            logging.warning(f"Exportación {export_format} interrumpida tras {exported} filas")
+            discard_connection(db)
@@ -0,0 +1,558 @@
+"""
+Generación masiva de códigos QR en segundo plano.
+
+Un administrador crea un trabajo (``generation_jobs``) con el número de
+códigos, su valor y estado y, opcionalmente, las opciones de una hoja
+imprimible. La petición solo inserta la fila del trabajo; los hilos de
+``GenerationWorkers`` de cualquier worker de la API lo procesan:
+
+- Reclamo: ``SELECT ... FOR UPDATE SKIP LOCKED`` sobre los trabajos
+  pendientes, así que dos workers nunca toman el mismo trabajo ni se esperan
+  entre sí.
+- Por bloques: cada bloque de ``chunk_size`` códigos se inserta en una
+  transacción que también suma el bloque a ``generated`` y renueva
+  ``heartbeat_at``. El progreso guardado siempre coincide con los códigos
+  confirmados, y tras un reinicio el trabajo sigue desde ahí.
+- Reinicios: al parar, el worker termina el bloque en curso y devuelve el
+  trabajo a 'pendiente'. Si el proceso muere, el trabajo queda en 'en_proceso'
+  con un ``heartbeat_at`` antiguo y otro worker lo reclama pasados
+  ``stale_after`` segundos. Antes de cada bloque se comprueba, con la fila del
+  trabajo bloqueada, que sigue siendo de este worker.
+- Cancelación: ``cancel`` marca ``cancel_requested``; el worker lo ve antes del
+  siguiente bloque (o página de la hoja) y deja el trabajo en 'cancelado'. Los
+  códigos ya confirmados se conservan y se pueden descargar.
+- Imágenes: los códigos se insertan sin imagen. ``/api/qrdata/{id}/image``
+  la dibuja la primera vez que se pide y la guarda; las hojas se dibujan a
+  partir del contenido del QR.
+- Hoja: terminada la generación, las páginas se dibujan en el pool de procesos
+  de ``voucher_sheet`` y se escriben en ``directory`` como PDF (o ZIP de PNG).
+"""
+
+import csv
+import io
+import json
+import logging
+import os
+import secrets
+import socket
+import threading
+import zipfile
+from collections import deque
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Optional
+
+import mysql.connector
+from mysql.connector import errorcode
+
+from change_feed import stamp_changes
+from events import broker
+from voucher_sheet import build_pdf, compute_layout, get_executor, render_page, sheet_workers
+
+# Estados de un trabajo
+PENDING = "pendiente"
+RUNNING = "en_proceso"
+COMPLETED = "completado"
+CANCELLED = "cancelado"
+FAILED = "fallido"
+
+FINISHED_STATES = (COMPLETED, CANCELLED, FAILED)
+
+JOB_COLUMNS = (
+    "job_id, status, count, value, state, site_id, machine_id, sheet, generated, pages_total, "
+    "pages_done, result_file, cancel_requested, failures, error, worker, heartbeat_at, created_by, "
+    "created_at, started_at, finished_at"
+)
+
+
+class JobLost(Exception):
+    """El trabajo ya no es de este worker (reclamado por otro o cancelado)."""
+
+
+def job_row_to_dict(row) -> Dict:
+    (job_id, status, count, value, state, site_id, machine_id, sheet, generated, pages_total,
+     pages_done, result_file, cancel_requested, failures, error, worker, heartbeat_at, created_by,
+     created_at, started_at, finished_at) = row
+    return {
+        "job_id": job_id,
+        "status": status,
+        "count": count,
+        "generated": generated,
+        "progress": round(generated / count, 4) if count else 1.0,
+        "value": float(value),
+        "state": state,
+        "site_id": site_id,
+        "machine_id": machine_id,
+        "sheet": json.loads(sheet) if sheet else None,
+        "pages_total": pages_total,
+        "pages_done": pages_done,
+        "sheet_ready": result_file is not None,
+        "cancel_requested": bool(cancel_requested),
+        "failures": failures,
+        "error": error,
+        "worker": worker,
+        "heartbeat_at": heartbeat_at,
+        "created_by": created_by,
+        "created_at": created_at,
+        "started_at": started_at,
+        "finished_at": finished_at,
+    }
+
+
+class GenerationWorkers:
+    """Hilos que reclaman y procesan trabajos de generación."""
+
+    def __init__(self, connect: Callable, new_id: Callable[[], str], content: Callable,
+                 expiry: Callable[[date], Optional[date]] = lambda creation_date: None,
+                 directory: str = "jobs", workers: int = 1, chunk_size: int = 1000,
+                 poll_interval: float = 2, stale_after: float = 120, max_failures: int = 3,
+                 id_retries: int = 5):
+        self.connect = connect
+        self.new_id = new_id
+        # content(qrcode_id, value, expires_on) -> texto del QR
+        self.content = content
+        # expiry(creation_date) -> caducidad que se guarda en expires_on
+        self.expiry = expiry
+        self.directory = directory
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.max_failures = max_failures
+        # Intentos de un bloque cuyos IDs chocan con los de otra petición
+        self.id_retries = id_retries
+        self.worker_name = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    # --- API usada por los endpoints ---
+
+    def submit(self, count: int, value: float, state: str, site_id: Optional[str] = None,
+               machine_id: Optional[str] = None, sheet: Optional[Dict] = None,
+               created_by: Optional[str] = None) -> Dict:
+        job_id = secrets.token_hex(8)
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'INSERT INTO generation_jobs (job_id, status, count, value, state, site_id, machine_id, '
+                'sheet, created_by, created_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
+                (job_id, PENDING, count, value, state, site_id, machine_id,
+                 json.dumps(sheet) if sheet else None, created_by, datetime.now())
+            )
+            db.commit()
+        finally:
+            cursor.close()
+            db.close()
+        # Los hilos de este worker no esperan al siguiente sondeo
+        self._wake.set()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(f'SELECT {JOB_COLUMNS} FROM generation_jobs WHERE job_id = %s', (job_id,))
+            row = cursor.fetchone()
+            return job_row_to_dict(row) if row else None
+        finally:
+            cursor.close()
+            db.close()
+
+    def list_jobs(self, limit: int = 50, status: Optional[str] = None) -> List[Dict]:
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            if status:
+                cursor.execute(
+                    f'SELECT {JOB_COLUMNS} FROM generation_jobs WHERE status = %s ORDER BY created_at DESC LIMIT %s',
+                    (status, limit)
+                )
+            else:
+                cursor.execute(f'SELECT {JOB_COLUMNS} FROM generation_jobs ORDER BY created_at DESC LIMIT %s', (limit,))
+            return [job_row_to_dict(row) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+            db.close()
+
+    def cancel(self, job_id: str) -> Optional[Dict]:
+        """
+        Pide la cancelación. Un trabajo pendiente se cancela en el acto; uno en
+        proceso, cuando su worker termine el bloque en curso.
+        """
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'UPDATE generation_jobs SET status = %s, cancel_requested = 1, finished_at = %s '
+                'WHERE job_id = %s AND status = %s',
+                (CANCELLED, datetime.now(), job_id, PENDING)
+            )
+            if cursor.rowcount == 0:
+                cursor.execute(
+                    'UPDATE generation_jobs SET cancel_requested = 1 WHERE job_id = %s AND status = %s',
+                    (job_id, RUNNING)
+                )
+            db.commit()
+        finally:
+            cursor.close()
+            db.close()
+        return self.get(job_id)
+
+    def sheet_path(self, job: Dict) -> Optional[str]:
+        if not job["sheet_ready"]:
+            return None
+        return os.path.join(self.directory, f"{job['job_id']}.{'pdf' if job['sheet']['format'] == 'pdf' else 'zip'}")
+
+    def iter_codes(self, job_id: str, chunk_size: int = 1000) -> Iterator[tuple]:
+        """(qrcode_id, value, state, creation_date, contenido) de los códigos del trabajo."""
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            last_id = ""
+            while True:
+                cursor.execute(
+                    'SELECT qrcode_id, value, state, creation_date, expires_on FROM qr_codes '
+                    'WHERE job_id = %s AND qrcode_id > %s ORDER BY qrcode_id LIMIT %s',
+                    (job_id, last_id, chunk_size)
+                )
+                rows = cursor.fetchall()
+                db.commit()
+                for qrcode_id, value, state, creation_date, expires_on in rows:
+                    yield qrcode_id, float(value), state, creation_date, self.content(qrcode_id, float(value), expires_on)
+                if len(rows) < chunk_size:
+                    break
+                last_id = rows[-1][0]
+        finally:
+            cursor.close()
+            db.close()
+
+    def iter_codes_csv(self, job_id: str, chunk_size: int = 1000) -> Iterator[bytes]:
+        """CSV de los códigos del trabajo con el contenido de su QR, por bloques."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(("qrcode_id", "value", "state", "creation_date", "qr_payload"))
+        for number, (qrcode_id, value, state, creation_date, content) in enumerate(self.iter_codes(job_id, chunk_size), 1):
+            writer.writerow((qrcode_id, f"{value:.2f}", state, creation_date.isoformat(), content))
+            if number % chunk_size == 0:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode("utf-8")
+
+    # --- Hilos de trabajo ---
+
+    def start(self):
+        if self._threads or self.workers <= 0:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._stop.clear()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"generation-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.info(f"Generación masiva: {self.workers} hilos en {self.worker_name}")
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout=30)
+        self._threads = []
+
+    def status(self) -> Dict:
+        return {
+            "worker": self.worker_name,
+            "threads": len(self._threads),
+            "chunk_size": self.chunk_size,
+            "stale_after_seconds": self.stale_after,
+        }
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except mysql.connector.Error as e:
+                logging.error(f"Error reclamando trabajos de generación: {e}")
+                job = None
+            if job is not None:
+                self._process(job)
+                continue
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def _claim(self) -> Optional[Dict]:
+        """Toma el trabajo pendiente más antiguo (o uno abandonado por un worker caído)."""
+        now = datetime.now()
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'SELECT job_id FROM generation_jobs '
+                'WHERE status = %s OR (status = %s AND heartbeat_at < %s) '
+                'ORDER BY created_at LIMIT 1 FOR UPDATE SKIP LOCKED',
+                (PENDING, RUNNING, now - timedelta(seconds=self.stale_after))
+            )
+            row = cursor.fetchone()
+            if row is None:
+                db.commit()
+                return None
+            cursor.execute(
+                'UPDATE generation_jobs SET status = %s, worker = %s, heartbeat_at = %s, '
+                'started_at = COALESCE(started_at, %s) WHERE job_id = %s',
+                (RUNNING, self.worker_name, now, now, row[0])
+            )
+            cursor.execute(f'SELECT {JOB_COLUMNS} FROM generation_jobs WHERE job_id = %s', (row[0],))
+            job = job_row_to_dict(cursor.fetchone())
+            db.commit()
+        finally:
+            cursor.close()
+            db.close()
+        logging.info(f"Trabajo de generación {job['job_id']} reclamado ({job['generated']}/{job['count']})")
+        return job
+
+    def _process(self, job: Dict):
+        job_id = job["job_id"]
+        try:
+            while job["generated"] < job["count"]:
+                if self._stop.is_set():
+                    self._release(job_id)
+                    return
+                job["generated"] = self._generate_chunk(job)
+            if job["sheet"]:
+                self._render_sheet(job)
+            self._finish(job_id, COMPLETED)
+            logging.info(f"Trabajo de generación {job_id} completado: {job['count']} códigos")
+        except JobLost as e:
+            logging.info(f"Trabajo de generación {job_id}: {e}")
+        except InterruptedError:
+            self._release(job_id)
+        except Exception as e:
+            logging.error(f"Error en el trabajo de generación {job_id}: {e}")
+            self._fail(job_id, str(e))
+
+    def _generate_chunk(self, job: Dict) -> int:
+        """Inserta el siguiente bloque y devuelve el total generado. Reintenta si un ID choca."""
+        for attempt in range(1, self.id_retries + 1):
+            try:
+                return self._insert_chunk(job)
+            except mysql.connector.IntegrityError as e:
+                # Un ID creado a la vez por otra petición: se repite el bloque
+                # con IDs nuevos. Cualquier otro error de integridad no se
+                # arregla repitiendo.
+                if e.errno != errorcode.ER_DUP_ENTRY or attempt == self.id_retries:
+                    raise
+                logging.warning(f"Trabajo de generación {job['job_id']}: ID repetido, se repite el bloque ({e})")
+
+    def _insert_chunk(self, job: Dict) -> int:
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'SELECT status, generated, cancel_requested, worker FROM generation_jobs '
+                'WHERE job_id = %s FOR UPDATE',
+                (job["job_id"],)
+            )
+            status, generated, cancel_requested, worker = cursor.fetchone()
+            if status != RUNNING or worker != self.worker_name:
+                db.rollback()
+                raise JobLost(f"lo procesa {worker} ({status})")
+            if cancel_requested:
+                db.rollback()
+                self._finish(job["job_id"], CANCELLED)
+                raise JobLost("cancelado")
+
+            size = min(self.chunk_size, job["count"] - generated)
+            qrcode_ids = self._unique_ids(cursor, size)
+            creation_date = date.today()
+            expires_on = self.expiry(creation_date)
+            cursor.executemany(
+                'INSERT INTO qr_codes (qrcode_id, value, state, creation_date, site_id, machine_id, job_id, expires_on) '
+                'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)',
+                [(qrcode_id, job["value"], job["state"], creation_date, job["site_id"], job["machine_id"], job["job_id"],
+                  expires_on)
+                 for qrcode_id in qrcode_ids]
+            )
+            last_seq = stamp_changes(cursor, qrcode_ids)
+            cursor.execute(
+                'UPDATE generation_jobs SET generated = generated + %s, heartbeat_at = %s WHERE job_id = %s',
+                (size, datetime.now(), job["job_id"])
+            )
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        finally:
+            cursor.close()
+            db.close()
+        # Como create_qr_data: un evento por código, tras el commit
+        first_seq = last_seq - size + 1
+        for offset, qrcode_id in enumerate(qrcode_ids):
+            broker.publish("created", {
+                "qrcode_id": qrcode_id,
+                "value": float(job["value"]),
+                "state": job["state"],
+                "creation_date": datetime.combine(creation_date, datetime.min.time()),
+                "used_date": None,
+                "change_seq": first_seq + offset,
+                "site_id": job["site_id"],
+                "machine_id": job["machine_id"]
+            }, first_seq + offset)
+        return generated + size
+
+    def _unique_ids(self, cursor, size: int) -> List[str]:
+        """IDs nuevos que no existen en qr_codes ni en qr_codes_archive."""
+        ids = set()
+        while len(ids) < size:
+            candidates = {self.new_id() for _ in range(size - len(ids))} - ids
+            placeholders = ", ".join(["%s"] * len(candidates))
+            cursor.execute(
+                f'SELECT qrcode_id FROM qr_codes WHERE qrcode_id IN ({placeholders}) '
+                f'UNION ALL SELECT qrcode_id FROM qr_codes_archive WHERE qrcode_id IN ({placeholders})',
+                (*candidates, *candidates)
+            )
+            ids |= candidates - {row[0] for row in cursor.fetchall()}
+        return sorted(ids)
+
+    def _render_sheet(self, job: Dict):
+        """Dibuja la hoja de todos los códigos del trabajo en el pool de procesos."""
+        options = job["sheet"]
+        layout = compute_layout(options["page_size"], options["dpi"], options["columns"], options["rows"], options["margin_mm"])
+        page_count = -(-job["count"] // layout.per_page)
+        self._update_pages(job["job_id"], page_count, 0)
+        extension = "pdf" if options["format"] == "pdf" else "zip"
+        path = os.path.join(self.directory, f"{job['job_id']}.{extension}")
+        partial = path + ".part"
+        pages = self._rendered_pages(job, layout, options["format"], page_count)
+        try:
+            with open(partial, "wb") as output:
+                if options["format"] == "pdf":
+                    for chunk in build_pdf(pages, page_count, layout):
+                        output.write(chunk)
+                else:
+                    # Los PNG ya están comprimidos: ZIP sin recomprimir
+                    with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as archive:
+                        for number, png in enumerate(pages, start=1):
+                            archive.writestr(f"{job['job_id']}_{number:04d}.png", png)
+            os.replace(partial, path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'UPDATE generation_jobs SET result_file = %s WHERE job_id = %s',
+                (os.path.basename(path), job["job_id"])
+            )
+            db.commit()
+        finally:
+            cursor.close()
+            db.close()
+
+    def _rendered_pages(self, job: Dict, layout, output: str, page_count: int) -> Iterator[bytes]:
+        """
+        Páginas dibujadas en orden. Como mucho dos por proceso del pool en
+        vuelo, para no tener todo el trabajo en memoria.
+        """
+        executor = get_executor()
+        window = 2 * sheet_workers()
+        in_flight = deque()
+        page: List[tuple] = []
+        done = 0
+        codes = ((qrcode_id, value, content) for qrcode_id, value, _, _, content in self.iter_codes(job["job_id"]))
+        for voucher in codes:
+            page.append(voucher)
+            if len(page) == layout.per_page:
+                in_flight.append(executor.submit(render_page, page, layout, output))
+                page = []
+            while len(in_flight) >= window:
+                yield in_flight.popleft().result()
+                done += 1
+                self._page_done(job["job_id"], page_count, done)
+        if page:
+            in_flight.append(executor.submit(render_page, page, layout, output))
+        while in_flight:
+            yield in_flight.popleft().result()
+            done += 1
+            self._page_done(job["job_id"], page_count, done)
+
+    def _page_done(self, job_id: str, page_count: int, done: int):
+        """Progreso de la hoja cada 20 páginas; comprueba la cancelación y la parada."""
+        if done % 20 and done != page_count:
+            return
+        if self._stop.is_set():
+            raise InterruptedError()
+        if self._update_pages(job_id, page_count, done):
+            self._finish(job_id, CANCELLED)
+            raise JobLost("cancelado")
+
+    def _update_pages(self, job_id: str, page_count: int, done: int) -> bool:
+        """Guarda el progreso de la hoja y devuelve si se ha pedido cancelar."""
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'UPDATE generation_jobs SET pages_total = %s, pages_done = %s, heartbeat_at = %s '
+                'WHERE job_id = %s AND worker = %s',
+                (page_count, done, datetime.now(), job_id, self.worker_name)
+            )
+            if cursor.rowcount == 0:
+                db.rollback()
+                raise JobLost("reclamado por otro worker")
+            cursor.execute('SELECT cancel_requested FROM generation_jobs WHERE job_id = %s', (job_id,))
+            cancel_requested = cursor.fetchone()[0]
+            db.commit()
+            return bool(cancel_requested)
+        finally:
+            cursor.close()
+            db.close()
+
+    def _finish(self, job_id: str, status: str, error: Optional[str] = None):
+        self._set_status(job_id, status, finished_at=datetime.now(), error=error)
+
+    def _release(self, job_id: str):
+        """Devuelve el trabajo a la cola al parar; otro worker (o este al reiniciar) lo continúa."""
+        try:
+            self._set_status(job_id, PENDING)
+            logging.info(f"Trabajo de generación {job_id} devuelto a la cola")
+        except mysql.connector.Error as e:
+            # Se reclamará cuando caduque su heartbeat
+            logging.error(f"No se pudo devolver el trabajo {job_id} a la cola: {e}")
+
+    def _fail(self, job_id: str, error: str):
+        """Un error cuenta como fallo; tras max_failures el trabajo queda en 'fallido'."""
+        try:
+            db = self.connect()
+            cursor = db.cursor()
+            try:
+                cursor.execute(
+                    'UPDATE generation_jobs SET failures = failures + 1, error = %s, worker = NULL, '
+                    'status = IF(failures >= %s, %s, %s), '
+                    'finished_at = IF(failures >= %s, %s, NULL) '
+                    'WHERE job_id = %s AND worker = %s',
+                    (error[:1000], self.max_failures, FAILED, PENDING, self.max_failures, datetime.now(),
+                     job_id, self.worker_name)
+                )
+                db.commit()
+            finally:
+                cursor.close()
+                db.close()
+        except mysql.connector.Error as e:
+            logging.error(f"No se pudo registrar el fallo del trabajo {job_id}: {e}")
+
+    def _set_status(self, job_id: str, status: str, finished_at: Optional[datetime] = None,
+                    error: Optional[str] = None):
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'UPDATE generation_jobs SET status = %s, worker = NULL, finished_at = %s, '
+                'error = COALESCE(%s, error) WHERE job_id = %s AND worker = %s',
+                (status, finished_at, error, job_id, self.worker_name)
+            )
+            db.commit()
+        finally:
+            cursor.close()
+            db.close()
@@ -0,0 +1,39 @@
+"""
+Configuración de gunicorn para ejecutar la API con varios workers uvicorn.
+
+    gunicorn -c gunicorn_conf.py qrcode_generator:app
+
+- ``WEB_CONCURRENCY``: número de workers (por defecto, uno por núcleo).
+- ``MAX_REQUESTS`` / ``MAX_REQUESTS_JITTER``: cada worker se recicla tras
+  ese número de peticiones (con un margen aleatorio para que no se reinicien
+  todos a la vez), lo que limita el crecimiento de memoria.
+- ``GRACEFUL_TIMEOUT``: segundos que un worker tiene para terminar sus
+  peticiones al recargar (``kill -HUP``) o parar.
+
+La app no se precarga en el maestro: cada worker crea su pool de base de
+datos, sus tareas de mantenimiento y su pool de hojas después del fork.
+"""
+
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = f"{os.getenv('API_HOST', '0.0.0.0')}:{os.getenv('API_PORT', '3000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "0")) or multiprocessing.cpu_count()
+worker_class = "uvicorn.workers.UvicornWorker"
+
+max_requests = int(os.getenv("MAX_REQUESTS", "10000"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "1000"))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+# Las hojas de vales y las exportaciones grandes pueden tardar
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+keepalive = 5
+
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+accesslog = "-"
+
+# database.py y voucher_sheet.py reparten sus recursos entre los workers
+os.environ["WEB_CONCURRENCY"] = str(workers)
@@ -0,0 +1,87 @@
+"""
+Almacenamiento compacto y deduplicado de las imágenes QR.
+
+Las imágenes que sube el navegador son PNG a todo color de un canvas. Un QR
+solo necesita blanco y negro, así que se recodifican como PNG de 1 bit
+(``compact_png``), mucho más pequeños. Cada imagen se guarda una sola vez en
+``qr_image_blobs`` indexada por su SHA-256; ``qr_codes.image_hash`` apunta a
+ella y ``qr_codes.qr_image`` queda a NULL.
+
+``QR_IMAGE_SQL`` resuelve la imagen de una fila de ``qr_codes`` tanto si está
+todavía en línea (filas sin migrar) como si está en ``qr_image_blobs``;
+``qr_image_sql`` hace lo mismo para otra tabla con las mismas columnas
+(``qr_codes_archive``).
+"""
+
+import hashlib
+import io
+from typing import Optional
+
+import qrcode
+from PIL import Image
+
+
+def qr_image_sql(table: str) -> str:
+    """Expresión SQL de la imagen de una fila de ``table``."""
+    return (
+        f"COALESCE(qr_image, (SELECT data FROM qr_image_blobs "
+        f"WHERE qr_image_blobs.image_hash = {table}.image_hash))"
+    )
+
+
+# Expresión SQL de la imagen de una fila de qr_codes
+QR_IMAGE_SQL = qr_image_sql("qr_codes")
+
+# Umbral de gris para pasar a blanco y negro
+BLACK_THRESHOLD = 128
+
+
+def compact_png(data: bytes) -> bytes:
+    """Recodifica una imagen QR como PNG de 1 bit."""
+    with Image.open(io.BytesIO(data)) as image:
+        if image.mode in ("RGBA", "LA", "P"):
+            # Las zonas transparentes del canvas se consideran fondo blanco
+            image = image.convert("RGBA")
+            background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+            image = Image.alpha_composite(background, image)
+        gray = image.convert("L")
+    bilevel = gray.point(lambda level: 255 if level >= BLACK_THRESHOLD else 0).convert("1")
+    buffer = io.BytesIO()
+    bilevel.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def image_hash(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+def store_image(cursor, data: bytes) -> bytes:
+    """
+    Guarda la imagen en qr_image_blobs si no existe ya y devuelve su hash.
+    Debe llamarse dentro de la transacción que actualiza qr_codes.
+    """
+    digest = image_hash(data)
+    cursor.execute(
+        'INSERT IGNORE INTO qr_image_blobs (image_hash, data) VALUES (%s, %s)',
+        (digest, data)
+    )
+    return digest
+
+
+def render_qr_png(content: str, box_size: int = 4) -> bytes:
+    """Genera el PNG de 1 bit de un QR (para filas cuya imagen se eliminó)."""
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_H, box_size=box_size, border=2)
+    qr.add_data(content)
+    qr.make(fit=True)
+    image = qr.make_image(fill_color="black", back_color="white").get_image().convert("1")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def try_compact_png(data: bytes) -> Optional[bytes]:
+    """Como compact_png, pero devuelve None si la imagen no se puede leer."""
+    try:
+        return compact_png(data)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,156 @@
+"""
+Registro de sedes (``sites``) y máquinas expendedoras (``machines``).
+
+Cada máquina pertenece a una sede. Un código QR puede quedar ligado a una
+máquina o a una sede (``qr_codes.machine_id`` / ``qr_codes.site_id``) y solo
+se canjea allí; el canje guarda la máquina en ``redeemed_machine_id``.
+
+Comprobar el ámbito de un código en cada canje necesita la sede de la
+máquina que canjea, así que cada worker guarda en memoria la tabla
+máquina -> sede y la recarga cada ``refresh_interval`` segundos (o antes, si
+aparece una máquina desconocida, como mucho una vez cada ``min_refresh_gap``).
+Las altas hechas en este worker se ven al momento.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set
+
+import mysql.connector
+
+
+class RegistryError(Exception):
+    """Error de alta en el registro."""
+
+
+class DuplicateEntry(RegistryError):
+    """La sede o la máquina ya existe."""
+
+
+class UnknownSite(RegistryError):
+    """La sede no está registrada."""
+
+
+class MachineRegistry:
+    """Sedes y máquinas registradas, con la tabla máquina -> sede en memoria."""
+
+    def __init__(self, connect: Callable, refresh_interval: float = 60, min_refresh_gap: float = 5):
+        self.connect = connect
+        self.refresh_interval = refresh_interval
+        self.min_refresh_gap = min_refresh_gap
+        self._machine_sites: Dict[str, str] = {}
+        self._sites: Set[str] = set()
+        self._loaded = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute('SELECT site_id FROM sites')
+            sites = {row[0] for row in cursor.fetchall()}
+            cursor.execute('SELECT machine_id, site_id FROM machines')
+            machine_sites = dict(cursor.fetchall())
+        finally:
+            cursor.close()
+            db.close()
+        with self._lock:
+            self._sites = sites
+            self._machine_sites = machine_sites
+            self._loaded = time.monotonic()
+
+    def _ensure_fresh(self, missing: bool):
+        age = time.monotonic() - self._loaded
+        if age > self.refresh_interval or (missing and age > self.min_refresh_gap):
+            try:
+                self.refresh()
+            except mysql.connector.Error as e:
+                # Se sigue con la tabla cargada la última vez
+                logging.error(f"Error recargando el registro de máquinas: {e}")
+
+    def site_of(self, machine_id: str) -> Optional[str]:
+        """Sede de la máquina, o None si no está registrada."""
+        self._ensure_fresh(machine_id not in self._machine_sites)
+        return self._machine_sites.get(machine_id)
+
+    def has_site(self, site_id: str) -> bool:
+        self._ensure_fresh(site_id not in self._sites)
+        return site_id in self._sites
+
+    def create_site(self, site_id: str, name: str) -> Dict:
+        created_at = datetime.now()
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'INSERT INTO sites (site_id, name, created_at) VALUES (%s, %s, %s)',
+                (site_id, name, created_at)
+            )
+            db.commit()
+        except mysql.connector.IntegrityError:
+            raise DuplicateEntry(f"La sede {site_id} ya existe")
+        finally:
+            cursor.close()
+            db.close()
+        with self._lock:
+            self._sites.add(site_id)
+        return {"site_id": site_id, "name": name, "created_at": created_at}
+
+    def create_machine(self, machine_id: str, site_id: str, name: Optional[str] = None) -> Dict:
+        if not self.has_site(site_id):
+            raise UnknownSite(f"La sede {site_id} no está registrada")
+        created_at = datetime.now()
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'INSERT INTO machines (machine_id, site_id, name, created_at) VALUES (%s, %s, %s, %s)',
+                (machine_id, site_id, name, created_at)
+            )
+            db.commit()
+        except mysql.connector.IntegrityError:
+            raise DuplicateEntry(f"La máquina {machine_id} ya existe")
+        finally:
+            cursor.close()
+            db.close()
+        with self._lock:
+            self._machine_sites[machine_id] = site_id
+        return {"machine_id": machine_id, "site_id": site_id, "name": name, "created_at": created_at}
+
+    def list_sites(self) -> List[Dict]:
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                'SELECT s.site_id, s.name, s.created_at, COUNT(m.machine_id) FROM sites s '
+                'LEFT JOIN machines m ON m.site_id = s.site_id '
+                'GROUP BY s.site_id, s.name, s.created_at ORDER BY s.site_id'
+            )
+            return [
+                {"site_id": row[0], "name": row[1], "created_at": row[2], "machines": row[3]}
+                for row in cursor.fetchall()
+            ]
+        finally:
+            cursor.close()
+            db.close()
+
+    def list_machines(self, site_id: Optional[str] = None) -> List[Dict]:
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            if site_id:
+                cursor.execute(
+                    'SELECT machine_id, site_id, name, created_at FROM machines WHERE site_id = %s ORDER BY machine_id',
+                    (site_id,)
+                )
+            else:
+                cursor.execute('SELECT machine_id, site_id, name, created_at FROM machines ORDER BY machine_id')
+            return [
+                {"machine_id": row[0], "site_id": row[1], "name": row[2], "created_at": row[3]}
+                for row in cursor.fetchall()
+            ]
+        finally:
+            cursor.close()
+            db.close()
@@ -0,0 +1,301 @@
+"""
+Tareas de mantenimiento en segundo plano sobre qr_codes.
+
+Cada tarea corre en su propio hilo y procesa la tabla en lotes pequeños, con
+una transacción corta por lote y una pausa entre lotes, para no mantener
+bloqueos largos mientras los lectores canjean códigos.
+
+Con varios workers cada proceso tiene sus propias tareas; antes de cada
+pasada se toma un bloqueo con nombre de MySQL (``GET_LOCK``) para que solo
+un proceso la ejecute.
+
+- ``ExpirySweeper``: pasa a 'expirado' los códigos pendientes de canje más
+  antiguos que ``max_age_days``.
+- ``Archiver``: mueve a ``qr_codes_archive`` los códigos en estado final
+  (usado, expirado, invalidado) más antiguos que ``after_days``, para que
+  ``qr_codes`` solo contenga el conjunto de trabajo de los lectores.
+"""
+
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from change_feed import stamp_changes
+from events import broker
+
+# Estados que todavía se pueden canjear y por tanto pueden expirar
+EXPIRABLE_STATES = ("valido", "enCirculacion")
+
+# Estados finales: ya no cambian y se pueden archivar
+ARCHIVABLE_STATES = ("usado", "expirado", "invalidado")
+
+# Columnas que se copian de qr_codes a qr_codes_archive
+ARCHIVE_COLUMNS = (
+    "qrcode_id, value, state, creation_date, used_date, qr_image, image_hash, change_seq, "
+    "site_id, machine_id, redeemed_machine_id, job_id, expires_on"
+)
+
+
+class PeriodicJob:
+    """Tarea que se ejecuta cada ``interval`` segundos en un hilo propio."""
+
+    name = "job"
+
+    def __init__(self, connect: Callable, interval: float, batch_size: int, pause: float):
+        self.connect = connect
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.last_run: Optional[Dict] = None
+        self.running = False
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return True
+
+    @property
+    def lock_name(self) -> str:
+        return f"qr_maintenance_{self.name}"
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+            self._thread.start()
+            logging.info(f"Tarea '{self.name}' iniciada (cada {self.interval:.0f} s)")
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def trigger(self):
+        """Adelanta la siguiente ejecución."""
+        self._wake.set()
+
+    def status(self) -> Dict:
+        return {
+            "job": self.name,
+            "enabled": self._thread is not None,
+            "running": self.running,
+            "interval_seconds": self.interval,
+            "last_run": self.last_run,
+        }
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.run_once()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def run_once(self) -> Dict:
+        """Ejecuta una pasada completa y guarda su resumen en ``last_run``."""
+        self.running = True
+        started = time.monotonic()
+        report = {"started_at": datetime.now(), "rows": 0, "batches": 0, "error": None}
+        lock_db = None
+        try:
+            lock_db = self._acquire_lock()
+            if lock_db is None:
+                report["skipped"] = "otro proceso está ejecutando la tarea"
+            else:
+                self.run(report)
+        except Exception as e:
+            logging.error(f"Error en la tarea '{self.name}': {e}")
+            report["error"] = str(e)
+        finally:
+            if lock_db is not None:
+                self._release_lock(lock_db)
+            report["finished_at"] = datetime.now()
+            report["duration_seconds"] = round(time.monotonic() - started, 3)
+            self.last_run = report
+            self.running = False
+        if report["rows"]:
+            logging.info(
+                f"Tarea '{self.name}': {report['rows']} filas en {report['batches']} lotes "
+                f"({report['duration_seconds']} s)"
+            )
+        return report
+
+    def run(self, report: Dict):
+        raise NotImplementedError
+
+    def _acquire_lock(self):
+        """
+        Toma el bloqueo con nombre de la tarea sin esperar. Devuelve la conexión
+        que lo mantiene, o None si lo tiene otro proceso.
+        """
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            cursor.execute('SELECT GET_LOCK(%s, 0)', (self.lock_name,))
+            acquired = cursor.fetchone()[0] == 1
+        finally:
+            cursor.close()
+        if not acquired:
+            db.close()
+            return None
+        return db
+
+    def _release_lock(self, db):
+        try:
+            cursor = db.cursor()
+            cursor.execute('SELECT RELEASE_LOCK(%s)', (self.lock_name,))
+            cursor.fetchone()
+            cursor.close()
+        finally:
+            db.close()
+
+    def _sleep_between_batches(self) -> bool:
+        """Pausa entre lotes; devuelve False si hay que parar."""
+        return not self._stop.wait(self.pause)
+
+    def _lock_batch(self, cursor, columns: str, states: tuple, cutoff: date) -> List[tuple]:
+        """
+        Bloquea y devuelve el siguiente lote de filas de qr_codes en ``states``
+        creadas antes de ``cutoff``, usando el índice (state, creation_date).
+        SKIP LOCKED: las filas que un lector está canjeando se dejan para la
+        siguiente pasada en lugar de esperar por ellas.
+        """
+        placeholders = ", ".join(["%s"] * len(states))
+        cursor.execute(
+            f'SELECT {columns} FROM qr_codes '
+            f'WHERE state IN ({placeholders}) AND creation_date < %s '
+            f'ORDER BY creation_date LIMIT %s FOR UPDATE SKIP LOCKED',
+            (*states, cutoff, self.batch_size)
+        )
+        return cursor.fetchall()
+
+
+class ExpirySweeper(PeriodicJob):
+    """Marca como 'expirado' los códigos pendientes más antiguos que max_age_days."""
+
+    name = "expiry"
+
+    def __init__(self, connect: Callable, max_age_days: int, interval: float = 3600,
+                 batch_size: int = 500, pause: float = 0.2):
+        super().__init__(connect, interval, batch_size, pause)
+        self.max_age_days = max_age_days
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_age_days > 0
+
+    def cutoff(self) -> date:
+        """Los códigos creados antes de esta fecha están caducados."""
+        return date.today() - timedelta(days=self.max_age_days)
+
+    def status(self) -> Dict:
+        status = super().status()
+        status["max_age_days"] = self.max_age_days
+        status["cutoff"] = self.cutoff() if self.enabled else None
+        return status
+
+    def run(self, report: Dict):
+        cutoff = self.cutoff()
+        report["cutoff"] = cutoff
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            while True:
+                rows = self._lock_batch(
+                    cursor, "qrcode_id, value, creation_date, site_id, machine_id", EXPIRABLE_STATES, cutoff
+                )
+                if not rows:
+                    db.commit()
+                    break
+                ids = [row[0] for row in rows]
+                id_placeholders = ", ".join(["%s"] * len(ids))
+                cursor.execute(
+                    f'UPDATE qr_codes SET state = "expirado" WHERE qrcode_id IN ({id_placeholders})',
+                    ids
+                )
+                last_seq = stamp_changes(cursor, ids)
+                db.commit()
+
+                self._publish(rows, last_seq)
+                report["rows"] += len(rows)
+                report["batches"] += 1
+                logging.debug(f"Expiración: lote {report['batches']}, {len(rows)} filas (total {report['rows']})")
+                if len(rows) < self.batch_size or not self._sleep_between_batches():
+                    break
+        finally:
+            cursor.close()
+            db.close()
+
+    def _publish(self, rows: List[tuple], last_seq: int):
+        first_seq = last_seq - len(rows) + 1
+        for offset, (qrcode_id, value, creation_date, site_id, machine_id) in enumerate(rows):
+            broker.publish("state", {
+                "qrcode_id": qrcode_id,
+                "value": float(value),
+                "state": "expirado",
+                "creation_date": creation_date,
+                "used_date": None,
+                "change_seq": first_seq + offset,
+                "site_id": site_id,
+                "machine_id": machine_id
+            }, first_seq + offset)
+
+
+class Archiver(PeriodicJob):
+    """Mueve a qr_codes_archive los códigos en estado final más antiguos que after_days."""
+
+    name = "archive"
+
+    def __init__(self, connect: Callable, after_days: int, interval: float = 3600,
+                 batch_size: int = 500, pause: float = 0.2):
+        super().__init__(connect, interval, batch_size, pause)
+        self.after_days = after_days
+
+    @property
+    def enabled(self) -> bool:
+        return self.after_days > 0
+
+    def cutoff(self) -> date:
+        """Los códigos finales creados antes de esta fecha se archivan."""
+        return date.today() - timedelta(days=self.after_days)
+
+    def status(self) -> Dict:
+        status = super().status()
+        status["after_days"] = self.after_days
+        status["cutoff"] = self.cutoff() if self.enabled else None
+        return status
+
+    def run(self, report: Dict):
+        cutoff = self.cutoff()
+        report["cutoff"] = cutoff
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            while True:
+                rows = self._lock_batch(cursor, "qrcode_id", ARCHIVABLE_STATES, cutoff)
+                if not rows:
+                    db.commit()
+                    break
+                ids = [row[0] for row in rows]
+                id_placeholders = ", ".join(["%s"] * len(ids))
+                # Copia y borrado en la misma transacción: la fila está siempre
+                # en una de las dos tablas y nunca en ambas.
+                cursor.execute(
+                    f'INSERT INTO qr_codes_archive ({ARCHIVE_COLUMNS}, archived_at) '
+                    f'SELECT {ARCHIVE_COLUMNS}, NOW() FROM qr_codes WHERE qrcode_id IN ({id_placeholders})',
+                    ids
+                )
+                cursor.execute(f'DELETE FROM qr_codes WHERE qrcode_id IN ({id_placeholders})', ids)
+                db.commit()
+
+                report["rows"] += len(rows)
+                report["batches"] += 1
+                logging.debug(f"Archivado: lote {report['batches']}, {len(rows)} filas (total {report['rows']})")
+                if len(rows) < self.batch_size or not self._sleep_between_batches():
+                    break
+        finally:
+            cursor.close()
+            db.close()
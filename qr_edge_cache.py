@@ -0,0 +1,181 @@
+"""
+Réplica local de códigos QR para los lectores (Raspberry Pi).
+
+La réplica permite canjear códigos aunque se caiga la red entre la máquina
+y la API:
+
+- ``codes``: copia de los códigos conocidos (id, valor, estado y ámbito:
+  sede y máquina donde se pueden canjear), sincronizada desde el servidor. Se mantiene también en un diccionario en memoria para
+  que la comprobación de cada lectura no toque el disco.
+- ``journal``: registro durable de los canjes hechos en la máquina. Cada
+  entrada se confirma en SQLite (WAL + synchronous=FULL) antes de dar el
+  producto, y queda pendiente hasta que el servidor la acepta.
+- ``meta``: estado de la sincronización (cursor del feed de cambios,
+  última sincronización).
+"""
+
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+# Fila de ``codes``: (qrcode_id, valor, estado, site_id, machine_id)
+CodeRow = Tuple[str, float, str, Optional[str], Optional[str]]
+
+# Estados de las entradas del journal
+PENDING = "pendiente"
+SYNCED = "sincronizado"
+CONFLICT = "conflicto"
+
+
+class EdgeCache:
+    """Réplica local de códigos QR con journal de canjes."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS codes (
+                qrcode_id TEXT PRIMARY KEY,
+                value REAL NOT NULL,
+                state TEXT NOT NULL,
+                site_id TEXT,
+                machine_id TEXT
+            );
+            CREATE TABLE IF NOT EXISTS journal (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                qrcode_id TEXT NOT NULL UNIQUE,
+                value REAL NOT NULL,
+                redeemed_at TEXT NOT NULL,
+                status TEXT NOT NULL,
+                detail TEXT
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """
+        )
+        # Réplicas creadas antes de que los códigos tuvieran ámbito
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(codes)")}
+        for column in ("site_id", "machine_id"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE codes ADD COLUMN {column} TEXT")
+        # Copia en memoria: qrcode_id -> (valor, estado)
+        self._codes: Dict[str, Tuple[float, str]] = {}
+        # Ámbito de los códigos ligados a una sede o máquina: qrcode_id -> (site_id, machine_id)
+        self._scopes: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        for qrcode_id, value, state, site_id, machine_id in self._conn.execute(
+            "SELECT qrcode_id, value, state, site_id, machine_id FROM codes"
+        ):
+            self._codes[qrcode_id] = (value, state)
+            if site_id or machine_id:
+                self._scopes[qrcode_id] = (site_id, machine_id)
+        # Códigos canjeados en esta máquina (pendientes o no)
+        self._redeemed = {
+            row[0] for row in self._conn.execute("SELECT qrcode_id FROM journal")
+        }
+
+    def __len__(self):
+        return len(self._codes)
+
+    def lookup(self, qrcode_id: str) -> Optional[Tuple[float, str]]:
+        """Devuelve (valor, estado) del código según la réplica, o None si no se conoce."""
+        if qrcode_id in self._redeemed:
+            return (0.0, "usado")
+        return self._codes.get(qrcode_id)
+
+    def scope(self, qrcode_id: str) -> Tuple[Optional[str], Optional[str]]:
+        """(site_id, machine_id) donde se puede canjear el código; (None, None) = en cualquiera."""
+        return self._scopes.get(qrcode_id, (None, None))
+
+    def apply_codes(self, rows: List[CodeRow]):
+        """Inserta o actualiza códigos recibidos del servidor."""
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO codes (qrcode_id, value, state, site_id, machine_id) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(qrcode_id) DO UPDATE SET value = excluded.value, state = excluded.state, "
+                    "site_id = excluded.site_id, machine_id = excluded.machine_id",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            for qrcode_id, value, state, site_id, machine_id in rows:
+                self._codes[qrcode_id] = (value, state)
+                if site_id or machine_id:
+                    self._scopes[qrcode_id] = (site_id, machine_id)
+                else:
+                    self._scopes.pop(qrcode_id, None)
+
+    def redeem(self, qrcode_id: str, value: float) -> bool:
+        """
+        Registra el canje de forma durable.
+        Devuelve False si el código ya fue canjeado en esta máquina.
+        """
+        with self._lock:
+            if qrcode_id in self._redeemed:
+                return False
+            try:
+                self._conn.execute(
+                    "INSERT INTO journal (qrcode_id, value, redeemed_at, status) VALUES (?, ?, ?, ?)",
+                    (qrcode_id, value, datetime.now().isoformat(), PENDING),
+                )
+            except sqlite3.IntegrityError:
+                return False
+            self._redeemed.add(qrcode_id)
+            return True
+
+    def pending(self) -> List[Tuple[int, str, float, str]]:
+        """Canjes que aún no se han confirmado con el servidor."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, qrcode_id, value, redeemed_at FROM journal WHERE status = ? ORDER BY id",
+                (PENDING,),
+            ).fetchall()
+
+    def mark_synced(self, entry_id: int):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE journal SET status = ? WHERE id = ?", (SYNCED, entry_id)
+            )
+
+    def mark_conflict(self, entry_id: int, detail: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE journal SET status = ?, detail = ? WHERE id = ?",
+                (CONFLICT, detail, entry_id),
+            )
+
+    def conflicts(self) -> List[Tuple[str, float, str, str]]:
+        """Canjes locales rechazados por el servidor (posibles dobles canjes)."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT qrcode_id, value, redeemed_at, detail FROM journal WHERE status = ? ORDER BY id",
+                (CONFLICT,),
+            ).fetchall()
+
+    def get_meta(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key: str, value: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,180 @@
+"""
+Contenido firmado de los códigos QR.
+
+Por defecto un QR contiene solo su ``qrcode_id`` y el lector tiene que
+preguntar al servidor qué vale. Con una clave de firma configurada, el QR
+lleva además el valor y la fecha de caducidad, firmados:
+
+    QR1H.<qrcode_id>.<valor en céntimos>.<caducidad AAAAMMDD o 0>.<firma>
+
+``QR1H`` firma con HMAC-SHA256 (truncado a 128 bits) y una clave compartida
+(``QR_SIGNING_KEY``); ``QR1E`` firma con Ed25519 (``QR_SIGNING_ED25519_KEY``),
+de modo que los lectores solo necesitan la clave pública y un lector
+comprometido no puede fabricar códigos. La firma va en base64url sin relleno.
+
+Un lector comprueba el formato, la firma y la caducidad sin red, y solo
+contacta con el servidor para registrar el canje. Los códigos con el
+``qrcode_id`` sin firmar siguen siendo válidos.
+
+Este módulo lo usan tanto la API como los lectores: no depende de nada más
+del proyecto, y Ed25519 requiere el paquete ``cryptography``.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import re
+from datetime import date, datetime
+from typing import NamedTuple, Optional
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+except ImportError:  # pragma: no cover - cryptography es opcional en los lectores
+    Ed25519PrivateKey = Ed25519PublicKey = InvalidSignature = None
+
+HMAC_PREFIX = "QR1H"
+ED25519_PREFIX = "QR1E"
+HMAC_SIGNATURE_BYTES = 16
+
+_PAYLOAD_RE = re.compile(r"^(QR1[HE])\.([A-Za-z0-9_-]{1,32})\.(\d{1,9})\.(\d{8}|0)\.([A-Za-z0-9_-]+)$")
+
+
+class InvalidPayload(ValueError):
+    """El contenido del QR está mal formado, la firma no es válida o ha caducado."""
+
+
+class Payload(NamedTuple):
+    qrcode_id: str
+    value: float
+    expires: Optional[date]
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _signed_part(prefix: str, qrcode_id: str, cents: int, expires: Optional[date]) -> str:
+    return f"{prefix}.{qrcode_id}.{cents}.{expires.strftime('%Y%m%d') if expires else '0'}"
+
+
+def is_signed_payload(text: str) -> bool:
+    return text.startswith((HMAC_PREFIX + ".", ED25519_PREFIX + "."))
+
+
+class PayloadSigner:
+    """Genera el contenido firmado de un QR."""
+
+    def __init__(self, hmac_key: Optional[bytes] = None, ed25519_key=None):
+        if not hmac_key and ed25519_key is None:
+            raise ValueError("Se necesita una clave HMAC o Ed25519")
+        self.hmac_key = hmac_key
+        self.ed25519_key = ed25519_key
+
+    def sign(self, qrcode_id: str, value: float, expires: Optional[date] = None) -> str:
+        cents = int(round(value * 100))
+        if self.ed25519_key is not None:
+            message = _signed_part(ED25519_PREFIX, qrcode_id, cents, expires)
+            signature = self.ed25519_key.sign(message.encode("ascii"))
+        else:
+            message = _signed_part(HMAC_PREFIX, qrcode_id, cents, expires)
+            signature = hmac.new(self.hmac_key, message.encode("ascii"), hashlib.sha256).digest()
+            signature = signature[:HMAC_SIGNATURE_BYTES]
+        return f"{message}.{_b64encode(signature)}"
+
+
+class PayloadVerifier:
+    """Comprueba el contenido firmado de un QR sin contactar con el servidor."""
+
+    def __init__(self, hmac_key: Optional[bytes] = None, ed25519_public_key=None):
+        self.hmac_key = hmac_key
+        self.ed25519_public_key = ed25519_public_key
+
+    def verify(self, text: str, today: Optional[date] = None) -> Payload:
+        match = _PAYLOAD_RE.match(text)
+        if not match:
+            raise InvalidPayload("formato no válido")
+        prefix, qrcode_id, cents, expires_text, signature_text = match.groups()
+        message = text[:text.rindex(".")].encode("ascii")
+        try:
+            signature = _b64decode(signature_text)
+        except ValueError:
+            raise InvalidPayload("firma mal codificada")
+
+        if prefix == HMAC_PREFIX:
+            if not self.hmac_key:
+                raise InvalidPayload("no hay clave HMAC configurada")
+            expected = hmac.new(self.hmac_key, message, hashlib.sha256).digest()[:HMAC_SIGNATURE_BYTES]
+            if not hmac.compare_digest(expected, signature):
+                raise InvalidPayload("firma no válida")
+        else:
+            if self.ed25519_public_key is None:
+                raise InvalidPayload("no hay clave pública Ed25519 configurada")
+            try:
+                self.ed25519_public_key.verify(signature, message)
+            except InvalidSignature:
+                raise InvalidPayload("firma no válida")
+
+        expires = None
+        if expires_text != "0":
+            try:
+                expires = datetime.strptime(expires_text, "%Y%m%d").date()
+            except ValueError:
+                raise InvalidPayload("fecha de caducidad no válida")
+            if expires < (today or date.today()):
+                raise InvalidPayload("código caducado")
+        return Payload(qrcode_id, int(cents) / 100, expires)
+
+
+def _load_ed25519_private_key(value: str):
+    """Clave privada Ed25519: semilla de 32 bytes en base64."""
+    if Ed25519PrivateKey is None:
+        raise RuntimeError("Ed25519 requiere el paquete cryptography")
+    return Ed25519PrivateKey.from_private_bytes(_b64decode(value.strip()))
+
+
+def _load_ed25519_public_key(value: str):
+    """Clave pública Ed25519: 32 bytes en base64."""
+    if Ed25519PublicKey is None:
+        raise RuntimeError("Ed25519 requiere el paquete cryptography")
+    return Ed25519PublicKey.from_public_bytes(_b64decode(value.strip()))
+
+
+def signer_from_env() -> Optional[PayloadSigner]:
+    """Firmador configurado con QR_SIGNING_ED25519_KEY o QR_SIGNING_KEY; None si no hay clave."""
+    ed25519_key = os.getenv("QR_SIGNING_ED25519_KEY")
+    hmac_key = os.getenv("QR_SIGNING_KEY")
+    if ed25519_key:
+        return PayloadSigner(ed25519_key=_load_ed25519_private_key(ed25519_key))
+    if hmac_key:
+        return PayloadSigner(hmac_key=hmac_key.encode("utf-8"))
+    return None
+
+
+def verifier_from_env() -> PayloadVerifier:
+    """Verificador de los lectores: QR_SIGNING_KEY y/o QR_VERIFY_ED25519_PUBLIC_KEY."""
+    public_key = os.getenv("QR_VERIFY_ED25519_PUBLIC_KEY")
+    hmac_key = os.getenv("QR_SIGNING_KEY")
+    return PayloadVerifier(
+        hmac_key=hmac_key.encode("utf-8") if hmac_key else None,
+        ed25519_public_key=_load_ed25519_public_key(public_key) if public_key else None
+    )
+
+
+if __name__ == "__main__":
+    # Genera un par de claves Ed25519 para QR_SIGNING_ED25519_KEY / QR_VERIFY_ED25519_PUBLIC_KEY
+    from cryptography.hazmat.primitives import serialization
+
+    private_key = Ed25519PrivateKey.generate()
+    raw = serialization.Encoding.Raw
+    print("QR_SIGNING_ED25519_KEY=" + _b64encode(private_key.private_bytes(
+        raw, serialization.PrivateFormat.Raw, serialization.NoEncryption()
+    )))
+    print("QR_VERIFY_ED25519_PUBLIC_KEY=" + _b64encode(private_key.public_key().public_bytes(
+        raw, serialization.PublicFormat.Raw
+    )))
@@ -1,24 +1,68 @@
 from datetime import datetime, timedelta, date
-from typing import List, Optional
-from fastapi import FastAPI, HTTPException, Depends, status
+from typing import List, Optional, Tuple
+import asyncio
+from fastapi import FastAPI, HTTPException, Depends, status, Request, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
-from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, StreamingResponse, Response, FileResponse
+from pydantic import BaseModel, Field, ValidationError
 import mysql.connector
 import random
 import string
 import logging
 import os
 import base64
+import zipfile
+import io
 from dotenv import load_dotenv
 from fastapi.security import OAuth2PasswordRequestForm
+from starlette.concurrency import run_in_threadpool
 from auth import (
     authenticate_user,
     create_access_token,
+    get_current_user,
     get_current_active_user,
+    get_current_user_from_ticket,
+    create_sse_ticket,
+    SSE_TICKET_EXPIRE_SECONDS,
     check_admin_role,
-    ACCESS_TOKEN_EXPIRE_MINUTES
+    optional_oauth2_scheme,
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    SECRET_KEY
+)
+from database import get_connection, get_read_connection, pool_size, replicas, worker_count
+from change_feed import stamp_changes, fetch_changes, change_row_to_dict
+from events import broker, format_sse, ChangeFeedRelay
+from serialization import (
+    QR_COLUMNS,
+    ARCHIVE_QR_COLUMNS,
+    SUMMARY_COLUMNS,
+    row_to_dict,
+    summary_row_to_dict,
+    validate_first,
+    FastJSONResponse
+)
+from image_store import QR_IMAGE_SQL, qr_image_sql, store_image, try_compact_png, render_qr_png
+from maintenance import ExpirySweeper, Archiver
+from qr_payload import signer_from_env
+from redemption_journal import RedemptionJournal, RedemptionFlusher
+from compression import CompressionMiddleware
+from diagnostics import ProfilingMiddleware, settings_store
+from static_assets import StaticAssets
+from device_auth import DeviceKey, DeviceKeyStore, DeviceAuthError, KEY_HEADER, MACHINE_HEADER
+from device_ingest import DeviceIngestServer, ping
+from device_replies import DeviceReplyStore
+from telemetry import TelemetryAggregator
+from export import EXPORT_FORMATS, iter_export_chunks
+from generation_jobs import GenerationWorkers, FINISHED_STATES
+from machine_registry import MachineRegistry, DuplicateEntry, UnknownSite
+from voucher_sheet import (
+    PAGE_SIZES_MM,
+    SHEET_FORMATS,
+    compute_layout,
+    render_page,
+    build_pdf,
+    get_executor,
+    shutdown_executor
 )
 from pydantic import validator
 
@@ -53,15 +97,134 @@ class QRCodeBase(BaseModel):
         return v
 
 class QRCodeCreate(QRCodeBase):
-    pass
+    site_id: Optional[str] = Field(None, max_length=32, description="Only redeemable at machines of this site")
+    machine_id: Optional[str] = Field(None, max_length=64, description="Only redeemable at this machine")
 
 class QRCode(QRCodeBase):
     qrcode_id: str
     used_date: Optional[datetime] = None
+    site_id: Optional[str] = None
+    machine_id: Optional[str] = None
+    redeemed_machine_id: Optional[str] = Field(None, description="Machine where the code was redeemed")
+    qr_payload: Optional[str] = Field(None, description="Content to encode in the QR (signed when a signing key is set)")
 
     class Config:
         from_attributes = True  # Updated for Pydantic 2.x
 
+class QRCodeChange(BaseModel):
+    qrcode_id: str
+    value: float
+    state: str
+    creation_date: datetime
+    used_date: Optional[datetime] = None
+    change_seq: int
+    site_id: Optional[str] = None
+    machine_id: Optional[str] = None
+    redeemed_machine_id: Optional[str] = None
+
+class QRCodeChangeFeed(BaseModel):
+    changes: List[QRCodeChange]
+    cursor: int = Field(..., description="Cursor to pass as 'since' in the next request")
+    has_more: bool = Field(..., description="True if more changes are pending after this batch")
+
+class QRCodeLookupRequest(BaseModel):
+    qrcode_ids: List[str] = Field(..., description="QR codes to look up")
+
+class QRCodeSummary(BaseModel):
+    qrcode_id: str
+    value: float
+    state: str
+    creation_date: datetime
+    used_date: Optional[datetime] = None
+    site_id: Optional[str] = None
+    machine_id: Optional[str] = None
+    redeemed_machine_id: Optional[str] = None
+    archived: bool = False
+
+class QRCodeLookupResult(BaseModel):
+    found: List[QRCodeSummary]
+    missing: List[str]
+
+class DeviceKeyCreate(BaseModel):
+    machine_id: str = Field(..., min_length=1, max_length=64, description="Machine the key is bound to")
+    description: Optional[str] = Field(None, max_length=255)
+
+class DeviceKeyIssued(BaseModel):
+    key_id: str
+    machine_id: str
+    api_key: str = Field(..., description="Full key; it is shown only once")
+
+class DeviceKeyInfo(BaseModel):
+    key_id: str
+    machine_id: str
+    description: Optional[str] = None
+    created_at: datetime
+    expires_at: Optional[datetime] = None
+    revoked_at: Optional[datetime] = None
+
+class SiteCreate(BaseModel):
+    site_id: str = Field(..., min_length=1, max_length=32)
+    name: str = Field(..., min_length=1, max_length=255)
+
+class MachineCreate(BaseModel):
+    machine_id: str = Field(..., min_length=1, max_length=64, description="Same id the reader sends in X-Machine-Id")
+    site_id: str = Field(..., min_length=1, max_length=32)
+    name: Optional[str] = Field(None, max_length=255)
+
+class TelemetryHeartbeat(BaseModel):
+    rssi: Optional[int] = Field(None, description="WiFi signal strength in dBm")
+    free_heap: Optional[int] = Field(None, ge=0, description="Free memory in bytes")
+    uptime_s: Optional[int] = Field(None, ge=0)
+    firmware: Optional[str] = Field(None, max_length=64)
+
+class TelemetryScan(BaseModel):
+    detect_ms: float = Field(..., ge=0, description="Time spent detecting the code")
+    ok: bool = True
+    error: Optional[str] = Field(None, max_length=64, description="Failure reason when ok is false")
+    age_s: float = Field(0, ge=0, description="Seconds between the scan and sending the batch")
+
+class TelemetryBatch(BaseModel):
+    heartbeat: Optional[TelemetryHeartbeat] = None
+    scans: List[TelemetryScan] = Field(default_factory=list, max_items=500)
+
+class DiagnosticsSettings(BaseModel):
+    profile_sample_rate: int = Field(0, ge=0, description="Profile 1 in N requests (0 = off)")
+    profile_slow_ms: float = Field(0, ge=0, description="Only keep profiles of requests slower than this (0 = keep all)")
+    slow_query_ms: float = Field(0, ge=0, description="Log queries slower than this (0 = off)")
+
+class SheetOptions(BaseModel):
+    format: str = Field("pdf", description="Output format: pdf or png")
+    page_size: str = Field("A4", description="Page size: A4 or Letter")
+    columns: int = Field(3, ge=1, le=10)
+    rows: int = Field(8, ge=1, le=20)
+    dpi: int = Field(200, ge=72, le=600)
+    margin_mm: float = Field(10, ge=0, le=50)
+
+    @validator('format')
+    def validate_format(cls, v):
+        if v not in SHEET_FORMATS:
+            raise ValueError(f"Formato no soportado. Use uno de: {', '.join(SHEET_FORMATS)}")
+        return v
+
+    @validator('page_size')
+    def validate_page_size(cls, v):
+        if v not in PAGE_SIZES_MM:
+            raise ValueError(f"Tamaño de página no soportado. Use uno de: {', '.join(PAGE_SIZES_MM)}")
+        return v
+
+class SheetRequest(SheetOptions):
+    qrcode_ids: Optional[List[str]] = Field(None, description="QR codes to print, in order")
+    state: Optional[str] = Field("valido", description="State of the QR codes to print when qrcode_ids is not given")
+    count: int = Field(100, ge=1, description="Number of QR codes to print when qrcode_ids is not given")
+
+class GenerationJobCreate(BaseModel):
+    count: int = Field(..., ge=1, description="Number of QR codes to generate")
+    value: float = Field(..., gt=0, description="Value of each QR code")
+    state: str = Field("valido", max_length=45, description="State of the new QR codes")
+    site_id: Optional[str] = Field(None, max_length=32, description="Only redeemable at machines of this site")
+    machine_id: Optional[str] = Field(None, max_length=64, description="Only redeemable at this machine")
+    sheet: Optional[SheetOptions] = Field(None, description="Also render a printable sheet of the generated codes")
+
 # FastAPI app
 app = FastAPI(
     title="QR Code Generator API",
@@ -78,8 +241,57 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Compresión gzip/brotli negociada por Accept-Encoding
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", "500"))
+)
+
+# Perfiles muestreados (el último middleware añadido es el más externo)
+app.add_middleware(
+    ProfilingMiddleware,
+    output_dir=os.getenv("DIAGNOSTICS_PROFILE_DIR", "profiles")
+)
+
+@app.on_event("shutdown")
+def stop_sheet_workers():
+    shutdown_executor()
+
+@app.on_event("startup")
+def start_maintenance_jobs():
+    for job in MAINTENANCE_JOBS.values():
+        if job.enabled:
+            job.start()
+
+@app.on_event("shutdown")
+def stop_maintenance_jobs():
+    for job in MAINTENANCE_JOBS.values():
+        job.stop()
+    if redemption_journal is not None:
+        # Aplicar lo pendiente antes de salir; si falla, se aplica al reiniciar
+        redemption_flusher.run_once()
+        redemption_journal.close()
+
+# Con varios workers los eventos SSE se leen del feed de cambios
+events_relay = ChangeFeedRelay(
+    broker,
+    get_connection,
+    interval=float(os.getenv("EVENTS_POLL_INTERVAL", "1")),
+    batch_size=int(os.getenv("QR_CHANGES_MAX_BATCH", "500"))
+)
+
+@app.on_event("startup")
+async def start_events_relay():
+    if worker_count() > 1 or os.getenv("EVENTS_FROM_FEED", "false").lower() == "true":
+        events_relay.start()
+
+@app.on_event("shutdown")
+async def stop_events_relay():
+    await events_relay.stop()
+
+# Ficheros estáticos precomprimidos, con huella y caché inmutable
+static_assets = StaticAssets("static")
+app.mount("/static", static_assets, name="static")
 
 # Ruta de autenticación
 @app.post("/token")
@@ -99,9 +311,9 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 # Serve index.html at root
 @app.get("/")
-async def read_root():
+async def read_root(request: Request):
     try:
-        return FileResponse("static/index.html")
+        return static_assets.response("index.html", request.headers, request.method)
     except Exception as e:
         logging.error(f"Error serving index.html: {e}")
         return JSONResponse(
@@ -111,9 +323,9 @@ async def read_root():
 
 # Serve login.html
 @app.get("/login.html")
-async def login_page():
+async def login_page(request: Request):
     try:
-        return FileResponse("static/login.html")
+        return static_assets.response("login.html", request.headers, request.method)
     except Exception as e:
         logging.error(f"Error serving login.html: {e}")
         return JSONResponse(
@@ -121,20 +333,19 @@ async def login_page():
             content={"detail": "Error loading the login page"}
         )
 
-# Database configuration
-DB_CONFIG = {
-    "host": os.getenv("DB_HOST", "localhost"),
-    "user": os.getenv("DB_USER", "root"),
-    "password": os.getenv("DB_PASSWORD", ""),
-    "database": os.getenv("DB_NAME", "waterDB")
-}
-
 # Database dependency
 def get_db():
     connection = None
     try:
-        connection = mysql.connector.connect(**DB_CONFIG)
+        connection = get_connection()
         yield connection
+    except mysql.connector.errors.PoolError as err:
+        logging.warning(f"Pool de base de datos agotado: {err}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Base de datos saturada, reintente en unos segundos",
+            headers={"Retry-After": "1"}
+        )
     except mysql.connector.Error as err:
         logging.error(f"Database connection error: {err}")
         raise HTTPException(
@@ -145,13 +356,165 @@ def get_db():
         if connection and connection.is_connected():
             connection.close()
 
+# Réplicas de lectura para listados, estadísticas y exportación
+@app.on_event("startup")
+def start_replica_checks():
+    replicas.start()
+
+@app.on_event("shutdown")
+def stop_replica_checks():
+    replicas.stop()
+
+# Caducidad automática de códigos pendientes (0 = desactivada)
+expiry_sweeper = ExpirySweeper(
+    get_connection,
+    max_age_days=int(os.getenv("EXPIRY_MAX_AGE_DAYS", "0")),
+    interval=float(os.getenv("EXPIRY_INTERVAL_SECONDS", "3600")),
+    batch_size=int(os.getenv("EXPIRY_BATCH_SIZE", "500")),
+    pause=float(os.getenv("EXPIRY_BATCH_PAUSE", "0.2"))
+)
+
+# Archivado de códigos en estado final (0 = desactivado)
+archiver = Archiver(
+    get_connection,
+    after_days=int(os.getenv("ARCHIVE_AFTER_DAYS", "0")),
+    interval=float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600")),
+    batch_size=int(os.getenv("ARCHIVE_BATCH_SIZE", "500")),
+    pause=float(os.getenv("ARCHIVE_BATCH_PAUSE", "0.2"))
+)
+
+# Journal de canjes con escritura diferida (desactivado si no hay ruta)
+redemption_journal = None
+redemption_flusher = None
+if os.getenv("REDEMPTION_JOURNAL_PATH"):
+    redemption_journal = RedemptionJournal(os.getenv("REDEMPTION_JOURNAL_PATH"))
+    redemption_flusher = RedemptionFlusher(
+        get_connection,
+        redemption_journal,
+        interval=float(os.getenv("REDEMPTION_FLUSH_INTERVAL", "0.2")),
+        batch_size=int(os.getenv("REDEMPTION_FLUSH_BATCH", "500")),
+        journal_name=os.getenv("REDEMPTION_JOURNAL_NAME") or None,
+        retention_days=int(os.getenv("REDEMPTION_JOURNAL_RETENTION_DAYS", "7"))
+    )
+
+MAINTENANCE_JOBS = {
+    job.name: job for job in (expiry_sweeper, archiver, redemption_flusher) if job is not None
+}
+
+# Claves de API de los lectores, validadas en memoria
+device_keys = DeviceKeyStore(
+    get_connection,
+    pepper=(os.getenv("DEVICE_KEY_PEPPER") or SECRET_KEY).encode("utf-8"),
+    refresh_interval=float(os.getenv("DEVICE_KEYS_REFRESH_INTERVAL", "30"))
+)
+
+@app.on_event("startup")
+def start_device_keys():
+    device_keys.start()
+
+@app.on_event("shutdown")
+def stop_device_keys():
+    device_keys.stop()
+
+async def get_device(
+    x_device_key: Optional[str] = Header(None, alias=KEY_HEADER),
+    x_machine_id: Optional[str] = Header(None, alias=MACHINE_HEADER)
+) -> DeviceKey:
+    """Reader authenticated with its API key (X-Device-Key + X-Machine-Id)."""
+    try:
+        return device_keys.authenticate(x_device_key, x_machine_id)
+    except DeviceAuthError as e:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=str(e),
+            headers={"WWW-Authenticate": "DeviceKey"}
+        )
+
+async def get_current_user_or_device(
+    x_device_key: Optional[str] = Header(None, alias=KEY_HEADER),
+    x_machine_id: Optional[str] = Header(None, alias=MACHINE_HEADER),
+    token: Optional[str] = Depends(optional_oauth2_scheme)
+) -> dict:
+    """A logged-in user, or a reader with its API key."""
+    if x_device_key:
+        device = await get_device(x_device_key, x_machine_id)
+        return {"username": f"device:{device.key_id}", "role": "device", "machine_id": device.machine_id}
+    if token is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="No se pudieron validar las credenciales",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return await get_current_active_user(await get_current_user(token))
+
+# Firma del contenido de los QR (None = el QR contiene solo el qrcode_id)
+payload_signer = signer_from_env()
+
+def payload_expiry(creation_date) -> Optional[date]:
+    """Expiry to store with a new code (NULL when automatic expiry is off)."""
+    if not expiry_sweeper.enabled:
+        return None
+    if isinstance(creation_date, datetime):
+        creation_date = creation_date.date()
+    return creation_date + timedelta(days=expiry_sweeper.max_age_days)
+
+def qr_content(qrcode_id: str, value: float, expires_on: Optional[date]) -> str:
+    """Text encoded in the QR: the signed payload, or the bare qrcode_id."""
+    if payload_signer is None:
+        return qrcode_id
+    # La caducidad guardada al crear el código: el contenido no cambia aunque
+    # cambie EXPIRY_MAX_AGE_DAYS y coincide con el de los QR ya impresos
+    return payload_signer.sign(qrcode_id, value, expires_on)
+
+def fetch_by_ids(cursor, columns: str, table: str, qrcode_ids: List[str], chunk_size: int = 1000) -> List[tuple]:
+    """Select rows of a table by qrcode_id in chunks of IN (...) queries."""
+    rows = []
+    for start in range(0, len(qrcode_ids), chunk_size):
+        chunk = qrcode_ids[start:start + chunk_size]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(f'SELECT {columns} FROM {table} WHERE qrcode_id IN ({placeholders})', chunk)
+        rows.extend(cursor.fetchall())
+    return rows
+
 def generate_qrcode_id(length: int = int(os.getenv("QR_SHORT_ID_LENGTH", "8"))) -> str:
     """Generate a unique QR code ID."""
     characters = string.ascii_letters + string.digits
     return ''.join(random.choice(characters) for _ in range(length))
 
+# Sedes y máquinas (ámbito de los códigos)
+machine_registry = MachineRegistry(
+    get_connection,
+    refresh_interval=float(os.getenv("MACHINE_REGISTRY_REFRESH", "60"))
+)
+
+def resolve_scope(site_id: Optional[str], machine_id: Optional[str]):
+    """Validate the site/machine a new code is bound to; a machine implies its site."""
+    if machine_id:
+        machine_site = machine_registry.site_of(machine_id)
+        if machine_site is None:
+            raise HTTPException(status_code=404, detail=f"Máquina no registrada: {machine_id}")
+        if site_id and site_id != machine_site:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"La máquina {machine_id} no pertenece a la sede {site_id}"
+            )
+        return machine_site, machine_id
+    if site_id and not machine_registry.has_site(site_id):
+        raise HTTPException(status_code=404, detail=f"Sede no registrada: {site_id}")
+    return site_id, None
+
+def scope_conditions(site_id: Optional[str], machine_id: Optional[str], redeemed_by: Optional[str]):
+    """WHERE conditions and params for the site/machine filters of list and stats."""
+    conditions = []
+    params = []
+    for column, value in (("site_id", site_id), ("machine_id", machine_id), ("redeemed_machine_id", redeemed_by)):
+        if value:
+            conditions.append(f'{column} = %s')
+            params.append(value)
+    return conditions, params
+
 @app.post("/api/qrdata", response_model=QRCode)
-async def create_qr_data(
+def create_qr_data(
     qr_data: QRCodeCreate,
     current_user: dict = Depends(check_admin_role)  # Solo administradores pueden crear QR
 ):
@@ -178,18 +541,24 @@ async def create_qr_data(
             detail="La fecha de creación no puede ser futura"
         )
 
+    site_id, machine_id = resolve_scope(qr_data.site_id, qr_data.machine_id)
+
     db = None
     cursor = None
     try:
         # Obtener conexión a la base de datos
-        db = mysql.connector.connect(**DB_CONFIG)
+        db = get_connection()
         cursor = db.cursor()
 
         # Generate unique qrcode_id
         while True:
             qrcode_id = generate_qrcode_id()
-            cursor.execute('SELECT 1 FROM qr_codes WHERE qrcode_id = %s', (qrcode_id,))
-            if cursor.fetchone() is None:
+            cursor.execute(
+                'SELECT 1 FROM qr_codes WHERE qrcode_id = %s '
+                'UNION ALL SELECT 1 FROM qr_codes_archive WHERE qrcode_id = %s',
+                (qrcode_id, qrcode_id)
+            )
+            if not cursor.fetchall():
                 break
 
         # Convert base64 image to binary if provided
@@ -207,16 +576,29 @@ async def create_qr_data(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="Error al decodificar la imagen QR"
                 )
+            # Store the compact 1-bit version, deduplicated by content hash
+            qr_image_binary = try_compact_png(qr_image_binary) or qr_image_binary
+
+        expires_on = payload_expiry(creation_date)
+        if payload_signer is not None:
+            # La imagen del navegador codifica un ID provisional: se genera la del contenido firmado
+            qr_image_binary = render_qr_png(qr_content(qrcode_id, qr_data.value, expires_on))
 
-        # Insert the QR code data with the image
-        query = 'INSERT INTO qr_codes (qrcode_id, value, state, creation_date, qr_image) VALUES (%s, %s, %s, %s, %s)'
-        values = (qrcode_id, qr_data.value, qr_data.state, qr_data.creation_date, qr_image_binary)
+        image_hash = store_image(cursor, qr_image_binary) if qr_image_binary else None
+
+        # Insert the QR code data referencing the stored image
+        query = (
+            'INSERT INTO qr_codes (qrcode_id, value, state, creation_date, image_hash, site_id, machine_id, expires_on) '
+            'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)'
+        )
+        values = (qrcode_id, qr_data.value, qr_data.state, qr_data.creation_date, image_hash, site_id, machine_id, expires_on)
         cursor.execute(query, values)
+        change_seq = stamp_changes(cursor, [qrcode_id])
         db.commit()
         logging.info(f"QR code created with ID: {qrcode_id}")
 
         # Fetch the created record
-        cursor.execute('SELECT * FROM qr_codes WHERE qrcode_id = %s', (qrcode_id,))
+        cursor.execute(f'SELECT {QR_COLUMNS} FROM qr_codes WHERE qrcode_id = %s', (qrcode_id,))
         result = cursor.fetchone()
         
         if not result:
@@ -225,19 +607,21 @@ async def create_qr_data(
                 detail="Error al recuperar el código QR creado"
             )
         
-        # Convert binary image back to base64 for response
-        qr_image_base64 = None
-        if result[5]:  # If qr_image is not None
-            qr_image_base64 = base64.b64encode(result[5]).decode('utf-8')
+        qr_code = row_to_dict(result)
+        qr_code["qr_payload"] = qr_content(qr_code["qrcode_id"], qr_code["value"], expires_on)
+        broker.publish("created", {
+            "qrcode_id": qr_code["qrcode_id"],
+            "value": qr_code["value"],
+            "state": qr_code["state"],
+            "creation_date": qr_code["creation_date"],
+            "used_date": qr_code["used_date"],
+            "change_seq": change_seq,
+            "site_id": qr_code["site_id"],
+            "machine_id": qr_code["machine_id"]
+        }, change_seq)
         
-        return QRCode(
-            qrcode_id=result[0],
-            value=float(result[1]),
-            state=result[2],
-            creation_date=result[3],
-            used_date=result[4],
-            qr_image=qr_image_base64
-        )
+        validate_first(QRCode, [qr_code])
+        return FastJSONResponse(qr_code)
     except mysql.connector.Error as err:
         logging.error(f"Database error: {err}")
         raise HTTPException(
@@ -256,39 +640,147 @@ async def create_qr_data(
         if db:
             db.close()
 
+def with_pending_redemptions(codes: List[dict]) -> List[dict]:
+    """Codes already redeemed in the journal but not yet flushed to MySQL show as used."""
+    if redemption_journal is None or not codes:
+        return codes
+    pending = redemption_journal.pending_redemptions([code["qrcode_id"] for code in codes])
+    for code in codes:
+        entry = pending.get(code["qrcode_id"])
+        if entry is not None and code["state"] == "valido":
+            redeemed_at, machine_id = entry
+            code.update(
+                state="usado",
+                value=0.0,
+                used_date=datetime.fromisoformat(redeemed_at),
+                redeemed_machine_id=machine_id
+            )
+    return codes
+
+@app.post("/api/qrdata/lookup", response_model=QRCodeLookupResult)
+def lookup_qr_data(
+    lookup: QRCodeLookupRequest,
+    current_user: dict = Depends(get_current_active_user)
+):
+    """Get the state of many QR codes at once (without images)."""
+    max_ids = int(os.getenv("QR_LOOKUP_MAX_IDS", "5000"))
+    qrcode_ids = list(dict.fromkeys(lookup.qrcode_ids))
+    if len(qrcode_ids) > max_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"No se pueden consultar más de {max_ids} códigos QR a la vez"
+        )
+
+    chunk_size = int(os.getenv("QR_LOOKUP_CHUNK_SIZE", "1000"))
+    db = None
+    cursor = None
+    try:
+        db = get_connection()
+        cursor = db.cursor()
+        found = {}
+        for row in fetch_by_ids(cursor, SUMMARY_COLUMNS, "qr_codes", qrcode_ids, chunk_size):
+            found[row[0]] = dict(summary_row_to_dict(row), archived=False)
+        # Los que no están en qr_codes pueden estar archivados
+        pending = [qrcode_id for qrcode_id in qrcode_ids if qrcode_id not in found]
+        for row in fetch_by_ids(cursor, SUMMARY_COLUMNS, "qr_codes_archive", pending, chunk_size):
+            found[row[0]] = dict(summary_row_to_dict(row), archived=True)
+    except mysql.connector.Error as err:
+        logging.error(f"Database error: {err}")
+        raise HTTPException(status_code=500, detail="Error en la base de datos")
+    finally:
+        if cursor:
+            cursor.close()
+        if db and db.is_connected():
+            db.close()
+
+    validate_first(QRCodeSummary, with_pending_redemptions(list(found.values())))
+    # En el orden de la petición
+    return FastJSONResponse({
+        "found": [found[qrcode_id] for qrcode_id in qrcode_ids if qrcode_id in found],
+        "missing": [qrcode_id for qrcode_id in qrcode_ids if qrcode_id not in found]
+    })
+
 @app.get("/api/qrdata/{qrcode_id}", response_model=QRCode)
-async def get_qr_data(
+def get_qr_data(
     qrcode_id: str,
-    current_user: dict = Depends(get_current_active_user)
+    current_user: dict = Depends(get_current_user_or_device)
 ):
     """Get QR code information by qrcode_id."""
     db = None
     cursor = None
     try:
         # Obtener conexión a la base de datos
-        db = mysql.connector.connect(**DB_CONFIG)
+        db = get_connection()
         cursor = db.cursor()
         
-        cursor.execute('SELECT * FROM qr_codes WHERE qrcode_id = %s', (qrcode_id,))
+        cursor.execute(f'SELECT {QR_COLUMNS}, expires_on FROM qr_codes WHERE qrcode_id = %s', (qrcode_id,))
         result = cursor.fetchone()
+        if not result:
+            # Los códigos en estado final pueden estar ya archivados
+            cursor.execute(
+                f'SELECT {ARCHIVE_QR_COLUMNS}, expires_on FROM qr_codes_archive WHERE qrcode_id = %s',
+                (qrcode_id,)
+            )
+            result = cursor.fetchone()
         
         if not result:
             raise HTTPException(status_code=404, detail="Código QR no encontrado")
         
-        # Convert binary image back to base64 for response
-        qr_image_base64 = None
-        if result[5]:  # If qr_image is not None
-            qr_image_base64 = base64.b64encode(result[5]).decode('utf-8')
-            
-        # Format the response with dollar sign
-        return {
-            "qrcode_id": result[0],
-            "value": f"${float(result[1]):.2f}",
-            "state": result[2],
-            "creation_date": result[3],
-            "used_date": result[4],
-            "qr_image": qr_image_base64
-        }
+        # Sin imagen guardada (generación masiva, compact_qr_images.py --drop)
+        # qr_image va a null: los lectores consultan aquí en cada lectura y no
+        # se dibuja ni se firma un PNG para ellos; está en /image
+        qr_code = row_to_dict(result)
+        qr_code["qr_payload"] = qr_content(qr_code["qrcode_id"], qr_code["value"], result[9])
+        with_pending_redemptions([qr_code])
+        validate_first(QRCode, [qr_code])
+        return FastJSONResponse(qr_code)
+    except mysql.connector.Error as err:
+        logging.error(f"Database error: {err}")
+        raise HTTPException(status_code=500, detail="Error en la base de datos")
+    finally:
+        if cursor:
+            cursor.close()
+        if db and db.is_connected():
+            db.close()
+
+@app.get("/api/qrdata/{qrcode_id}/image")
+def get_qr_image(
+    qrcode_id: str,
+    current_user: dict = Depends(get_current_active_user)
+):
+    """PNG image of a QR code, for lists that load images only for the visible rows."""
+    db = None
+    cursor = None
+    try:
+        db = get_connection()
+        cursor = db.cursor()
+        table = "qr_codes"
+        cursor.execute(f'SELECT value, expires_on, {QR_IMAGE_SQL} FROM qr_codes WHERE qrcode_id = %s', (qrcode_id,))
+        result = cursor.fetchone()
+        if not result:
+            table = "qr_codes_archive"
+            cursor.execute(
+                f'SELECT value, expires_on, {qr_image_sql(table)} FROM {table} WHERE qrcode_id = %s',
+                (qrcode_id,)
+            )
+            result = cursor.fetchone()
+        if not result:
+            raise HTTPException(status_code=404, detail="Código QR no encontrado")
+        value, expires_on, image = result
+        if image is None:
+            # Se dibuja una sola vez y se guarda: las siguientes peticiones la leen
+            image = render_qr_png(qr_content(qrcode_id, float(value), expires_on))
+            cursor.execute(
+                f'UPDATE {table} SET image_hash = %s WHERE qrcode_id = %s AND image_hash IS NULL AND qr_image IS NULL',
+                (store_image(cursor, image), qrcode_id)
+            )
+            db.commit()
+        # La imagen de un código no cambia
+        return Response(
+            content=bytes(image),
+            media_type="image/png",
+            headers={"Cache-Control": "private, max-age=86400"}
+        )
     except mysql.connector.Error as err:
         logging.error(f"Database error: {err}")
         raise HTTPException(status_code=500, detail="Error en la base de datos")
@@ -299,101 +791,813 @@ async def get_qr_data(
             db.close()
 
 @app.get("/api/qrcodes", response_model=List[QRCode])
-async def get_all_qrcodes(
+def get_all_qrcodes(
     current_user: dict = Depends(get_current_active_user),
     skip: int = 0,
-    limit: int = 100
+    limit: int = 100,
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    state: Optional[str] = Query(None, description="Only codes in this state"),
+    q: Optional[str] = Query(None, max_length=32, description="qrcode_id prefix"),
+    include_images: bool = True,
+    site_id: Optional[str] = Query(None, description="Only codes bound to this site"),
+    machine_id: Optional[str] = Query(None, description="Only codes bound to this machine"),
+    redeemed_by: Optional[str] = Query(None, description="Only codes redeemed at this machine"),
+    max_lag: Optional[float] = Query(None, ge=0, description="Seconds of replica lag accepted (0 = primary)")
 ):
-    """List all QR codes with pagination."""
-    logging.info(f"Obteniendo códigos QR con paginación: skip={skip}, limit={limit}")
+    """
+    List QR codes ordered by qrcode_id. Pages are chained with the
+    X-Next-Cursor response header; skip is only used without a cursor.
+    Served from a read replica when one is within max_lag.
+    """
+    limit = max(1, min(limit, int(os.getenv("QR_LIST_MAX_PAGE", "1000"))))
+    logging.info(
+        f"Obteniendo códigos QR: cursor={cursor}, skip={skip}, limit={limit}, state={state}, q={q}, "
+        f"site_id={site_id}, machine_id={machine_id}, redeemed_by={redeemed_by}"
+    )
     db = None
-    cursor = None
+    db_cursor = None
     try:
-        # Obtener conexión a la base de datos
-        db = mysql.connector.connect(**DB_CONFIG)
-        cursor = db.cursor()
-        
-        # Verificar si la tabla existe
-        cursor.execute("SHOW TABLES LIKE 'qr_codes'")
-        if not cursor.fetchone():
-            logging.error("La tabla 'qr_codes' no existe en la base de datos")
-            raise HTTPException(status_code=500, detail="La tabla 'qr_codes' no existe en la base de datos")
-        
-        # Obtener el total de registros
-        cursor.execute('SELECT COUNT(*) FROM qr_codes')
-        total_count = cursor.fetchone()[0]
-        logging.info(f"Total de códigos QR: {total_count}")
-        
-        # Obtener los registros con paginación
-        cursor.execute('SELECT * FROM qr_codes LIMIT %s OFFSET %s', (limit, skip))
-        results = cursor.fetchall()
-        logging.info(f"Obtenidos {len(results)} códigos QR")
-        
+        # Réplica de lectura si hay alguna al día; si no, el primario
+        db = get_read_connection(max_lag)
+        db_cursor = db.cursor()
+
+        # Paginación por clave (qrcode_id > cursor): cada página cuesta lo
+        # mismo aunque se esté al final de la lista. Con sede o máquina se usa
+        # el índice (site_id|machine_id, state, qrcode_id)
+        conditions, params = scope_conditions(site_id, machine_id, redeemed_by)
+        if state:
+            conditions.append('state = %s')
+            params.append(state)
+        if q:
+            escaped = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            conditions.append('qrcode_id LIKE %s')
+            params.append(escaped + '%')
+        if cursor:
+            conditions.append('qrcode_id > %s')
+            params.append(cursor)
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        columns = QR_COLUMNS if include_images else SUMMARY_COLUMNS
+        query = f'SELECT {columns} FROM qr_codes{where} ORDER BY qrcode_id LIMIT %s'
+        params.append(limit)
+        if not cursor and skip:
+            query += ' OFFSET %s'
+            params.append(skip)
+        db_cursor.execute(query, params)
+
+        to_dict = row_to_dict if include_images else summary_row_to_dict
         qr_codes = []
-        for row in results:
+        last_id = None
+        for row in db_cursor:
+            last_id = row[0]
             try:
-                # Convert binary image back to base64 for response
-                qr_image_base64 = None
-                if row[5]:  # If qr_image is not None
-                    qr_image_base64 = base64.b64encode(row[5]).decode('utf-8')
-                    
-                qr_codes.append(QRCode(
-                    qrcode_id=row[0],
-                    value=float(row[1]),
-                    state=row[2],
-                    creation_date=row[3],
-                    used_date=row[4],
-                    qr_image=qr_image_base64
-                ))
+                qr_codes.append(to_dict(row))
             except Exception as e:
-                logging.error(f"Error procesando fila {row}: {e}")
+                logging.error(f"Error procesando fila {row[0]}: {e}")
                 # Continuar con la siguiente fila
                 continue
-        
-        return qr_codes
+        logging.info(f"Obtenidos {len(qr_codes)} códigos QR")
+
+        # Se devuelve la respuesta ya codificada para no validar cada fila otra vez
+        validate_first(QRCode, qr_codes)
+        response = FastJSONResponse(qr_codes)
+        if last_id is not None and len(qr_codes) == limit:
+            response.headers["X-Next-Cursor"] = last_id
+        return response
     except mysql.connector.Error as err:
         logging.error(f"Error de base de datos: {err}")
         raise HTTPException(status_code=500, detail=f"Error de base de datos: {str(err)}")
     except Exception as e:
         logging.error(f"Error al obtener códigos QR: {e}")
         raise HTTPException(status_code=500, detail=f"Error al cargar los códigos QR: {str(e)}")
+    finally:
+        if db_cursor:
+            db_cursor.close()
+        if db and db.is_connected():
+            db.close()
+
+@app.get("/api/qrcodes/stats")
+def get_qrcode_stats(
+    current_user: dict = Depends(get_current_active_user),
+    site_id: Optional[str] = Query(None, description="Only codes bound to this site"),
+    machine_id: Optional[str] = Query(None, description="Only codes bound to this machine"),
+    redeemed_by: Optional[str] = Query(None, description="Only codes redeemed at this machine"),
+    max_lag: Optional[float] = Query(None, ge=0, description="Seconds of replica lag accepted (0 = primary)")
+):
+    """Number of QR codes per state in qr_codes (archived codes are not counted)."""
+    db = None
+    cursor = None
+    try:
+        db = get_read_connection(max_lag)
+        cursor = db.cursor()
+        # Se resuelve con el índice (state, ...) o (site_id|machine_id, state, ...) sin leer las filas
+        conditions, params = scope_conditions(site_id, machine_id, redeemed_by)
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        cursor.execute(f'SELECT state, COUNT(*) FROM qr_codes{where} GROUP BY state', params)
+        by_state = {state: count for state, count in cursor.fetchall()}
+        return {"total": sum(by_state.values()), "by_state": by_state}
+    except mysql.connector.Error as err:
+        logging.error(f"Error de base de datos: {err}")
+        raise HTTPException(status_code=500, detail="Error en la base de datos")
     finally:
         if cursor:
             cursor.close()
         if db and db.is_connected():
             db.close()
 
-@app.put("/api/qrdata/exchange/{qrcode_id}")
-async def exchange_qr(qrcode_id: str, db: mysql.connector.MySQLConnection = Depends(get_db)):
-    """Exchange a QR code."""
+@app.get("/api/qrcodes/changes", response_model=QRCodeChangeFeed)
+def get_qrcode_changes(
+    current_user: dict = Depends(get_current_user_or_device),
+    since: int = 0,
+    limit: int = 100
+):
+    """List QR codes created or modified after the given change cursor."""
+    limit = max(1, min(limit, int(os.getenv("QR_CHANGES_MAX_BATCH", "500"))))
+    db = None
+    cursor = None
+    try:
+        db = get_connection()
+        cursor = db.cursor()
+
+        rows, has_more = fetch_changes(cursor, since, limit)
+        changes = [change_row_to_dict(row) for row in rows]
+        validate_first(QRCodeChange, changes)
+        return FastJSONResponse({
+            "changes": changes,
+            "cursor": rows[-1][5] if rows else since,
+            "has_more": has_more
+        })
+    except mysql.connector.Error as err:
+        logging.error(f"Error de base de datos: {err}")
+        raise HTTPException(status_code=500, detail="Error en la base de datos")
+    finally:
+        if cursor:
+            cursor.close()
+        if db and db.is_connected():
+            db.close()
+
+@app.get("/api/qrcodes/export")
+async def export_qrcodes(
+    current_user: dict = Depends(get_current_active_user),
+    export_format: str = Query("csv", alias="format"),
+    state: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    site_id: Optional[str] = Query(None, description="Only codes bound to this site"),
+    machine_id: Optional[str] = Query(None, description="Only codes bound to this machine"),
+    redeemed_by: Optional[str] = Query(None, description="Only codes redeemed at this machine"),
+    max_lag: Optional[float] = Query(None, ge=0, description="Seconds of replica lag accepted (0 = primary)")
+):
+    """Stream every QR code (without images) as CSV or NDJSON, from a read replica when possible."""
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Formato no soportado. Use uno de: {', '.join(EXPORT_FORMATS)}"
+        )
+    logging.info(
+        f"Exportando códigos QR: format={export_format}, state={state}, date_from={date_from}, date_to={date_to}, "
+        f"site_id={site_id}, machine_id={machine_id}, redeemed_by={redeemed_by}"
+    )
+    chunks = iter_export_chunks(
+        lambda: get_read_connection(max_lag),
+        export_format,
+        state=state,
+        date_from=date_from,
+        date_to=date_to,
+        chunk_size=int(os.getenv("EXPORT_CHUNK_SIZE", "1000")),
+        site_id=site_id,
+        machine_id=machine_id,
+        redeemed_machine_id=redeemed_by
+    )
+    filename = f"qr_codes_{datetime.now():%Y%m%d-%H%M}.{export_format}"
+    return StreamingResponse(
+        chunks,
+        media_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+def select_sheet_vouchers(sheet: SheetRequest) -> List[tuple]:
+    """(qrcode_id, value, QR content) of the vouchers to print."""
+    db = None
+    cursor = None
+    try:
+        db = get_connection()
+        cursor = db.cursor()
+        if sheet.qrcode_ids:
+            rows = {row[0]: row for row in fetch_by_ids(cursor, "qrcode_id, value, expires_on", "qr_codes", sheet.qrcode_ids)}
+            missing = [qrcode_id for qrcode_id in sheet.qrcode_ids if qrcode_id not in rows]
+            if missing:
+                raise HTTPException(status_code=404, detail=f"Códigos QR no encontrados: {', '.join(missing[:20])}")
+            selected = [rows[qrcode_id] for qrcode_id in sheet.qrcode_ids]
+        else:
+            cursor.execute(
+                'SELECT qrcode_id, value, expires_on FROM qr_codes WHERE state = %s ORDER BY creation_date DESC LIMIT %s',
+                (sheet.state, sheet.count)
+            )
+            selected = cursor.fetchall()
+        return [
+            (qrcode_id, float(value), qr_content(qrcode_id, float(value), expires_on))
+            for qrcode_id, value, expires_on in selected
+        ]
+    except mysql.connector.Error as err:
+        logging.error(f"Database error: {err}")
+        raise HTTPException(status_code=500, detail="Error en la base de datos")
+    finally:
+        if cursor:
+            cursor.close()
+        if db and db.is_connected():
+            db.close()
+
+@app.post("/api/qrcodes/sheet")
+async def create_qr_sheet(
+    sheet: SheetRequest,
+    current_user: dict = Depends(check_admin_role)
+):
+    """Render a printable sheet (PDF or PNG pages) of QR vouchers."""
+    max_vouchers = int(os.getenv("SHEET_MAX_VOUCHERS", "5000"))
+    requested = len(sheet.qrcode_ids) if sheet.qrcode_ids else sheet.count
+    if requested > max_vouchers:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"No se pueden imprimir más de {max_vouchers} códigos QR por hoja"
+        )
+
+    # La consulta bloquea: se hace en el threadpool
+    vouchers = await run_in_threadpool(select_sheet_vouchers, sheet)
+    if not vouchers:
+        raise HTTPException(status_code=404, detail="No hay códigos QR para imprimir")
+
+    # Cada página se dibuja en un proceso del pool
+    layout = compute_layout(sheet.page_size, sheet.dpi, sheet.columns, sheet.rows, sheet.margin_mm)
+    pages = [
+        vouchers[start:start + layout.per_page]
+        for start in range(0, len(vouchers), layout.per_page)
+    ]
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    rendered = await asyncio.gather(*[
+        loop.run_in_executor(executor, render_page, page, layout, sheet.format)
+        for page in pages
+    ])
+    logging.info(f"Hoja de {len(vouchers)} códigos QR generada: {len(rendered)} páginas ({sheet.format})")
+
+    filename = f"qr_sheet_{datetime.now():%Y%m%d-%H%M}"
+    if sheet.format == "pdf":
+        return StreamingResponse(
+            build_pdf(rendered, len(rendered), layout),
+            media_type="application/pdf",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.pdf"'}
+        )
+    if len(rendered) == 1:
+        return Response(
+            rendered[0],
+            media_type="image/png",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.png"'}
+        )
+    # Varias páginas PNG: se entregan en un ZIP (sin recomprimir)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for number, png in enumerate(rendered, start=1):
+            archive.writestr(f"{filename}_{number:03d}.png", png)
+    return Response(
+        buffer.getvalue(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}.zip"'}
+    )
+
+# Generación masiva en segundo plano (cualquier worker procesa cualquier trabajo)
+generation_workers = GenerationWorkers(
+    get_connection,
+    new_id=generate_qrcode_id,
+    content=qr_content,
+    expiry=payload_expiry,
+    directory=os.getenv("GENERATION_JOBS_DIR", "jobs"),
+    workers=int(os.getenv("GENERATION_WORKERS", "1")),
+    chunk_size=int(os.getenv("GENERATION_CHUNK_SIZE", "1000")),
+    poll_interval=float(os.getenv("GENERATION_POLL_INTERVAL", "2")),
+    stale_after=float(os.getenv("GENERATION_STALE_AFTER", "120")),
+    max_failures=int(os.getenv("GENERATION_MAX_FAILURES", "3"))
+)
+
+@app.on_event("startup")
+def start_generation_workers():
+    generation_workers.start()
+
+@app.on_event("shutdown")
+def stop_generation_workers():
+    # Terminan el bloque en curso y devuelven sus trabajos a la cola
+    generation_workers.stop()
+
+def get_generation_job(job_id: str) -> dict:
+    job = generation_workers.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo de generación no encontrado")
+    return job
+
+@app.post("/api/jobs", status_code=status.HTTP_202_ACCEPTED)
+def create_generation_job(request: GenerationJobCreate, current_user: dict = Depends(check_admin_role)):
+    """
+    Queue the generation of many QR codes. Poll GET /api/jobs/{job_id} for
+    progress, then download the codes (and the sheet, if requested).
+    """
+    max_count = int(os.getenv("GENERATION_MAX_COUNT", "1000000"))
+    if request.count > max_count:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"No se pueden generar más de {max_count} códigos QR por trabajo"
+        )
+    site_id, machine_id = resolve_scope(request.site_id, request.machine_id)
+    try:
+        job = generation_workers.submit(
+            request.count,
+            request.value,
+            request.state,
+            site_id=site_id,
+            machine_id=machine_id,
+            sheet=request.sheet.dict() if request.sheet else None,
+            created_by=current_user.get("username")
+        )
+    except mysql.connector.Error as err:
+        logging.error(f"Error de base de datos: {err}")
+        raise HTTPException(status_code=500, detail="Error en la base de datos")
+    logging.info(f"Trabajo de generación {job['job_id']} creado: {request.count} códigos de {request.value}")
+    return FastJSONResponse(job, status_code=status.HTTP_202_ACCEPTED)
+
+@app.get("/api/jobs")
+def list_generation_jobs(
+    status_filter: Optional[str] = Query(None, alias="status"),
+    limit: int = Query(50, ge=1, le=500),
+    current_user: dict = Depends(check_admin_role)
+):
+    """Most recent generation jobs."""
+    return FastJSONResponse(generation_workers.list_jobs(limit, status_filter))
+
+@app.get("/api/jobs/{job_id}")
+def get_generation_job_status(job_id: str, current_user: dict = Depends(check_admin_role)):
+    """Status and progress of a generation job."""
+    return FastJSONResponse(get_generation_job(job_id))
+
+@app.post("/api/jobs/{job_id}/cancel")
+def cancel_generation_job(job_id: str, current_user: dict = Depends(check_admin_role)):
+    """
+    Cancel a generation job. A running job stops after its current chunk;
+    the codes already generated are kept.
+    """
+    job = get_generation_job(job_id)
+    if job["status"] in FINISHED_STATES:
+        raise HTTPException(status_code=409, detail=f"El trabajo ya ha terminado ({job['status']})")
+    job = generation_workers.cancel(job_id)
+    logging.info(f"Cancelación pedida para el trabajo de generación {job_id}")
+    return FastJSONResponse(job)
+
+@app.get("/api/jobs/{job_id}/codes")
+def download_generation_job_codes(job_id: str, current_user: dict = Depends(check_admin_role)):
+    """CSV of the codes generated by a job so far, with the content of each QR."""
+    get_generation_job(job_id)
+    return StreamingResponse(
+        generation_workers.iter_codes_csv(job_id),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="qr_job_{job_id}.csv"'}
+    )
+
+@app.get("/api/jobs/{job_id}/sheet")
+def download_generation_job_sheet(job_id: str, current_user: dict = Depends(check_admin_role)):
+    """Printable sheet rendered by a completed job (PDF, or a ZIP of PNG pages)."""
+    job = get_generation_job(job_id)
+    path = generation_workers.sheet_path(job)
+    if path is None:
+        raise HTTPException(status_code=404, detail="El trabajo no tiene hoja o todavía no está lista")
+    if not os.path.exists(path):
+        # El trabajo se procesó en otro host sin el directorio compartido
+        raise HTTPException(status_code=404, detail="La hoja no está en este servidor")
+    media_type = "application/pdf" if path.endswith(".pdf") else "application/zip"
+    return FileResponse(path, media_type=media_type, filename=os.path.basename(path))
+
+def missed_events(since: int, limit: int) -> Tuple[List[str], int, bool]:
+    """
+    A batch of the changes after ``since``, already formatted as SSE, with
+    the cursor of the last one and whether more are pending.
+    """
+    db = None
+    cursor = None
+    try:
+        db = get_connection()
+        cursor = db.cursor()
+        rows, has_more = fetch_changes(cursor, since, limit)
+        messages = [format_sse("change", change_row_to_dict(row), row[5]) for row in rows]
+        return messages, rows[-1][5] if rows else since, has_more
+    finally:
+        if cursor:
+            cursor.close()
+        if db and db.is_connected():
+            db.close()
+
+@app.post("/api/events/ticket")
+async def create_events_ticket(current_user: dict = Depends(get_current_active_user)):
+    """Short-lived ticket to open /api/events (EventSource cannot send the Authorization header)."""
+    return {"ticket": create_sse_ticket(current_user["username"]), "expires_in": SSE_TICKET_EXPIRE_SECONDS}
+
+@app.get("/api/events")
+async def stream_events(
+    request: Request,
+    current_user: dict = Depends(get_current_user_from_ticket),
+    last_event_id: Optional[str] = Header(None),
+    since: Optional[int] = Query(None, description="Last event id seen, for a new EventSource after a ticket expired")
+):
+    """Stream QR code creations, redemptions and state changes as Server-Sent Events."""
+    queue = broker.subscribe()
+    keepalive = float(os.getenv("EVENTS_KEEPALIVE_SECONDS", "15"))
+    batch = int(os.getenv("QR_CHANGES_MAX_BATCH", "500"))
+    max_replay = int(os.getenv("EVENTS_MAX_REPLAY", "5000"))
+
+    # Cambios perdidos desde el último evento recibido por el cliente
+    if last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+
+    async def event_stream():
+        try:
+            yield "retry: 3000\n\n"
+            cursor = since
+            replayed = 0
+            while cursor is not None:
+                if replayed >= max_replay:
+                    # Demasiados cambios perdidos: el cliente recarga la lista
+                    # en vez de recibirlos uno a uno
+                    yield format_sse("reset", {"cursor": cursor})
+                    break
+                try:
+                    messages, cursor, has_more = await run_in_threadpool(
+                        missed_events, cursor, min(batch, max_replay - replayed)
+                    )
+                except mysql.connector.Error as err:
+                    logging.error(f"Error recuperando eventos perdidos: {err}")
+                    yield format_sse("reset", {"cursor": cursor})
+                    break
+                for message in messages:
+                    yield message
+                replayed += len(messages)
+                if not has_more:
+                    break
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    break
+                yield message
+        finally:
+            broker.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def get_maintenance_job(job_name: str):
+    job = MAINTENANCE_JOBS.get(job_name)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Tarea de mantenimiento no encontrada")
+    return job
+
+@app.get("/api/maintenance/{job_name}")
+async def get_maintenance_status(job_name: str, current_user: dict = Depends(check_admin_role)):
+    """Configuration and last run report of a maintenance job (expiry, archive)."""
+    return get_maintenance_job(job_name).status()
+
+@app.post("/api/maintenance/{job_name}/run")
+async def run_maintenance_job(job_name: str, current_user: dict = Depends(check_admin_role)):
+    """Start a pass of a maintenance job now."""
+    job = get_maintenance_job(job_name)
+    if not job.enabled:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"La tarea '{job_name}' está desactivada"
+        )
+    job.trigger()
+    return {"status": "scheduled"}
+
+@app.get("/api/diagnostics", response_model=DiagnosticsSettings)
+async def get_diagnostics(current_user: dict = Depends(check_admin_role)):
+    """Current request profiling and slow query log settings."""
+    return settings_store.get()
+
+@app.put("/api/diagnostics", response_model=DiagnosticsSettings)
+async def update_diagnostics(settings: DiagnosticsSettings, current_user: dict = Depends(check_admin_role)):
+    """Change profiling and slow query settings; every worker picks them up within a second."""
+    try:
+        return settings_store.update(settings.dict())
+    except OSError as e:
+        logging.error(f"No se pudo guardar la configuración de diagnóstico: {e}")
+        raise HTTPException(status_code=500, detail="No se pudo guardar la configuración de diagnóstico")
+
+@app.get("/api/database/replicas")
+async def get_replica_status(current_user: dict = Depends(check_admin_role)):
+    """Read replicas with their last measured lag, as seen by this worker."""
+    return {"max_lag_seconds": replicas.max_lag, "replicas": replicas.status()}
+
+@app.post("/api/sites")
+def create_site(request: SiteCreate, current_user: dict = Depends(check_admin_role)):
+    """Register a site (a location with one or more vending machines)."""
+    try:
+        site = machine_registry.create_site(request.site_id, request.name)
+    except DuplicateEntry as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except mysql.connector.Error as err:
+        logging.error(f"Error de base de datos: {err}")
+        raise HTTPException(status_code=500, detail="Error en la base de datos")
+    logging.info(f"Sede {request.site_id} registrada")
+    return site
+
+@app.get("/api/sites")
+def list_sites(current_user: dict = Depends(check_admin_role)):
+    """Registered sites with their number of machines."""
+    return machine_registry.list_sites()
+
+@app.post("/api/machines")
+def create_machine(request: MachineCreate, current_user: dict = Depends(check_admin_role)):
+    """Register a vending machine at a site."""
+    try:
+        machine = machine_registry.create_machine(request.machine_id, request.site_id, request.name)
+    except UnknownSite as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except DuplicateEntry as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except mysql.connector.Error as err:
+        logging.error(f"Error de base de datos: {err}")
+        raise HTTPException(status_code=500, detail="Error en la base de datos")
+    logging.info(f"Máquina {request.machine_id} registrada en la sede {request.site_id}")
+    return machine
+
+@app.get("/api/machines")
+def list_machines(site_id: Optional[str] = None, current_user: dict = Depends(check_admin_role)):
+    """Registered machines, optionally only those of one site."""
+    return machine_registry.list_machines(site_id)
+
+@app.post("/api/devices/keys", response_model=DeviceKeyIssued)
+def create_device_key(request: DeviceKeyCreate, current_user: dict = Depends(check_admin_role)):
+    """Issue an API key for a machine. The full key is returned only in this response."""
+    key, api_key = device_keys.create(request.machine_id, request.description)
+    logging.info(f"Clave de dispositivo {key.key_id} creada para la máquina {key.machine_id}")
+    return {"key_id": key.key_id, "machine_id": key.machine_id, "api_key": api_key}
+
+@app.get("/api/devices/keys", response_model=List[DeviceKeyInfo])
+def list_device_keys(machine_id: Optional[str] = None, current_user: dict = Depends(check_admin_role)):
+    """Registered device keys (without secrets)."""
+    return device_keys.list_keys(machine_id)
+
+@app.post("/api/devices/keys/{key_id}/rotate", response_model=DeviceKeyIssued)
+def rotate_device_key(
+    key_id: str,
+    grace_hours: float = Query(float(os.getenv("DEVICE_KEY_ROTATION_GRACE_HOURS", "24")), ge=0),
+    current_user: dict = Depends(check_admin_role)
+):
+    """Issue a new key for the same machine; the old one keeps working for grace_hours."""
+    issued = device_keys.rotate(key_id, timedelta(hours=grace_hours))
+    if issued is None:
+        raise HTTPException(status_code=404, detail="Clave de dispositivo no encontrada")
+    key, api_key = issued
+    logging.info(f"Clave de dispositivo {key_id} rotada: nueva clave {key.key_id}")
+    return {"key_id": key.key_id, "machine_id": key.machine_id, "api_key": api_key}
+
+@app.delete("/api/devices/keys/{key_id}")
+def revoke_device_key(key_id: str, current_user: dict = Depends(check_admin_role)):
+    """Revoke a device key immediately."""
+    if not device_keys.revoke(key_id):
+        raise HTTPException(status_code=404, detail="Clave de dispositivo no encontrada")
+    logging.info(f"Clave de dispositivo {key_id} revocada")
+    return {"status": "revoked"}
+
+def raise_already_redeemed():
+    # 409 y no 200: un lector que da el producto con cada 200 no lo da dos veces
+    raise HTTPException(status_code=409, detail="El código ya fue canjeado por esta máquina")
+
+def redeem_code(db, qrcode_id: str, machine_id: Optional[str] = None) -> dict:
+    """
+    Redeem a QR code at a machine. Raises HTTPException (400, 403, 404) when
+    it cannot be exchanged, and 409 when this same machine already redeemed
+    it (a retry whose first response was lost). Shared by the HTTP endpoint
+    and the device ingest channel; it blocks on MySQL and the journal, so it
+    runs in the threadpool.
+    """
     cursor = db.cursor()
     try:
-        # Check QR code status and value
-        cursor.execute('SELECT state, value FROM qr_codes WHERE qrcode_id = %s', (qrcode_id,))
+        # Check QR code status, value and scope
+        cursor.execute(
+            'SELECT state, value, creation_date, site_id, machine_id, redeemed_machine_id '
+            'FROM qr_codes WHERE qrcode_id = %s',
+            (qrcode_id,)
+        )
         result = cursor.fetchone()
         
         if not result:
+            cursor.execute('SELECT redeemed_machine_id FROM qr_codes_archive WHERE qrcode_id = %s', (qrcode_id,))
+            archived = cursor.fetchone()
+            if archived:
+                # Archivado: ya está en un estado final
+                if machine_id and archived[0] == machine_id:
+                    raise_already_redeemed()
+                raise HTTPException(status_code=400, detail="QR code cannot be exchanged")
             raise HTTPException(status_code=404, detail="Código QR no encontrado")
             
-        state, value = result
+        state, value, creation_date, code_site, code_machine, redeemed_by = result
+        if state == 'usado' and machine_id and redeemed_by == machine_id:
+            raise_already_redeemed()
+        if code_machine and code_machine != machine_id:
+            raise HTTPException(status_code=403, detail="El código no es válido en esta máquina")
+        if code_site and not code_machine and machine_registry.site_of(machine_id) != code_site:
+            raise HTTPException(status_code=403, detail="El código no es válido en esta sede")
         min_value = float(os.getenv("QR_MIN_VALUE", "0.05"))
+        if expiry_sweeper.enabled and creation_date < expiry_sweeper.cutoff():
+            # Caducado aunque el barrido todavía no lo haya marcado
+            raise HTTPException(status_code=400, detail="QR code cannot be exchanged")
+        if state == 'valido' and value > min_value and redemption_journal is not None:
+            # Se confirma al lector en cuanto el canje está en el journal;
+            # RedemptionFlusher lo aplica a MySQL en el siguiente lote
+            accepted = redemption_journal.append(qrcode_id, float(value), machine_id).result()
+            if not accepted:
+                if machine_id and redemption_journal.redeemed_by(qrcode_id) == machine_id:
+                    # Todavía en el journal, sin aplicar a MySQL
+                    raise_already_redeemed()
+                raise HTTPException(status_code=400, detail="QR code cannot be exchanged")
+            return {"status": "success", "message": "QR code exchanged successfully"}
         if state == 'valido' and value > min_value:
-            # Update QR code
-            update_query = 'UPDATE qr_codes SET state = "usado", value = 0, used_date = %s WHERE qrcode_id = %s'
+            # Update QR code (only if it is still valid)
+            update_query = (
+                'UPDATE qr_codes SET state = "usado", value = 0, used_date = %s, redeemed_machine_id = %s '
+                'WHERE qrcode_id = %s AND state = "valido"'
+            )
             used_date = datetime.now()
-            cursor.execute(update_query, (used_date, qrcode_id))
+            cursor.execute(update_query, (used_date, machine_id, qrcode_id))
+            if cursor.rowcount == 0:
+                db.rollback()
+                raise HTTPException(status_code=400, detail="QR code cannot be exchanged")
+            change_seq = stamp_changes(cursor, [qrcode_id])
             db.commit()
+            broker.publish("redeemed", {
+                "qrcode_id": qrcode_id,
+                "value": 0.0,
+                "state": "usado",
+                "creation_date": creation_date,
+                "used_date": used_date,
+                "change_seq": change_seq,
+                "site_id": code_site,
+                "machine_id": code_machine,
+                "redeemed_machine_id": machine_id
+            }, change_seq)
             return {"status": "success", "message": "QR code exchanged successfully"}
         else:
             raise HTTPException(status_code=400, detail="QR code cannot be exchanged")
     finally:
         cursor.close()
 
+@app.put("/api/qrdata/exchange/{qrcode_id}")
+def exchange_qr(
+    qrcode_id: str,
+    # Antes que get_db: una petición sin clave válida no ocupa una conexión del pool
+    device: DeviceKey = Depends(get_device),
+    db: mysql.connector.MySQLConnection = Depends(get_db)
+):
+    """Exchange a QR code (readers only, authenticated with their device key)."""
+    return redeem_code(db, qrcode_id, device.machine_id)
+
+def message_qrcode_id(message: dict) -> str:
+    qrcode_id = message.get("qrcode_id")
+    if not isinstance(qrcode_id, str) or not qrcode_id:
+        raise HTTPException(status_code=400, detail="Falta qrcode_id")
+    return qrcode_id
+
+def redeem_with_connection(qrcode_id: str, machine_id: str) -> dict:
+    db = get_connection()
+    try:
+        return redeem_code(db, qrcode_id, machine_id)
+    finally:
+        db.close()
+
+async def ingest_redeem(device: DeviceKey, message: dict) -> dict:
+    """Canje recibido por el canal persistente de los lectores."""
+    # MySQL y el journal bloquean: fuera del event loop que atiende a los lectores
+    return await run_in_threadpool(redeem_with_connection, message_qrcode_id(message), device.machine_id)
+
+def lookup_code(qrcode_id: str) -> dict:
+    db = get_connection()
+    cursor = db.cursor()
+    try:
+        cursor.execute(f'SELECT {SUMMARY_COLUMNS} FROM qr_codes WHERE qrcode_id = %s', (qrcode_id,))
+        result = cursor.fetchone()
+        if not result:
+            cursor.execute(f'SELECT {SUMMARY_COLUMNS} FROM qr_codes_archive WHERE qrcode_id = %s', (qrcode_id,))
+            result = cursor.fetchone()
+        if not result:
+            raise HTTPException(status_code=404, detail="Código QR no encontrado")
+        return with_pending_redemptions([summary_row_to_dict(result)])[0]
+    finally:
+        cursor.close()
+        db.close()
+
+async def ingest_lookup(device: DeviceKey, message: dict) -> dict:
+    """Estado y valor de un código, por el canal persistente."""
+    return await run_in_threadpool(lookup_code, message_qrcode_id(message))
+
+# Telemetría de los lectores, agregada en memoria (sin filas por evento)
+telemetry = TelemetryAggregator(
+    directory=os.getenv("TELEMETRY_DIR", "telemetry"),
+    bucket_seconds=int(os.getenv("TELEMETRY_BUCKET_SECONDS", "60")),
+    buckets=int(os.getenv("TELEMETRY_BUCKETS", "60")),
+    offline_after=float(os.getenv("TELEMETRY_OFFLINE_AFTER", "180")),
+    summary_window=float(os.getenv("TELEMETRY_SUMMARY_WINDOW", "900")),
+    publish_interval=float(os.getenv("TELEMETRY_PUBLISH_INTERVAL", "10"))
+)
+
+@app.on_event("startup")
+def start_telemetry():
+    telemetry.start()
+
+@app.on_event("shutdown")
+def stop_telemetry():
+    telemetry.stop()
+
+def record_telemetry(device: DeviceKey, batch: TelemetryBatch):
+    telemetry.record(
+        device.machine_id,
+        batch.heartbeat.dict() if batch.heartbeat is not None else None,
+        [scan.dict() for scan in batch.scans]
+    )
+
+@app.post("/api/telemetry")
+async def post_telemetry(batch: TelemetryBatch, device: DeviceKey = Depends(get_device)):
+    """Batched heartbeat and scan metrics from a reader (device key)."""
+    record_telemetry(device, batch)
+    return {"status": "accepted", "scans": len(batch.scans)}
+
+@app.get("/api/telemetry/summary")
+async def get_telemetry_summary(current_user: dict = Depends(check_admin_role)):
+    """Fleet health: offline, slow and failing machines (precomputed, refreshed every few seconds)."""
+    return telemetry.summary()
+
+@app.get("/api/telemetry/devices/{machine_id}")
+async def get_device_telemetry(machine_id: str, current_user: dict = Depends(check_admin_role)):
+    """Status of one machine with its per-interval rollups."""
+    result = telemetry.device(machine_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="No hay telemetría de esta máquina")
+    return result
+
+async def ingest_telemetry(device: DeviceKey, message: dict) -> dict:
+    """Lote de telemetría recibido por el canal persistente."""
+    try:
+        batch = TelemetryBatch.parse_obj(message)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors())
+    record_telemetry(device, batch)
+    return {"scans": len(batch.scans)}
+
+# Canal TCP persistente de los lectores (0 = desactivado)
+device_ingest = DeviceIngestServer(
+    device_keys.authenticate,
+    {"redeem": ingest_redeem, "lookup": ingest_lookup, "telemetry": ingest_telemetry, "ping": ping},
+    host=os.getenv("DEVICE_INGEST_HOST", "0.0.0.0"),
+    port=int(os.getenv("DEVICE_INGEST_PORT", "0")),
+    idle_timeout=float(os.getenv("DEVICE_INGEST_IDLE_TIMEOUT", "300")),
+    max_in_flight=int(os.getenv("DEVICE_INGEST_MAX_IN_FLIGHT", "16")),
+    # Por defecto la mitad del pool: el resto queda para la API HTTP
+    max_concurrency=int(os.getenv("DEVICE_INGEST_MAX_CONCURRENCY", "0")) or max(1, pool_size() // 2),
+    replay_size=int(os.getenv("DEVICE_INGEST_REPLAY_SIZE", "4096")),
+    # Compartidas entre workers: un reintento puede llegar a otro worker
+    reply_store=DeviceReplyStore(
+        get_connection,
+        ttl_hours=float(os.getenv("DEVICE_REPLY_TTL_HOURS", "24")),
+        pending_timeout=float(os.getenv("DEVICE_REPLY_PENDING_TIMEOUT", "30"))
+    )
+)
+
+@app.on_event("startup")
+async def start_device_ingest():
+    if device_ingest.port:
+        await device_ingest.start()
+
+@app.on_event("shutdown")
+async def stop_device_ingest():
+    await device_ingest.stop()
+
+@app.get("/api/devices/ingest")
+async def get_device_ingest_status(current_user: dict = Depends(check_admin_role)):
+    """Open reader connections and messages handled by this worker's ingest channel."""
+    return {"enabled": bool(device_ingest.port), **device_ingest.status()}
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(
-        app,
-        host=os.getenv("API_HOST", "0.0.0.0"),
-        port=int(os.getenv("API_PORT", "3000")),
-        log_level=os.getenv("LOG_LEVEL", "info").lower()
-    ) 
\ No newline at end of file
+    # Un solo proceso, para desarrollo; en producción: gunicorn -c gunicorn_conf.py.
+    # Se arranca como ``python -m uvicorn`` y no con uvicorn.run(app): los
+    # procesos de las hojas (spawn) vuelven a importar el módulo __main__, y
+    # así no cargan la API entera sino solo voucher_sheet.
+    import sys
+    os.execv(sys.executable, [
+        sys.executable, "-m", "uvicorn", "qrcode_generator:app",
+        "--app-dir", os.path.dirname(os.path.abspath(__file__)),
+        "--host", os.getenv("API_HOST", "0.0.0.0"),
+        "--port", os.getenv("API_PORT", "3000"),
+        "--log-level", os.getenv("LOG_LEVEL", "info").lower(),
+    ]) 
\ No newline at end of file
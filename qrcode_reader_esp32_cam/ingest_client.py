@@ -0,0 +1,175 @@
+"""
+ESP32 MicroPython client for the reader ingest channel (device_ingest.py)
+
+Important Notes:
+---------------
+1. Serial Communication:
+   - Use only ASCII characters in print statements
+
+2. Protocol:
+   - One TCP connection is kept open instead of one HTTP request per scan
+   - Every message is a 4 byte big-endian length followed by JSON
+   - The first message authenticates the machine with its device key
+   - Messages are sent without waiting for the answer; each response
+     carries the seq of its request and may arrive in a different order
+   - A ping is sent after PING_INTERVAL seconds without traffic so the
+     server does not close the idle connection
+
+3. Usage:
+    client = IngestClient(INGEST_HOST, INGEST_PORT, DEVICE_KEY, MACHINE_ID)
+    client.connect()
+    seq = client.send("redeem", qrcode_id="ABC123")
+    ...
+    for response in client.poll():
+        if response["seq"] == seq and response["ok"]:
+            print("Redeemed")
+
+   If the connection drops, poll() returns the unanswered requests with
+   status 0 (outcome unknown). After connect(), send them again with the
+   same seq: the server answers a repeated redeem with the response it
+   already gave instead of redeeming twice.
+    client.send("redeem", seq=seq, qrcode_id="ABC123")
+"""
+
+import usocket as socket
+import ustruct as struct
+import ujson as json
+import uselect as select
+import utime as time
+
+PING_INTERVAL = 60  # Seconds without traffic before a ping
+CONNECT_TIMEOUT = 10  # Seconds for connect and hello
+MAX_MESSAGE_SIZE = 4096  # Responses are small
+
+
+class IngestError(Exception):
+    pass
+
+
+class IngestClient:
+    def __init__(self, host, port, key, machine_id, ping_interval=PING_INTERVAL):
+        self.host = host
+        self.port = port
+        self.key = key
+        self.machine_id = machine_id
+        self.ping_interval = ping_interval
+        self.sock = None
+        self.poller = None
+        self.seq = 0
+        self.pending = {}  # seq -> op of requests without response
+        self.buffer = b""
+        self.last_sent = time.ticks_ms()
+
+    def connect(self):
+        self.close()
+        addr = socket.getaddrinfo(self.host, self.port)[0][-1]
+        sock = socket.socket()
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(addr)
+            self.sock = sock
+            self.buffer = b""
+            self.seq += 1
+            self._write({"seq": self.seq, "op": "hello", "key": self.key, "machine_id": self.machine_id})
+            response = self._read_message_blocking()
+        except OSError as e:
+            sock.close()
+            self.sock = None
+            raise IngestError("Connection failed: {}".format(e))
+        if not response.get("ok"):
+            self.close()
+            raise IngestError("Authentication failed: {}".format(response.get("detail")))
+        sock.settimeout(None)
+        self.poller = select.poll()
+        self.poller.register(sock, select.POLLIN)
+        print("Ingest channel connected")
+
+    def connected(self):
+        return self.sock is not None
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.poller = None
+
+    def send(self, op, seq=None, **fields):
+        """Sends a request without waiting for the answer. Returns its seq.
+
+        Pass the seq of a request whose answer was lost to retry it.
+        """
+        if self.sock is None:
+            raise IngestError("Not connected")
+        if seq is None:
+            self.seq += 1
+            seq = self.seq
+        message = {"seq": seq, "op": op}
+        message.update(fields)
+        self.pending[seq] = op
+        try:
+            self._write(message)
+        except OSError:
+            self.close()
+        return seq
+
+    def poll(self):
+        """Returns the responses received so far (never blocks)."""
+        responses = []
+        if self.sock is None:
+            return self._drop_pending(responses)
+        try:
+            while self.poller.poll(0):
+                data = self.sock.recv(512)
+                if not data:
+                    raise OSError("closed by server")
+                self.buffer += data
+            while True:
+                message = self._take_message()
+                if message is None:
+                    break
+                self.pending.pop(message.get("seq"), None)
+                responses.append(message)
+            if time.ticks_diff(time.ticks_ms(), self.last_sent) > self.ping_interval * 1000:
+                self.send("ping")
+        except (OSError, ValueError) as e:
+            print("Ingest channel lost: {}".format(e))
+            self.close()
+            return self._drop_pending(responses)
+        return responses
+
+    def _drop_pending(self, responses):
+        for seq in self.pending:
+            responses.append({"seq": seq, "op": self.pending[seq], "ok": False, "status": 0,
+                              "detail": "connection lost"})
+        self.pending = {}
+        return responses
+
+    def _write(self, message):
+        body = json.dumps(message).encode()
+        self.sock.sendall(struct.pack(">I", len(body)) + body)
+        self.last_sent = time.ticks_ms()
+
+    def _take_message(self):
+        if len(self.buffer) < 4:
+            return None
+        length = struct.unpack(">I", self.buffer[:4])[0]
+        if length > MAX_MESSAGE_SIZE:
+            raise ValueError("message too large")
+        if len(self.buffer) < 4 + length:
+            return None
+        body = self.buffer[4:4 + length]
+        self.buffer = self.buffer[4 + length:]
+        return json.loads(body)
+
+    def _read_message_blocking(self):
+        while True:
+            message = self._take_message()
+            if message is not None:
+                return message
+            data = self.sock.recv(512)
+            if not data:
+                raise OSError("closed by server")
+            self.buffer += data
@@ -20,6 +20,21 @@ Important Notes:
    - Provides visual and audio feedback
    - Optimized camera settings for QR detection
 
+4. Adaptive Resolution:
+   - The camera delivers raw grayscale frames (one byte per pixel) so the
+     detector works on real pixels without decoding JPEG
+   - Each scan first looks for finder patterns in a low resolution frame
+   - Only when a candidate is found is a full resolution frame taken, and
+     only the region around the candidate is scanned in it
+   - The last region where a code was confirmed is remembered (also in
+     ROI_FILE, across reboots) and searched first, since codes are
+     presented in a fairly fixed window in front of the machine
+
+5. Telemetry:
+   - Detect times, capture failures and a heartbeat (RSSI, free heap,
+     uptime) are sent in one batch every TELEMETRY_INTERVAL seconds
+     (telemetry_client.py) when API_URL and DEVICE_KEY are set
+
 Date: 03-04-2025
 """
 
@@ -30,6 +45,8 @@ from time import sleep
 import gc
 import ubinascii
 import json
+import utime
+from telemetry_client import Telemetry
 
 # Global configuration
 WIFI_SSID = "Vodafone-C62B"
@@ -38,11 +55,26 @@ FLASH_PIN = 4
 BUZZER_PIN = 12  # Pin for buzzer (if available)
 WIFI_TIMEOUT = 15
 
+# Telemetry (empty API_URL = disabled)
+API_URL = ""  # e.g. "http://192.168.1.10:3000"
+DEVICE_KEY = ""  # Issued with POST /api/devices/keys
+MACHINE_ID = ""
+
 # Camera parameters
 CAMERA_RESOLUTION = (800, 600)  # Resolution for QR detection
 SCAN_INTERVAL = 5  # Time in seconds between scan attempts
 MAX_CAPTURE_ATTEMPTS = 3  # Maximum number of capture attempts per cycle
 
+# Adaptive resolution (framesize values of the flashed camera driver)
+FULL_RES_FRAMESIZE = 10  # 800x600, CAMERA_RESOLUTION
+LOW_RES_FRAMESIZE = 5  # 320x240, LOW_RES_RESOLUTION
+LOW_RES_RESOLUTION = (320, 240)
+LOW_RES_SCAN_STEP = 4  # Finer step: low resolution frames are small
+ROI_MARGIN = 0.5  # Extra space around the candidate, as a fraction of its size
+MIN_ROI_SIZE = 120  # Minimum side of the region scanned at full resolution
+ROI_FILE = "roi.json"  # Last confirmed region, kept across reboots
+ROI_MOVE_THRESHOLD = 30  # Pixels the region must move before it is saved again
+
 # QR detection parameters
 PATTERN_SIZE = 7  # Size of QR finder pattern (7x7 modules)
 THRESHOLD = 128  # Threshold for black/white pixel detection
@@ -107,12 +139,17 @@ def initialize_camera():
     # wait for camera ready
     for i in range(5):
         try:
-            cam = camera.init()
+            # Raw grayscale frames if the driver supports them (1 byte per pixel)
+            if hasattr(camera, "GRAYSCALE"):
+                cam = camera.init(0, format=camera.GRAYSCALE)
+            else:
+                cam = camera.init()
             print("Camera ready?: ", cam)
             if cam:
                 # Configure camera for better QR detection
                 # Based on optimized settings for code scanning
-                camera.framesize(10)     # 800x600
+                camera.framesize(LOW_RES_FRAMESIZE)
+                current_framesize[0] = LOW_RES_FRAMESIZE
                 camera.contrast(2)       # increase contrast
                 camera.quality(10)       # best quality
                 camera.speffect(2)       # grayscale for better QR detection
@@ -166,61 +203,169 @@ def is_finder_pattern(pixels, x, y, width, height):
     
     return True
 
-def find_qr_patterns(image_data, width, height):
+def find_qr_patterns(image_data, width, height, roi=None, step=SCAN_STEP):
     """
     Searches for the three QR finder patterns
-    Returns the coordinates and estimated size
+    Returns the coordinates of the patterns found
+
+    image_data must be a raw grayscale frame (width * height bytes). roi is
+    an optional (x0, y0, x1, y1) region: only that part of the frame is
+    scanned. JPEG frames cannot be decoded on the device and are skipped.
     """
-    # Convert JPEG data to grayscale pixel array
-    # This is a simplification. In a real implementation, we would need to
-    # properly decode the JPEG and convert it to a grayscale pixel array
-    
-    # For this implementation, we simulate a pixel array
-    # In a real implementation, we would need to decode the JPEG
-    # and convert it to a grayscale pixel array
-    
-    # Simulate a pixel array with random values
-    # In a real implementation, this would be the result of decoding the JPEG
-    import random
-    pixels = [random.randint(0, 255) for _ in range(width * height)]
-    
+    if len(image_data) != width * height:
+        print("Frame is not raw grayscale, skipping detection")
+        return []
+    pixels = image_data
+
+    if roi is None:
+        x0, y0, x1, y1 = 0, 0, width, height
+    else:
+        x0, y0, x1, y1 = roi
+    # Minimum distance between patterns scales with the resolution
+    min_distance = MIN_PATTERN_DISTANCE * width // CAMERA_RESOLUTION[0]
+
     # Search for finder patterns
     patterns = []
-    
+
     # Search in the image with a step to speed up detection
-    for y in range(0, height - PATTERN_SIZE, SCAN_STEP):
-        for x in range(0, width - PATTERN_SIZE, SCAN_STEP):
+    for y in range(y0, y1 - PATTERN_SIZE, step):
+        for x in range(x0, x1 - PATTERN_SIZE, step):
             if is_finder_pattern(pixels, x, y, width, height):
                 # Check distance with other patterns found
                 valid = True
                 for px, py in patterns:
-                    if abs(x - px) < MIN_PATTERN_DISTANCE and abs(y - py) < MIN_PATTERN_DISTANCE:
+                    if abs(x - px) < min_distance and abs(y - py) < min_distance:
                         valid = False
                         break
-                
+
                 if valid:
                     patterns.append((x, y))
                     print(f"QR pattern found at ({x}, {y})")
-                    
+
                     if len(patterns) == 3:  # Found all three patterns
                         return patterns
-    
+
     return patterns
 
-def detect_qr_in_image(image_data, width, height):
+def detect_qr_in_image(image_data, width, height, roi=None, step=SCAN_STEP):
     """
-    Detects if there is a QR code in the image
-    Returns True if a QR is detected, False otherwise
+    Detects if there is a QR code in the image (or in roi)
+    Returns the finder patterns found (empty if no QR is detected)
     """
     # Search for QR patterns
-    patterns = find_qr_patterns(image_data, width, height)
-    
+    patterns = find_qr_patterns(image_data, width, height, roi, step)
+
     if patterns:
         print(f"QR detected with {len(patterns)} finder patterns")
-        return True
-    else:
+    return patterns
+
+# Framesize currently configured in the sensor
+current_framesize = [None]
+
+def capture_frame(framesize, width, height):
+    """
+    Captures a frame at the given framesize, switching the sensor if needed.
+    The first frames after a switch can still have the old size, so frames of
+    the wrong size are discarded.
+    """
+    if current_framesize[0] != framesize:
+        camera.framesize(framesize)
+        current_framesize[0] = framesize
+    img = None
+    for _ in range(3):
+        img = camera.capture()
+        if img and len(img) == width * height:
+            return img
+    # JPEG mode (no raw grayscale support): return whatever was captured
+    return img
+
+def patterns_to_roi(patterns, scale_x, scale_y, width, height):
+    """Bounding box of the patterns, scaled to (width, height) and padded."""
+    xs = [x for x, _ in patterns]
+    ys = [y for _, y in patterns]
+    x0 = min(xs) * scale_x
+    y0 = min(ys) * scale_y
+    x1 = (max(xs) + PATTERN_SIZE) * scale_x
+    y1 = (max(ys) + PATTERN_SIZE) * scale_y
+    pad_x = max(int((x1 - x0) * ROI_MARGIN), (MIN_ROI_SIZE - (x1 - x0)) // 2)
+    pad_y = max(int((y1 - y0) * ROI_MARGIN), (MIN_ROI_SIZE - (y1 - y0)) // 2)
+    return (
+        max(0, int(x0 - pad_x)),
+        max(0, int(y0 - pad_y)),
+        min(width, int(x1 + pad_x)),
+        min(height, int(y1 + pad_y)),
+    )
+
+def load_roi():
+    try:
+        with open(ROI_FILE) as f:
+            roi = json.load(f)
+        return tuple(roi) if len(roi) == 4 else None
+    except (OSError, ValueError):
+        return None
+
+def save_roi(roi):
+    try:
+        with open(ROI_FILE, "w") as f:
+            json.dump(list(roi), f)
+    except OSError as e:
+        print(f"Could not save ROI: {e}")
+
+# Last region (full resolution coordinates) where a QR was confirmed
+last_roi = [load_roi()]
+
+def scale_roi(roi, scale_x, scale_y):
+    x0, y0, x1, y1 = roi
+    return (int(x0 * scale_x), int(y0 * scale_y), int(x1 * scale_x), int(y1 * scale_y))
+
+def scan_once():
+    """
+    One adaptive scan: a low resolution frame is searched first in the
+    remembered region and then whole; only if a candidate is found is a full
+    resolution frame taken and checked around it. Returns True if a QR was
+    detected, False if not and None if the frame could not be captured.
+    """
+    full_w, full_h = CAMERA_RESOLUTION
+    low_w, low_h = LOW_RES_RESOLUTION
+
+    img = capture_frame(LOW_RES_FRAMESIZE, low_w, low_h)
+    if not img:
+        print("Error capturing image")
+        return None
+    print(f"Image captured. Size: {len(img)} bytes")
+
+    # 1. Remembered region first, then the whole low resolution frame
+    candidates = []
+    if last_roi[0]:
+        low_roi = scale_roi(last_roi[0], low_w / full_w, low_h / full_h)
+        candidates = detect_qr_in_image(img, low_w, low_h, low_roi, LOW_RES_SCAN_STEP)
+    if not candidates:
+        candidates = detect_qr_in_image(img, low_w, low_h, step=LOW_RES_SCAN_STEP)
+    img = None
+    gc.collect()
+    if not candidates:
+        return False
+
+    # 2. Full resolution, only around the candidate
+    roi = patterns_to_roi(candidates, full_w / low_w, full_h / low_h, full_w, full_h)
+    img = capture_frame(FULL_RES_FRAMESIZE, full_w, full_h)
+    patterns = detect_qr_in_image(img, full_w, full_h, roi) if img else []
+    img = None
+    gc.collect()
+    if not patterns:
         return False
 
+    roi = patterns_to_roi(patterns, 1, 1, full_w, full_h)
+    # Small shifts between scans are ignored to avoid rewriting the flash
+    if last_roi[0] is None or max(abs(a - b) for a, b in zip(roi, last_roi[0])) > ROI_MOVE_THRESHOLD:
+        last_roi[0] = roi
+        save_roi(roi)
+        print(f"ROI updated: {roi}")
+    return True
+
+# Detect times and failures, sent in batches with a heartbeat
+telemetry = Telemetry(API_URL, DEVICE_KEY, MACHINE_ID)
+
 def capture_and_detect_qr():
     """
     Captures an image and attempts to detect QR patterns
@@ -247,17 +392,15 @@ def capture_and_detect_qr():
         for attempt in range(MAX_CAPTURE_ATTEMPTS):
             print(f"Capture attempt {attempt+1}/{MAX_CAPTURE_ATTEMPTS}")
             
-            # Capture an image
-            img = camera.capture()
-            
-            if not img:
-                print("Error capturing image")
-                continue
-            
-            print(f"Image captured. Size: {len(img)} bytes")
-            
-            # Try to detect QR in the image
-            if detect_qr_in_image(img, 800, 600):
+            # Low resolution search, full resolution only around candidates
+            started = utime.ticks_ms()
+            detected = scan_once()
+            elapsed = utime.ticks_diff(utime.ticks_ms(), started)
+            if detected is None:
+                telemetry.record_scan(elapsed, False, "capture")
+            elif detected:
+                telemetry.record_scan(elapsed, True)
+            if detected:
                 # Success sound
                 if buzzer:
                     buzzer.on()
@@ -289,6 +432,7 @@ def capture_and_detect_qr():
             
     except Exception as e:
         print(f"Error in capture and detection: {e}")
+        telemetry.record_scan(0, False, "exception")
         flash.off()
         return False
 
@@ -309,6 +453,7 @@ def main():
         # 3. Capture and detect QR
         while True:
             capture_and_detect_qr()
+            telemetry.maybe_flush()
             print(f"Waiting {SCAN_INTERVAL} seconds before next scan...")
             sleep(SCAN_INTERVAL)  # Wait before next reading
             
@@ -0,0 +1,125 @@
+"""
+Desktop stand-in for the ESP32-CAM camera driver (sim/ stubs)
+
+Important Notes:
+---------------
+1. Frames:
+   - Frames are replayed from image files on disk (photos of vouchers, or
+     frames dumped from the board as PGM/PNG) instead of the sensor
+   - Each frame is cropped to the aspect ratio of the configured framesize,
+     scaled to it and returned as raw grayscale bytes (one byte per pixel),
+     like the driver does with format=GRAYSCALE; with the default format
+     it is returned JPEG encoded
+   - The same frame is returned on every capture until next_frame() is
+     called, so a low and a full resolution capture see the same scene
+
+2. Usage:
+    import camera
+    camera.replay(["corpus/qr/voucher1.jpg", "corpus/qr/voucher2.jpg"])
+    camera.init(0, format=camera.GRAYSCALE)
+    camera.framesize(5)
+    frame = camera.capture()  # 320 * 240 bytes
+    camera.next_frame()
+
+   With captures_per_frame=N the next frame is loaded automatically every N
+   captures, for running the detector main loop unchanged.
+"""
+
+import io
+
+from PIL import Image, ImageOps
+
+JPEG = 0
+GRAYSCALE = 1
+
+# Framesize values of the flashed driver, as used by qr_motion_detector.py
+FRAMESIZES = {
+    1: (160, 120),
+    5: (320, 240),
+    8: (640, 480),
+    10: (800, 600),
+}
+
+_state = {
+    "initialized": False,
+    "format": JPEG,
+    "framesize": 5,
+    "paths": [],
+    "index": 0,
+    "captures_per_frame": 0,
+    "captures": 0,
+}
+# Converted frames by (path, size, format), so replaying costs no conversion
+_cache = {}
+
+
+def replay(paths, captures_per_frame=0):
+    """Sets the frames to replay, in order (cycled when they run out)."""
+    _state["paths"] = list(paths)
+    _state["index"] = 0
+    _state["captures_per_frame"] = captures_per_frame
+    _state["captures"] = 0
+
+
+def next_frame():
+    if _state["paths"]:
+        _state["index"] = (_state["index"] + 1) % len(_state["paths"])
+
+
+def current_path():
+    return _state["paths"][_state["index"]] if _state["paths"] else None
+
+
+def init(*args, format=JPEG, **kwargs):
+    _state["initialized"] = True
+    _state["format"] = format
+    return True
+
+
+def deinit():
+    _state["initialized"] = False
+
+
+def framesize(size):
+    if size not in FRAMESIZES:
+        raise ValueError("Unsupported framesize: {}".format(size))
+    _state["framesize"] = size
+
+
+def _render(path, size, fmt):
+    key = (path, size, fmt)
+    frame = _cache.get(key)
+    if frame is None:
+        with Image.open(path) as image:
+            gray = ImageOps.fit(ImageOps.exif_transpose(image).convert("L"), size)
+        if fmt == GRAYSCALE:
+            frame = gray.tobytes()
+        else:
+            buffer = io.BytesIO()
+            gray.save(buffer, format="JPEG", quality=90)
+            frame = buffer.getvalue()
+        _cache[key] = frame
+    return frame
+
+
+def capture():
+    """Current frame at the configured framesize, or None if not initialized."""
+    if not _state["initialized"] or not _state["paths"]:
+        return None
+    frame = _render(current_path(), FRAMESIZES[_state["framesize"]], _state["format"])
+    _state["captures"] += 1
+    per_frame = _state["captures_per_frame"]
+    if per_frame and _state["captures"] % per_frame == 0:
+        next_frame()
+    return frame
+
+
+# Sensor settings are accepted and ignored
+def contrast(value): pass
+def quality(value): pass
+def speffect(value): pass
+def brightness(value): pass
+def saturation(value): pass
+def flip(value): pass
+def mirror(value): pass
+def whitebalance(value): pass
@@ -0,0 +1,40 @@
+"""
+Desktop stand-in for the MicroPython machine module (sim/ stubs)
+
+Pins only remember their value; nothing is driven.
+"""
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, pin, mode=-1, pull=-1, value=None):
+        self.pin = pin
+        self.mode = mode
+        self._value = value or 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = 1 if value else 0
+
+
+def reset():
+    raise SystemExit("machine.reset()")
+
+
+def freq(value=None):
+    return 240000000
+
+
+def unique_id():
+    return b"\x00\x00\x00\x00\x00\x00"
@@ -0,0 +1,39 @@
+"""
+Desktop stand-in for the MicroPython network module (sim/ stubs)
+
+The WLAN interface is always connected, with a fixed address and RSSI.
+"""
+
+STA_IF = 0
+AP_IF = 1
+
+RSSI = -60
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+        self._connected = False
+
+    def active(self, value=None):
+        if value is None:
+            return self._active
+        self._active = bool(value)
+
+    def connect(self, ssid=None, password=None):
+        self._connected = True
+
+    def disconnect(self):
+        self._connected = False
+
+    def isconnected(self):
+        return self._connected
+
+    def ifconfig(self):
+        return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
+
+    def status(self, param=None):
+        if param == "rssi":
+            return RSSI
+        return 1010 if self._connected else 1000
@@ -0,0 +1,3 @@
+"""Desktop stand-in for MicroPython ubinascii (sim/ stubs)."""
+
+from binascii import a2b_base64, b2a_base64, hexlify, unhexlify  # noqa: F401
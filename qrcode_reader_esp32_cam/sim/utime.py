@@ -0,0 +1,31 @@
+"""Desktop stand-in for MicroPython utime (sim/ stubs)."""
+
+import time as _time
+
+# Ticks wrap around like on the ESP32 (30-bit counter)
+TICKS_MAX = 0x3FFFFFFF
+TICKS_HALF = 0x20000000
+
+sleep = _time.sleep
+time = _time.time
+
+
+def ticks_ms():
+    return int(_time.monotonic() * 1000) & TICKS_MAX
+
+
+def ticks_us():
+    return int(_time.monotonic() * 1000000) & TICKS_MAX
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+
+def ticks_diff(end, start):
+    diff = (end - start) & TICKS_MAX
+    return diff - TICKS_MAX - 1 if diff & TICKS_HALF else diff
+
+
+def sleep_ms(ms):
+    sleep(ms / 1000)
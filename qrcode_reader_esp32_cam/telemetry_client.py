@@ -0,0 +1,109 @@
+"""
+ESP32 MicroPython telemetry batcher (server side: telemetry.py)
+
+Important Notes:
+---------------
+1. Serial Communication:
+   - Use only ASCII characters in print statements
+
+2. Batching:
+   - Scan metrics (detect time, success or failure) are kept in a small
+     list and sent together with a heartbeat (RSSI, free heap, uptime)
+     every TELEMETRY_INTERVAL seconds, not one request per scan
+   - At most MAX_PENDING_SCANS are kept; when the server cannot be reached
+     the oldest are dropped, so memory use is bounded
+   - If an IngestClient is connected the batch goes over the persistent
+     channel ("telemetry" op); otherwise it is posted to /api/telemetry
+
+3. Usage:
+    telemetry = Telemetry(API_URL, DEVICE_KEY, MACHINE_ID)
+    started = time.ticks_ms()
+    ok = scan_once()
+    telemetry.record_scan(time.ticks_diff(time.ticks_ms(), started), ok)
+    telemetry.maybe_flush()
+"""
+
+import gc
+import network
+import utime as time
+
+try:
+    import urequests as requests
+except ImportError:
+    requests = None
+
+FIRMWARE = "qr_motion_detector-2025.04"
+TELEMETRY_INTERVAL = 60  # Seconds between batches
+MAX_PENDING_SCANS = 100  # Scans kept while the server is unreachable
+HTTP_TIMEOUT = 10
+
+
+class Telemetry:
+    def __init__(self, api_url, key, machine_id, ingest=None, interval=TELEMETRY_INTERVAL):
+        self.api_url = api_url
+        self.key = key
+        self.machine_id = machine_id
+        self.ingest = ingest
+        self.interval = interval
+        self.scans = []  # [detect_ms, ok, error, ticks_ms]
+        self.last_flush = time.ticks_ms()
+
+    def record_scan(self, detect_ms, ok, error=None):
+        if len(self.scans) >= MAX_PENDING_SCANS:
+            self.scans.pop(0)
+        self.scans.append([detect_ms, ok, error, time.ticks_ms()])
+
+    def heartbeat(self):
+        rssi = None
+        try:
+            rssi = network.WLAN(network.STA_IF).status("rssi")
+        except Exception:
+            pass
+        gc.collect()
+        return {
+            "rssi": rssi,
+            "free_heap": gc.mem_free(),
+            "uptime_s": time.ticks_ms() // 1000,
+            "firmware": FIRMWARE,
+        }
+
+    def maybe_flush(self):
+        if time.ticks_diff(time.ticks_ms(), self.last_flush) >= self.interval * 1000:
+            self.flush()
+
+    def flush(self):
+        """Sends the heartbeat and pending scans. Returns True if delivered."""
+        self.last_flush = time.ticks_ms()
+        now = time.ticks_ms()
+        batch = {
+            "heartbeat": self.heartbeat(),
+            "scans": [
+                {"detect_ms": s[0], "ok": s[1], "error": s[2], "age_s": time.ticks_diff(now, s[3]) / 1000}
+                for s in self.scans
+            ],
+        }
+        sent = len(self.scans)
+        try:
+            if self.ingest is not None and self.ingest.connected():
+                # Fire and forget: a lost batch only costs one interval of metrics
+                self.ingest.send("telemetry", **batch)
+            elif self.api_url and requests is not None:
+                response = requests.post(
+                    self.api_url + "/api/telemetry",
+                    json=batch,
+                    headers={"X-Device-Key": self.key, "X-Machine-Id": self.machine_id},
+                    timeout=HTTP_TIMEOUT,
+                )
+                status = response.status_code
+                response.close()
+                if status != 200:
+                    print("Telemetry rejected: {}".format(status))
+                    return False
+            else:
+                return False
+        except Exception as e:
+            print("Telemetry not sent: {}".format(e))
+            return False
+        # Scans recorded while sending stay for the next batch
+        self.scans = self.scans[sent:]
+        return True
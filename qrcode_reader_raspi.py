@@ -1,8 +1,11 @@
 import sys
 import requests
+import threading
 import time
 import os
 from dotenv import load_dotenv
+from qr_edge_cache import EdgeCache
+from qr_payload import InvalidPayload, is_signed_payload, verifier_from_env
 
 # Cargar variables de entorno desde .env
 load_dotenv()
@@ -11,6 +14,209 @@ class Config:
     """Configuración del lector QR"""
     API_URL = os.getenv('API_URL', 'http://localhost:3000')
     QR_MIN_VALUE = float(os.getenv('QR_MIN_VALUE', '10.0'))
+    # Clave de API de la máquina (POST /api/devices/keys); sin ella el lector no arranca
+    DEVICE_KEY = os.getenv('DEVICE_KEY', '')
+    MACHINE_ID = os.getenv('MACHINE_ID', '')
+    # Sede de la máquina (POST /api/machines); para comprobar sin red los códigos de una sede
+    SITE_ID = os.getenv('SITE_ID', '')
+    API_TIMEOUT = float(os.getenv('API_TIMEOUT', '3'))
+    EDGE_CACHE_PATH = os.getenv('EDGE_CACHE_PATH', 'edge_cache.db')
+    SYNC_INTERVAL = int(os.getenv('SYNC_INTERVAL', '30'))
+    SYNC_PAGE_SIZE = int(os.getenv('SYNC_PAGE_SIZE', '100'))
+
+
+# Verificación local de los QR firmados (QR_SIGNING_KEY / QR_VERIFY_ED25519_PUBLIC_KEY)
+VERIFICADOR = verifier_from_env()
+
+
+class ClaveRechazada(Exception):
+    """El servidor rechazó la clave de dispositivo (revocada o de otra máquina)."""
+
+
+class ApiClient:
+    """Cliente HTTP de la API autenticado con la clave de dispositivo."""
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.session.headers.update({
+            "X-Device-Key": Config.DEVICE_KEY,
+            "X-Machine-Id": Config.MACHINE_ID,
+        })
+        # Se activa con un 401: sin clave válida los canjes no se podrían
+        # confirmar nunca, así que se deja de canjear sin red
+        self.clave_rechazada = threading.Event()
+
+    def request(self, method, path, **kwargs):
+        """Hace una petición autenticada. Lanza ClaveRechazada si la API responde 401."""
+        respuesta = self.session.request(
+            method, f"{Config.API_URL}{path}", timeout=Config.API_TIMEOUT, **kwargs
+        )
+        if respuesta.status_code == 401:
+            self.clave_rechazada.set()
+            detalle = respuesta.json().get("detail", "") if respuesta.content else ""
+            raise ClaveRechazada(detalle)
+        self.clave_rechazada.clear()
+        return respuesta
+
+
+def parse_value(valor):
+    """Convierte el valor devuelto por la API ("$10.00" o 10.0) a float."""
+    return float(str(valor).lstrip('$'))
+
+
+def fila_replica(qr):
+    """Fila de la réplica local a partir de un código devuelto por la API."""
+    return (qr["qrcode_id"], parse_value(qr["value"]), qr["state"], qr.get("site_id"), qr.get("machine_id"))
+
+
+def fuera_de_ambito(cache: EdgeCache, qrcode_id: str):
+    """Motivo por el que el código no se puede canjear en esta máquina, o None."""
+    sede, maquina = cache.scope(qrcode_id)
+    if maquina:
+        if maquina != Config.MACHINE_ID:
+            return f"solo es válido en la máquina {maquina}"
+    elif sede:
+        if not Config.SITE_ID:
+            return f"es de la sede {sede} y SITE_ID no está configurado"
+        if sede != Config.SITE_ID:
+            return f"solo es válido en la sede {sede}"
+    return None
+
+
+def sincronizar_replica(cache: EdgeCache, api: ApiClient):
+    """Descarga los cambios desde el último cursor y los aplica a la réplica local."""
+    cursor = int(cache.get_meta("cursor", "0"))
+    recibidos = 0
+    while True:
+        respuesta = api.request(
+            "GET", "/api/qrcodes/changes", params={"since": cursor, "limit": Config.SYNC_PAGE_SIZE}
+        )
+        respuesta.raise_for_status()
+        lote = respuesta.json()
+        cache.apply_codes([fila_replica(qr) for qr in lote["changes"]])
+        cursor = lote["cursor"]
+        cache.set_meta("cursor", str(cursor))
+        recibidos += len(lote["changes"])
+        if not lote["has_more"]:
+            break
+    cache.set_meta("last_sync", time.strftime("%Y-%m-%d %H:%M:%S"))
+    if recibidos:
+        print(f"Réplica sincronizada: {recibidos} cambios (cursor {cursor})")
+
+
+def reconciliar_canjes(cache: EdgeCache, api: ApiClient):
+    """Envía al servidor los canjes pendientes del journal local."""
+    for entry_id, qrcode_id, valor, fecha in cache.pending():
+        respuesta = api.request("PUT", f"/api/qrdata/exchange/{qrcode_id}")
+        if respuesta.status_code == 200:
+            cache.mark_synced(entry_id)
+            print(f"Canje de {qrcode_id} confirmado con el servidor")
+        elif respuesta.status_code == 409:
+            # Reintento de un canje que el servidor ya aplicó para esta máquina
+            # (se perdió la respuesta del primer envío)
+            cache.mark_synced(entry_id)
+            print(f"Canje de {qrcode_id} ya registrado en el servidor")
+        elif respuesta.status_code in (400, 403, 404):
+            detalle = respuesta.json().get("detail", "") if respuesta.content else ""
+            cache.mark_conflict(entry_id, f"{respuesta.status_code}: {detalle}")
+            print(f"CONFLICTO: el QR {qrcode_id} (valor {valor}) canjeado el {fecha} "
+                  f"fue rechazado por el servidor: {detalle}")
+        else:
+            respuesta.raise_for_status()
+
+
+def sincronizacion_en_segundo_plano(cache: EdgeCache, api: ApiClient, despertar: threading.Event):
+    """Reconcilia el journal y refresca la réplica periódicamente o cuando se solicita."""
+    while True:
+        try:
+            reconciliar_canjes(cache, api)
+            sincronizar_replica(cache, api)
+        except ClaveRechazada as e:
+            print(f"ERROR: la API rechazó la clave de dispositivo de {Config.MACHINE_ID} ({e}). "
+                  f"No se canjearán códigos hasta que se configure una clave válida.")
+        except requests.exceptions.RequestException as e:
+            print(f"Sin conexión con la API, se reintentará más tarde: {e}")
+        except Exception as e:
+            print(f"Error en la sincronización: {e}")
+        despertar.wait(Config.SYNC_INTERVAL)
+        despertar.clear()
+
+
+def consultar_servidor(cache: EdgeCache, api: ApiClient, qrcode_id: str):
+    """Consulta un código desconocido en el servidor y lo añade a la réplica."""
+    respuesta = api.request("GET", f"/api/qrdata/{qrcode_id}")
+    if respuesta.status_code == 404:
+        return None
+    respuesta.raise_for_status()
+    fila = fila_replica(respuesta.json())
+    cache.apply_codes([fila])
+    return fila[1], fila[2]
+
+
+def procesar_qr(cache: EdgeCache, api: ApiClient, despertar: threading.Event, datos: str):
+    """Valida un código contra la réplica local y lo canjea."""
+    if api.clave_rechazada.is_set():
+        print(f"Clave de dispositivo rechazada: no se canjea el QR {datos}.")
+        return
+    if is_signed_payload(datos):
+        # Contenido firmado: se valida sin consultar al servidor
+        try:
+            contenido = VERIFICADOR.verify(datos)
+        except InvalidPayload as e:
+            print(f"QR rechazado: {e}")
+            return
+        datos = contenido.qrcode_id
+        info = cache.lookup(datos)
+        if info is None:
+            # Firmado pero aún no replicado: se acepta con el valor firmado y el
+            # canje se confirma con el servidor en segundo plano
+            info = (contenido.value, 'valido')
+    else:
+        info = cache.lookup(datos)
+    if info is None:
+        try:
+            info = consultar_servidor(cache, api, datos)
+        except ClaveRechazada:
+            print(f"Clave de dispositivo rechazada: no se canjea el QR {datos}.")
+            return
+        except requests.exceptions.RequestException as e:
+            print(f"El QR {datos} no está en la réplica y la API no responde: {e}")
+            return
+        if info is None:
+            print(f"El QR {datos} no existe.")
+            return
+
+    motivo = fuera_de_ambito(cache, datos)
+    if motivo:
+        print(f"El QR {datos} {motivo}. No se generan pulsos.")
+        return
+
+    valor_qr, estado_qr = info
+    if valor_qr >= Config.QR_MIN_VALUE and estado_qr == 'valido':
+        if not cache.redeem(datos, valor_qr):
+            print(f"El QR {datos} ya fue canjeado en esta máquina.")
+            return
+        pulsos = int(valor_qr / Config.QR_MIN_VALUE)
+        print(f"Generando {pulsos} pulsos para el QR {datos}")
+        # El canje queda en el journal; se confirma con el servidor en segundo plano
+        despertar.set()
+    else:
+        if valor_qr < Config.QR_MIN_VALUE:
+            print(f"El valor del QR {datos} es menor a {Config.QR_MIN_VALUE}. No se generan pulsos.")
+        elif estado_qr != 'valido':
+            print(f"El estado del QR {datos} no es 'valido'. No se generan pulsos.")
+        else:
+            print(f"El QR {datos} no cumple con los requisitos para generar pulsos.")
+
+
+def reportar_conflictos(cache: EdgeCache):
+    """Muestra los canjes locales que el servidor rechazó."""
+    conflictos = cache.conflicts()
+    if not conflictos:
+        print("No hay conflictos registrados.")
+    for qrcode_id, valor, fecha, detalle in conflictos:
+        print(f"{fecha}  {qrcode_id}  valor={valor}  {detalle}")
+
 
 def leer_qr_desde_lector_usb():
     """Lee códigos QR desde un lector USB, procesa la información y actualiza la base de datos."""
@@ -19,52 +225,46 @@ def leer_qr_desde_lector_usb():
     print(f"API URL: {Config.API_URL}")
     print(f"Valor mínimo QR: {Config.QR_MIN_VALUE}")
 
+    cache = EdgeCache(Config.EDGE_CACHE_PATH)
+    api = ApiClient()
+    despertar = threading.Event()
+    print(f"Réplica local: {len(cache)} códigos, {len(cache.pending())} canjes pendientes")
+
+    threading.Thread(
+        target=sincronizacion_en_segundo_plano,
+        args=(cache, api, despertar),
+        daemon=True,
+    ).start()
+
     while True:
         try:
             # Leer la línea completa enviada por el lector USB (terminada con Enter)
             datos = input()
             datos = datos.strip()  # Eliminar espacios en blanco al principio y al final
+            if not datos:
+                continue
 
             print("Código QR leído:", datos)
-
-            try:
-                # Obtener información del QR
-                url_get = f"{Config.API_URL}/api/qrdata/{datos}"
-                respuesta_get = requests.get(url_get)
-                respuesta_get.raise_for_status()
-                info_qr = respuesta_get.json()
-                print("Información del QR:", info_qr)
-
-                valor_qr = info_qr.get('valor', 0)
-                estado_qr = info_qr.get('estado', '')
-
-                if valor_qr >= Config.QR_MIN_VALUE and estado_qr == 'valido':
-                    pulsos = int(valor_qr / Config.QR_MIN_VALUE)
-                    print(f"Generando {pulsos} pulsos para el QR {datos}")
-
-                    # Actualizar el estado y el valor del QR
-                    url_put = f"{Config.API_URL}/api/qrdata/canjear/{datos}"
-                    respuesta_put = requests.put(url_put)
-                    respuesta_put.raise_for_status()
-                    print(f"QR {datos} actualizado a 'usado' y valor a 0")
-                else:
-                    if valor_qr < Config.QR_MIN_VALUE:
-                        print(f"El valor del QR {datos} es menor a {Config.QR_MIN_VALUE}. No se generan pulsos.")
-                    elif estado_qr != 'valido':
-                        print(f"El estado del QR {datos} no es 'valido'. No se generan pulsos.")
-                    else:
-                        print(f"El QR {datos} no cumple con los requisitos para generar pulsos.")
-
-            except requests.exceptions.RequestException as e:
-                print(f"Error al procesar el QR: {e}")
+            procesar_qr(cache, api, despertar, datos)
 
         except KeyboardInterrupt:
             print("Programa terminado por el usuario.")
             break
+        except EOFError:
+            break
         except Exception as e:
             print(f"Error al leer desde el lector USB: {e}")
             time.sleep(1)
 
-if __name__ == "__main__":
-    leer_qr_desde_lector_usb()
+    cache.close()
 
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--conflictos":
+        reportar_conflictos(EdgeCache(Config.EDGE_CACHE_PATH))
+    elif not Config.DEVICE_KEY or not Config.MACHINE_ID:
+        # Sin clave el servidor rechaza todos los canjes: se darían productos
+        # sin poder confirmarlos nunca
+        print("ERROR: configure DEVICE_KEY y MACHINE_ID (POST /api/devices/keys) en .env.raspi")
+        sys.exit(1)
+    else:
+        leer_qr_desde_lector_usb()
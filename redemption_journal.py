@@ -0,0 +1,353 @@
+"""
+Journal de canjes con escritura diferida (write-behind) en el servidor.
+
+En los picos (cambios de turno, eventos) muchas máquinas canjean a la vez y
+cada ``exchange_qr`` confirmaba su propia transacción en MySQL. Con el
+journal activado (``REDEMPTION_JOURNAL_PATH``) el canje se valida con una
+lectura, se añade a un journal SQLite local y se confirma al lector en cuanto
+la entrada está en disco:
+
+- Commit en grupo: un hilo escritor recoge todas las entradas que llegan
+  mientras hace el fsync anterior y las confirma juntas en una sola
+  transacción (WAL + synchronous=FULL), así que el coste de un fsync se
+  reparte entre todos los canjes de la ráfaga. La restricción UNIQUE sobre
+  ``qrcode_id`` impide canjear dos veces el mismo código, también entre
+  workers que comparten el fichero.
+- ``RedemptionFlusher`` aplica las entradas pendientes a MySQL por lotes, cada
+  lote en una transacción. En esa misma transacción guarda en
+  ``qr_redemption_watermark`` el id de la última entrada aplicada; tras una
+  caída, las entradas hasta esa marca se dan por aplicadas y el resto se
+  aplica una sola vez.
+"""
+
+import logging
+import queue
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from change_feed import stamp_changes
+from events import broker
+from maintenance import PeriodicJob
+
+# Estados de las entradas del journal
+PENDING = "pendiente"
+APPLIED = "aplicado"
+CONFLICT = "conflicto"
+
+
+class RedemptionJournal:
+    """Journal SQLite de canjes con commit en grupo."""
+
+    def __init__(self, path: str, max_group: int = 1000):
+        self.path = path
+        self.max_group = max_group
+        self._queue: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        # Conexión de lectura y marcado (la del escritor es exclusiva de su hilo)
+        self._conn = self._connect()
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS redemptions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                qrcode_id TEXT NOT NULL UNIQUE,
+                value REAL NOT NULL,
+                redeemed_at TEXT NOT NULL,
+                status TEXT NOT NULL,
+                detail TEXT,
+                machine_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_redemptions_status ON redemptions (status, id);
+            """
+        )
+        # Journals creados antes de registrar la máquina del canje
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(redemptions)")}
+        if "machine_id" not in columns:
+            self._conn.execute("ALTER TABLE redemptions ADD COLUMN machine_id TEXT")
+        self._writer = threading.Thread(target=self._write_loop, name="redemption-journal", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def append(self, qrcode_id: str, value: float, machine_id: Optional[str] = None) -> Future:
+        """
+        Añade un canje. El Future se resuelve a True cuando la entrada está en
+        disco, o a False si el código ya tenía un canje en el journal.
+        """
+        future: Future = Future()
+        self._queue.put((qrcode_id, value, datetime.now(), machine_id, future))
+        return future
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            first = self._queue.get()
+            if first is None:
+                break
+            # Todo lo que se ha encolado mientras tanto va en el mismo commit
+            group = [first]
+            while len(group) < self.max_group:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                group.append(item)
+            self._commit_group(conn, group)
+        conn.close()
+
+    def _commit_group(self, conn: sqlite3.Connection, group: List[tuple]):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for qrcode_id, value, redeemed_at, machine_id, _ in group:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO redemptions (qrcode_id, value, redeemed_at, status, machine_id) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (qrcode_id, value, redeemed_at.isoformat(), PENDING, machine_id)
+                )
+                results.append(cursor.rowcount == 1)
+            conn.execute("COMMIT")
+        except Exception as e:
+            logging.error(f"Error escribiendo el journal de canjes: {e}")
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for *_, future in group:
+                future.set_exception(e)
+            return
+        for (*_, future), accepted in zip(group, results):
+            future.set_result(accepted)
+
+    def redeemed_by(self, qrcode_id: str) -> Optional[str]:
+        """Máquina del canje del código en el journal (pendiente o aplicado), o None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT machine_id FROM redemptions WHERE qrcode_id = ? AND status != ?",
+                (qrcode_id, CONFLICT)
+            ).fetchone()
+        return row[0] if row else None
+
+    def pending_redemptions(self, qrcode_ids: List[str], chunk_size: int = 500) -> Dict[str, Tuple[str, Optional[str]]]:
+        """
+        Canjes de esos códigos confirmados al lector pero aún sin aplicar a
+        MySQL: qrcode_id -> (redeemed_at, machine_id).
+        """
+        found = {}
+        with self._lock:
+            for start in range(0, len(qrcode_ids), chunk_size):
+                chunk = qrcode_ids[start:start + chunk_size]
+                placeholders = ", ".join(["?"] * len(chunk))
+                for qrcode_id, redeemed_at, machine_id in self._conn.execute(
+                    f"SELECT qrcode_id, redeemed_at, machine_id FROM redemptions "
+                    f"WHERE status = ? AND qrcode_id IN ({placeholders})",
+                    (PENDING, *chunk)
+                ):
+                    found[qrcode_id] = (redeemed_at, machine_id)
+        return found
+
+    def pending(self, after_id: int, limit: int) -> List[Tuple[int, str, float, str, Optional[str]]]:
+        """Entradas pendientes posteriores a ``after_id``, en orden."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, qrcode_id, value, redeemed_at, machine_id FROM redemptions "
+                "WHERE status = ? AND id > ? ORDER BY id LIMIT ?",
+                (PENDING, after_id, limit)
+            ).fetchall()
+
+    def pending_upto(self, last_id: int) -> List[Tuple[int, str]]:
+        """Entradas pendientes que MySQL ya tiene aplicadas (caída tras el commit)."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, qrcode_id FROM redemptions WHERE status = ? AND id <= ?",
+                (PENDING, last_id)
+            ).fetchall()
+
+    def mark(self, entry_ids: List[int], status: str, detail: str = None):
+        if not entry_ids:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "UPDATE redemptions SET status = ?, detail = ? WHERE id = ?",
+                [(status, detail, entry_id) for entry_id in entry_ids]
+            )
+            self._conn.execute("COMMIT")
+
+    def prune(self, before: datetime) -> int:
+        """Borra las entradas aplicadas anteriores a ``before`` (MySQL ya las tiene como usadas)."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM redemptions WHERE status = ? AND redeemed_at < ?",
+                (APPLIED, before.isoformat())
+            )
+            return cursor.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM redemptions GROUP BY status").fetchall())
+
+    def conflicts(self, limit: int = 100) -> List[Tuple[str, float, str, str]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT qrcode_id, value, redeemed_at, detail FROM redemptions "
+                "WHERE status = ? ORDER BY id DESC LIMIT ?",
+                (CONFLICT, limit)
+            ).fetchall()
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join(timeout=10)
+        with self._lock:
+            self._conn.close()
+
+
+class RedemptionFlusher(PeriodicJob):
+    """Aplica a MySQL los canjes del journal, un lote por transacción."""
+
+    name = "redemptions"
+
+    def __init__(self, connect: Callable, journal: RedemptionJournal, interval: float = 0.2,
+                 batch_size: int = 500, journal_name: str = None, retention_days: int = 7):
+        super().__init__(connect, interval, batch_size, pause=0)
+        self.journal = journal
+        # Identifica el journal en qr_redemption_watermark (uno por host)
+        self.journal_name = journal_name or socket.gethostname()
+        self.retention_days = retention_days
+        self._last_prune = 0.0
+
+    @property
+    def lock_name(self) -> str:
+        # Un flusher por journal: los de otros hosts no se bloquean entre sí
+        return f"qr_redemptions_{self.journal_name}"
+
+    def status(self) -> Dict:
+        status = super().status()
+        status["journal"] = self.journal.path
+        status["entries"] = self.journal.counts()
+        status["conflicts"] = [
+            {"qrcode_id": qrcode_id, "value": value, "redeemed_at": redeemed_at, "detail": detail}
+            for qrcode_id, value, redeemed_at, detail in self.journal.conflicts()
+        ]
+        return status
+
+    def run(self, report: Dict):
+        db = self.connect()
+        cursor = db.cursor()
+        try:
+            watermark = self._recover(db, cursor)
+            while True:
+                entries = self.journal.pending(watermark, self.batch_size)
+                if not entries:
+                    break
+                watermark = self._apply(db, cursor, entries)
+                report["rows"] += len(entries)
+                report["batches"] += 1
+                if len(entries) < self.batch_size:
+                    break
+        finally:
+            cursor.close()
+            db.close()
+        if time.monotonic() - self._last_prune > 3600:
+            self._last_prune = time.monotonic()
+            self.journal.prune(datetime.now() - timedelta(days=self.retention_days))
+
+    def _recover(self, db, cursor) -> int:
+        """
+        Lee la marca de agua y cierra las entradas que MySQL ya aplicó pero que
+        el journal no llegó a marcar. Devuelve la marca.
+        """
+        cursor.execute('SELECT last_entry FROM qr_redemption_watermark WHERE journal = %s', (self.journal_name,))
+        row = cursor.fetchone()
+        db.commit()
+        watermark = row[0] if row else 0
+        stale = self.journal.pending_upto(watermark)
+        if stale:
+            ids = [qrcode_id for _, qrcode_id in stale]
+            placeholders = ", ".join(["%s"] * len(ids))
+            # El Archiver puede haber movido ya las filas aplicadas
+            cursor.execute(
+                f'SELECT qrcode_id FROM qr_codes WHERE qrcode_id IN ({placeholders}) AND state = "usado" '
+                f'UNION ALL SELECT qrcode_id FROM qr_codes_archive WHERE qrcode_id IN ({placeholders}) '
+                f'AND state = "usado"',
+                ids + ids
+            )
+            used = {r[0] for r in cursor.fetchall()}
+            db.commit()
+            self.journal.mark([entry_id for entry_id, qrcode_id in stale if qrcode_id in used], APPLIED)
+            self.journal.mark(
+                [entry_id for entry_id, qrcode_id in stale if qrcode_id not in used],
+                CONFLICT, "El código cambió de estado antes de aplicar el canje"
+            )
+            logging.info(f"Journal de canjes: {len(stale)} entradas ya aplicadas recuperadas")
+        return watermark
+
+    def _apply(self, db, cursor, entries: List[tuple]) -> int:
+        """Aplica un lote en una transacción junto con la nueva marca de agua."""
+        ids = [entry[1] for entry in entries]
+        placeholders = ", ".join(["%s"] * len(ids))
+        cursor.execute(
+            f'SELECT qrcode_id, creation_date, site_id, machine_id FROM qr_codes '
+            f'WHERE qrcode_id IN ({placeholders}) AND state = "valido" FOR UPDATE',
+            ids
+        )
+        # qrcode_id -> (creation_date, site_id, machine_id)
+        valid = {row[0]: row[1:] for row in cursor.fetchall()}
+        applied = [entry for entry in entries if entry[1] in valid]
+        rejected = [entry for entry in entries if entry[1] not in valid]
+
+        last_seq = 0
+        if applied:
+            cases = " ".join(["WHEN %s THEN %s"] * len(applied))
+            applied_placeholders = ", ".join(["%s"] * len(applied))
+            dates = []
+            machines = []
+            for _, qrcode_id, _, redeemed_at, machine_id in applied:
+                dates += [qrcode_id, datetime.fromisoformat(redeemed_at)]
+                machines += [qrcode_id, machine_id]
+            cursor.execute(
+                f'UPDATE qr_codes SET state = "usado", value = 0, used_date = CASE qrcode_id {cases} END, '
+                f'redeemed_machine_id = CASE qrcode_id {cases} END '
+                f'WHERE qrcode_id IN ({applied_placeholders})',
+                dates + machines + [entry[1] for entry in applied]
+            )
+            last_seq = stamp_changes(cursor, [entry[1] for entry in applied])
+        watermark = entries[-1][0]
+        cursor.execute(
+            'INSERT INTO qr_redemption_watermark (journal, last_entry) VALUES (%s, %s) '
+            'ON DUPLICATE KEY UPDATE last_entry = VALUES(last_entry)',
+            (self.journal_name, watermark)
+        )
+        db.commit()
+
+        self.journal.mark([entry[0] for entry in applied], APPLIED)
+        self.journal.mark(
+            [entry[0] for entry in rejected], CONFLICT, "El código cambió de estado antes de aplicar el canje"
+        )
+        if rejected:
+            logging.warning(f"Journal de canjes: {len(rejected)} canjes no aplicados (estado cambiado)")
+
+        first_seq = last_seq - len(applied) + 1
+        for offset, (_, qrcode_id, _, redeemed_at, machine_id) in enumerate(applied):
+            creation_date, code_site, code_machine = valid[qrcode_id]
+            broker.publish("redeemed", {
+                "qrcode_id": qrcode_id,
+                "value": 0.0,
+                "state": "usado",
+                "creation_date": creation_date,
+                "used_date": redeemed_at,
+                "change_seq": first_seq + offset,
+                "site_id": code_site,
+                "machine_id": code_machine,
+                "redeemed_machine_id": machine_id
+            }, first_seq + offset)
+        return watermark
@@ -1,47 +1,261 @@
 #!/bin/sh
+#
+# Incremental MySQL backups: a periodic full dump plus binlog segments.
+#
+# Usage: backup-mysql.sh [auto|full|binlog]
+#
+#   full    mysqldump --single-transaction --master-data=2 (consistent snapshot
+#           without locking the tables, with the binlog position of the snapshot)
+#   binlog  FLUSH BINARY LOGS and copy every closed binlog not yet backed up
+#   auto    full if the last full dump is older than BACKUP_FULL_INTERVAL_HOURS,
+#           binlog otherwise (default)
+#
+# Every backup file gets a "<file>.manifest" with its sha256 and binlog
+# coordinates. The manifest of a full dump also holds the row count and a row
+# checksum of every table. These come from a consistent snapshot taken at the
+# start of a new binlog file (stats_binlog_file). verify_backup.py restores
+# the dump, replays the segments up to that file and compares the tables.
+# Binlog runs only copy files, with no queries on the tables.
 
 # Set error handling
 set -e
 
+MODE="${1:-auto}"
+
 # Load environment variables
-source /scripts/load-env.sh
-
-# Create backups directory if it doesn't exist
-mkdir -p /backups
-
-# Get current timestamp
-TIMESTAMP=$(date +%Y%m%d-%H%M)
-
-# Create backup filename using the database name from environment variable
-BACKUP_FILE="${DB_NAME}_${TIMESTAMP}.sql.gz"
-
-echo "Starting backup process at $(date)"
-
-# Create the backup
-echo "Creating MySQL backup..."
-mysqldump -h "${DB_HOST}" -u "${DB_USER}" -p"${DB_PASSWORD}" "${DB_NAME}" | gzip > "/backups/${BACKUP_FILE}"
-
-# Check if backup was successful
-if [ $? -eq 0 ]; then
-    echo "Backup created successfully: ${BACKUP_FILE}"
-    
-    # Upload to Google Drive
-    echo "Uploading to Google Drive..."
-    rclone copy "/backups/${BACKUP_FILE}" remote:backups/
-    
-    if [ $? -eq 0 ]; then
-        echo "Upload to Google Drive successful"
-        
-        # Clean up old backups (keep last 7 days)
-        echo "Cleaning up old backups..."
-        ls -t /backups/${DB_NAME}_*.sql.gz | tail -n +8 | xargs -r rm
-        
-        echo "Backup process completed successfully at $(date)"
-    else
-        echo "Error: Failed to upload to Google Drive"
+if [ -f /scripts/load-env.sh ]; then
+    . /scripts/load-env.sh
+fi
+
+BACKUP_DIR="${BACKUP_DIR:-/backups}"
+BINLOG_DIR="${BINLOG_DIR:-/var/lib/mysql}"
+BACKUP_USER="${BACKUP_USER:-root}"
+BACKUP_FULL_INTERVAL_HOURS="${BACKUP_FULL_INTERVAL_HOURS:-24}"
+BACKUP_KEEP_FULL="${BACKUP_KEEP_FULL:-7}"
+BACKUP_COMPRESSOR="${BACKUP_COMPRESSOR:-pigz}"
+
+# mysqldump --master-data and FLUSH BINARY LOGS need global privileges
+# (RELOAD, REPLICATION CLIENT), so the backup runs as root by default.
+export MYSQL_PWD="${BACKUP_PASSWORD:-${MYSQL_ROOT_PASSWORD}}"
+
+# Multi-threaded compression on every core
+case "${BACKUP_COMPRESSOR}" in
+    pigz) COMPRESS="pigz -c"; EXT="gz" ;;
+    zstd) COMPRESS="zstd -T0 -q -c"; EXT="zst" ;;
+    *) echo "Error: unsupported BACKUP_COMPRESSOR '${BACKUP_COMPRESSOR}' (pigz or zstd)"; exit 1 ;;
+esac
+
+mysql_query() {
+    mysql -h "${DB_HOST}" -u "${BACKUP_USER}" -N -B -e "$1" "${DB_NAME}"
+}
+
+# One query per table printing "table=<name> <rows> <checksum>". The
+# checksum is the BIT_XOR of the CRC32 of every row, a plain read that sees
+# the transaction's snapshot (CHECKSUM TABLE may not). verify_backup.py
+# computes the same on the restored copy.
+table_stats_queries() {
+    mysql -h "${DB_HOST}" -u "${BACKUP_USER}" -N -B "${DB_NAME}" <<'SQL'
+SET SESSION group_concat_max_len = 1048576;
+SELECT CONCAT(
+    'SELECT CONCAT(''table=', c.TABLE_NAME, ' '', COUNT(*), '' '', ',
+    'COALESCE(BIT_XOR(CRC32(CONCAT_WS(''#'', ',
+    GROUP_CONCAT(CONCAT('`', c.COLUMN_NAME, '`') ORDER BY c.ORDINAL_POSITION SEPARATOR ', '),
+    ', CONCAT(',
+    GROUP_CONCAT(CONCAT('ISNULL(`', c.COLUMN_NAME, '`)') ORDER BY c.ORDINAL_POSITION SEPARATOR ', '),
+    ')))), 0)) FROM `', c.TABLE_NAME, '`;'
+)
+FROM information_schema.COLUMNS c
+JOIN information_schema.TABLES t ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+WHERE c.TABLE_SCHEMA = DATABASE() AND t.TABLE_TYPE = 'BASE TABLE'
+GROUP BY c.TABLE_NAME
+ORDER BY c.TABLE_NAME;
+SQL
+}
+
+# Row count and checksum of every table from one consistent snapshot. The
+# global read lock is held only to start a new binlog file and open the
+# snapshot, so the snapshot is exactly the state at the start of that file.
+# Prints "<binlog file>\t<position>", then one "table=..." line per table.
+snapshot_table_stats() {
+    queries=$(table_stats_queries)
+    {
+        echo "FLUSH TABLES WITH READ LOCK;"
+        echo "FLUSH BINARY LOGS;"
+        echo "START TRANSACTION WITH CONSISTENT SNAPSHOT;"
+        echo "SHOW MASTER STATUS;"
+        echo "UNLOCK TABLES;"
+        echo "${queries}"
+        echo "COMMIT;"
+    } | mysql -h "${DB_HOST}" -u "${BACKUP_USER}" -N -B "${DB_NAME}"
+}
+
+# Write the common header of a manifest
+write_manifest() {
+    file="$1"
+    kind="$2"
+    manifest="${BACKUP_DIR}/${file}.manifest"
+    {
+        echo "type=${kind}"
+        echo "file=${file}"
+        echo "sha256=$(sha256sum "${BACKUP_DIR}/${file}" | cut -d' ' -f1)"
+        echo "size=$(wc -c < "${BACKUP_DIR}/${file}" | tr -d ' ')"
+        echo "created=$(date -u +%Y-%m-%dT%H:%M:%SZ)"
+        echo "compressor=${BACKUP_COMPRESSOR}"
+    } > "${manifest}.tmp"
+    echo "${manifest}"
+}
+
+# True if binlog name $1 sorts before $2 (names are zero-padded)
+before() {
+    [ "$1" != "$2" ] && [ "$(printf '%s\n%s\n' "$1" "$2" | sort | head -n 1)" = "$1" ]
+}
+
+upload() {
+    if [ -n "${BACKUP_REMOTE}" ] && command -v rclone > /dev/null; then
+        echo "Uploading $1..."
+        rclone copy "${BACKUP_DIR}/$1" "${BACKUP_REMOTE}"
+        rclone copy "${BACKUP_DIR}/$1.manifest" "${BACKUP_REMOTE}"
+    fi
+}
+
+latest_full() {
+    ls -t "${BACKUP_DIR}/${DB_NAME}"_*.full.sql.* 2>/dev/null | grep -v '\.manifest$' | head -n 1
+}
+
+full_backup() {
+    TIMESTAMP=$(date +%Y%m%d-%H%M)
+    BACKUP_FILE="${DB_NAME}_${TIMESTAMP}.full.sql.${EXT}"
+    echo "Creating full dump ${BACKUP_FILE}..."
+
+    # pipefail is not available in busybox sh: check mysqldump's status by hand
+    status_file="${BACKUP_DIR}/.dump-status"
+    { mysqldump -h "${DB_HOST}" -u "${BACKUP_USER}" \
+        --single-transaction --master-data=2 --flush-logs \
+        --routines --triggers --hex-blob \
+        --databases "${DB_NAME}"; echo $? > "${status_file}"; } \
+        | ${COMPRESS} > "${BACKUP_DIR}/${BACKUP_FILE}.tmp"
+    if [ "$(cat "${status_file}")" != "0" ]; then
+        rm -f "${BACKUP_DIR}/${BACKUP_FILE}.tmp" "${status_file}"
+        echo "Error: mysqldump failed"
         exit 1
     fi
-else
-    echo "Error: Failed to create backup"
-    exit 1
-fi
+    rm -f "${status_file}"
+    mv "${BACKUP_DIR}/${BACKUP_FILE}.tmp" "${BACKUP_DIR}/${BACKUP_FILE}"
+
+    # Binlog position of the snapshot, from the commented CHANGE MASTER line
+    coords=$(${COMPRESS%% *} -dc "${BACKUP_DIR}/${BACKUP_FILE}" | head -n 50 \
+        | grep -m 1 -E "CHANGE (MASTER|REPLICATION SOURCE) TO" || true)
+    if [ -z "${coords}" ]; then
+        echo "Error: binlog position not found in the dump (is binary logging enabled?)"
+        exit 1
+    fi
+    binlog_file=$(echo "${coords}" | sed -E "s/.*_LOG_FILE='([^']+)'.*/\1/")
+    binlog_pos=$(echo "${coords}" | sed -E "s/.*_LOG_POS=([0-9]+).*/\1/")
+
+    echo "Taking table stats..."
+    stats=$(snapshot_table_stats)
+    stats_coords=$(echo "${stats}" | head -n 1)
+
+    manifest=$(write_manifest "${BACKUP_FILE}" full)
+    {
+        echo "binlog_file=${binlog_file}"
+        echo "binlog_pos=${binlog_pos}"
+        echo "stats_binlog_file=$(echo "${stats_coords}" | cut -f1)"
+        echo "stats_binlog_pos=$(echo "${stats_coords}" | cut -f2)"
+        echo "${stats}" | sed '1d'
+    } >> "${manifest}.tmp"
+    mv "${manifest}.tmp" "${manifest}"
+
+    # Binlogs before this dump are no longer needed for the next restore
+    echo "${binlog_file}" > "${BACKUP_DIR}/.last-binlog"
+    echo "Full dump created: ${BACKUP_FILE} (from ${binlog_file}:${binlog_pos})"
+    upload "${BACKUP_FILE}"
+
+    # The segments between the dump and the stats snapshot are already closed:
+    # copy them now so the dump can be verified right away
+    copy_closed_binlogs
+}
+
+binlog_backup() {
+    last=$(cat "${BACKUP_DIR}/.last-binlog" 2>/dev/null || true)
+    if [ -z "${last}" ]; then
+        echo "No full dump yet: taking one first"
+        full_backup
+        return
+    fi
+
+    mysql_query "FLUSH BINARY LOGS"
+    copy_closed_binlogs
+}
+
+# Copy every closed binlog from .last-binlog on that has not been copied yet
+copy_closed_binlogs() {
+    last=$(cat "${BACKUP_DIR}/.last-binlog")
+    # Every binlog except the newest one is closed
+    closed=$(mysql_query "SHOW BINARY LOGS" | cut -f1 | sed '$d')
+
+    copied=0
+    for binlog in ${closed}; do
+        # The file that was current at the last backup is copied now that it is closed
+        if before "${binlog}" "${last}"; then
+            continue
+        fi
+        if [ -f "${BACKUP_DIR}/${DB_NAME}_${binlog}.${EXT}.manifest" ]; then
+            continue
+        fi
+        BACKUP_FILE="${DB_NAME}_${binlog}.${EXT}"
+        echo "Copying binlog segment ${binlog}..."
+        ${COMPRESS} "${BINLOG_DIR}/${binlog}" > "${BACKUP_DIR}/${BACKUP_FILE}.tmp"
+        mv "${BACKUP_DIR}/${BACKUP_FILE}.tmp" "${BACKUP_DIR}/${BACKUP_FILE}"
+
+        manifest=$(write_manifest "${BACKUP_FILE}" binlog)
+        echo "binlog_file=${binlog}" >> "${manifest}.tmp"
+        mv "${manifest}.tmp" "${manifest}"
+        upload "${BACKUP_FILE}"
+        copied=$((copied + 1))
+    done
+
+    newest=$(mysql_query "SHOW BINARY LOGS" | cut -f1 | tail -n 1)
+    echo "${newest}" > "${BACKUP_DIR}/.last-binlog"
+    echo "${copied} binlog segment(s) backed up"
+}
+
+cleanup() {
+    # Keep the last BACKUP_KEEP_FULL full dumps and the binlogs that follow them
+    oldest_kept=$(ls -t "${BACKUP_DIR}/${DB_NAME}"_*.full.sql.* 2>/dev/null | grep -v '\.manifest$' \
+        | head -n "${BACKUP_KEEP_FULL}" | tail -n 1)
+    [ -n "${oldest_kept}" ] || return 0
+    ls -t "${BACKUP_DIR}/${DB_NAME}"_*.full.sql.* 2>/dev/null | grep -v '\.manifest$' \
+        | tail -n +"$((BACKUP_KEEP_FULL + 1))" | while read -r old; do
+            rm -f "${old}" "${old}.manifest"
+        done
+    first_binlog=$(grep '^binlog_file=' "${oldest_kept}.manifest" | cut -d= -f2)
+    for segment in "${BACKUP_DIR}/${DB_NAME}"_*.manifest; do
+        grep -q '^type=binlog$' "${segment}" 2>/dev/null || continue
+        binlog=$(grep '^binlog_file=' "${segment}" | cut -d= -f2)
+        if before "${binlog}" "${first_binlog}"; then
+            rm -f "${segment%.manifest}" "${segment}"
+        fi
+    done
+}
+
+mkdir -p "${BACKUP_DIR}"
+echo "Starting ${MODE} backup at $(date)"
+
+case "${MODE}" in
+    full) full_backup ;;
+    binlog) binlog_backup ;;
+    auto)
+        latest=$(latest_full)
+        max_age_minutes=$((BACKUP_FULL_INTERVAL_HOURS * 60))
+        if [ -z "${latest}" ] || [ -n "$(find "${latest}" -mmin +"${max_age_minutes}")" ]; then
+            full_backup
+        else
+            binlog_backup
+        fi
+        ;;
+    *) echo "Usage: $0 [auto|full|binlog]"; exit 1 ;;
+esac
+
+cleanup
+echo "Backup process completed successfully at $(date)"
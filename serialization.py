@@ -0,0 +1,97 @@
+"""
+Serialización rápida de filas de qr_codes a JSON.
+
+Los endpoints de listado y consulta convierten cada fila de la base de datos
+directamente a un diccionario con los tipos ya normalizados (valor como
+float, fechas como datetime, imagen en base64) y la codifican una sola vez
+con orjson si está instalado. Al devolver una ``Response`` ya construida,
+FastAPI no vuelve a validar ni a serializar el resultado a través del
+``response_model``. En su lugar ``validate_first`` valida solo el primer
+elemento contra el modelo: todas las filas salen de la misma consulta y la
+misma conversión, así que un desajuste de columnas o de tipos aparece ya en
+la primera, y el coste no crece con el tamaño de la página.
+"""
+
+import base64
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, Sequence, Type
+
+from pydantic import BaseModel
+
+from fastapi.responses import Response
+
+from image_store import QR_IMAGE_SQL, qr_image_sql
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson es opcional
+    orjson = None
+
+# Columnas sin imagen, para consultas de estado
+SUMMARY_COLUMNS = "qrcode_id, value, state, creation_date, used_date, site_id, machine_id, redeemed_machine_id"
+
+# Columnas de qr_codes en el orden que espera row_to_dict
+QR_COLUMNS = f"{SUMMARY_COLUMNS}, {QR_IMAGE_SQL} AS qr_image"
+
+# Las mismas columnas leídas de qr_codes_archive
+ARCHIVE_QR_COLUMNS = f"{SUMMARY_COLUMNS}, {qr_image_sql('qr_codes_archive')} AS qr_image"
+
+
+def _as_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime.combine(value, datetime.min.time())
+    return value
+
+
+def row_to_dict(row: Sequence[Any]) -> Dict[str, Any]:
+    """Convierte una fila (QR_COLUMNS) al formato de respuesta de QRCode."""
+    result = summary_row_to_dict(row)
+    result["qr_image"] = base64.b64encode(row[8]).decode('ascii') if row[8] else None
+    return result
+
+
+def summary_row_to_dict(row: Sequence[Any]) -> Dict[str, Any]:
+    """Convierte una fila de SUMMARY_COLUMNS (sin imagen)."""
+    return {
+        "qrcode_id": row[0],
+        "value": float(row[1]),
+        "state": row[2],
+        "creation_date": _as_datetime(row[3]),
+        "used_date": row[4],
+        "site_id": row[5],
+        "machine_id": row[6],
+        "redeemed_machine_id": row[7],
+    }
+
+
+def validate_first(model: Type[BaseModel], items: Sequence[Dict[str, Any]]):
+    """Valida el primer elemento con el modelo de la respuesta (ValidationError -> 500)."""
+    if items:
+        model.validate(items[0])
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Tipo no serializable: {type(value).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    """Codifica a JSON con orjson, o con la librería estándar si no está disponible."""
+    if orjson is not None:
+        return orjson.dumps(content, default=_json_default)
+    return json.dumps(content, default=_json_default, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    """Respuesta JSON codificada con ``dumps``."""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
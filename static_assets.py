@@ -0,0 +1,160 @@
+"""
+Ficheros estáticos precomprimidos y con huella en el nombre.
+
+Al arrancar, ``StaticAssets`` lee el directorio ``static/`` una sola vez y
+para cada fichero:
+
+- calcula una huella del contenido y lo publica también como
+  ``nombre.<huella>.ext`` (por ejemplo ``styles.3f2a1b9c.css``). Esas URLs no
+  cambian mientras no cambie el contenido, así que se sirven con
+  ``Cache-Control: immutable`` y el navegador no vuelve a pedirlas;
+- reescribe en los HTML y CSS las referencias ``/static/<fichero>`` a la URL
+  con huella, de modo que un despliegue con un CSS nuevo cambia la URL;
+- guarda en memoria la versión brotli (calidad máxima) y gzip (nivel 9) si
+  son más pequeñas que el original.
+
+Las páginas HTML se piden por su nombre, así que se sirven con
+``Cache-Control: no-cache`` y un ETag: el navegador revalida en cada visita y
+recibe un 304 sin cuerpo si no han cambiado. La codificación se negocia con
+``Accept-Encoding`` igual que en ``compression.py``. Los cambios en
+``static/`` se ven al reiniciar el proceso.
+"""
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+from typing import Dict, Optional
+
+from starlette.datastructures import Headers
+from starlette.responses import PlainTextResponse, Response
+
+from compression import COMPRESSIBLE_TYPES, brotli, negotiate_encoding
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+# Ficheros cuyas referencias a /static/ se reescriben con la huella
+REWRITABLE_EXTENSIONS = (".html", ".css")
+
+_REFERENCE_RE = re.compile(r"(?<=/static/)([A-Za-z0-9_./-]+)")
+
+
+class Asset:
+    """Un fichero estático con sus versiones comprimidas."""
+
+    def __init__(self, name: str, body: bytes, content_type: str, precompress: bool):
+        self.name = name
+        self.content_type = content_type
+        digest = hashlib.sha256(body).hexdigest()
+        self.fingerprint = digest[:12]
+        stem, ext = os.path.splitext(name)
+        self.fingerprinted_name = f"{stem}.{self.fingerprint}{ext}"
+        self.bodies: Dict[Optional[str], bytes] = {None: body}
+        if precompress and content_type.startswith(COMPRESSIBLE_TYPES):
+            compressed = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                compressed["br"] = brotli.compress(body, quality=11)
+            for encoding, data in compressed.items():
+                if len(data) < len(body):
+                    self.bodies[encoding] = data
+
+    def etag(self, encoding: Optional[str]) -> str:
+        return f'"{self.fingerprint}-{encoding}"' if encoding else f'"{self.fingerprint}"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag[2:] == etag if tag.startswith("W/") else tag == etag for tag in candidates)
+
+
+class StaticAssets:
+    """Aplicación ASGI que sirve ``static/`` desde memoria (se monta en /static)."""
+
+    def __init__(self, directory: str, prefix: str = "/static", precompress: bool = True):
+        self.directory = directory
+        self.prefix = prefix.rstrip("/")
+        self.precompress = precompress
+        self.assets: Dict[str, Asset] = {}
+        # Nombre con huella -> asset (cacheable para siempre)
+        self.fingerprinted: Dict[str, Asset] = {}
+        self._load()
+
+    def _load(self):
+        names = []
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                path = os.path.join(root, filename)
+                names.append(os.path.relpath(path, self.directory).replace(os.sep, "/"))
+        # Primero lo que no referencia a nada, luego CSS y al final HTML,
+        # para que las huellas de lo referenciado ya existan al reescribir
+        order = {".css": 1, ".html": 2}
+        for name in sorted(names, key=lambda n: (order.get(os.path.splitext(n)[1], 0), n)):
+            with open(os.path.join(self.directory, name), "rb") as f:
+                body = f.read()
+            if name.endswith(REWRITABLE_EXTENSIONS):
+                body = self._rewrite_references(body)
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            asset = Asset(name, body, content_type, self.precompress)
+            self.assets[name] = asset
+            self.fingerprinted[asset.fingerprinted_name] = asset
+        logging.info(f"Ficheros estáticos cargados: {len(self.assets)} desde {self.directory}")
+
+    def _rewrite_references(self, body: bytes) -> bytes:
+        def replace(match):
+            asset = self.assets.get(match.group(1))
+            return asset.fingerprinted_name if asset else match.group(1)
+
+        return _REFERENCE_RE.sub(replace, body.decode("utf-8")).encode("utf-8")
+
+    def url(self, name: str) -> str:
+        """URL con huella de un fichero estático."""
+        return f"{self.prefix}/{self.assets[name].fingerprinted_name}"
+
+    def response(self, name: str, headers: Headers, method: str = "GET") -> Response:
+        """Respuesta para un fichero por su nombre lógico o con huella."""
+        asset = self.fingerprinted.get(name)
+        cache_control = IMMUTABLE_CACHE
+        if asset is None:
+            asset = self.assets.get(name)
+            cache_control = REVALIDATE_CACHE
+        if asset is None:
+            return PlainTextResponse("Not Found", status_code=404)
+
+        encoding = negotiate_encoding(headers.get("accept-encoding", ""))
+        if encoding not in asset.bodies:
+            encoding = None
+        response_headers = {
+            "ETag": asset.etag(encoding),
+            "Cache-Control": cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if_none_match = headers.get("if-none-match")
+        if if_none_match and _etag_matches(if_none_match, response_headers["ETag"]):
+            return Response(status_code=304, headers=response_headers)
+
+        body = asset.bodies[encoding]
+        if encoding:
+            response_headers["Content-Encoding"] = encoding
+        if method == "HEAD":
+            response_headers["Content-Length"] = str(len(body))
+            body = b""
+        return Response(body, media_type=asset.content_type, headers=response_headers)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        if scope["method"] not in ("GET", "HEAD"):
+            response = PlainTextResponse("Method Not Allowed", status_code=405, headers={"Allow": "GET, HEAD"})
+        else:
+            # Según la versión de Starlette, path trae o no el prefijo del montaje
+            path = scope["path"]
+            root_path = scope.get("root_path", "")
+            if root_path and path.startswith(root_path):
+                path = path[len(root_path):]
+            response = self.response(path.lstrip("/"), Headers(scope=scope), scope["method"])
+        await response(scope, receive, send)
@@ -0,0 +1,399 @@
+"""
+Telemetría de los lectores: latidos y métricas de escaneo agregadas en memoria.
+
+Los lectores envían por lotes (``POST /api/telemetry`` o la operación
+``telemetry`` del canal persistente) un latido con RSSI, memoria libre y
+tiempo encendido, y las métricas de los escaneos hechos desde el lote
+anterior (tiempo de detección, éxito o fallo). Nada de eso se guarda fila a
+fila en MySQL: cada máquina tiene un buffer circular de tamaño fijo
+(``deque(maxlen=buckets)``) con un resumen por intervalo de
+``bucket_seconds``:
+
+    [inicio, latidos, escaneos, fallos, suma ms detección, máx. ms detección,
+     RSSI mínimo, memoria libre mínima]
+
+así que la memoria por máquina está acotada y registrar un lote es O(escaneos).
+
+Un hilo publica cada ``publish_interval`` segundos una instantánea de sus
+máquinas en ``directory/telemetry-<pid>.json`` y lee las de los demás
+workers, que pueden haber recibido lotes de las mismas máquinas; con todas
+calcula el resumen de la flota (máquinas sin conexión, lentas, con fallos).
+``summary()`` devuelve ese resumen ya calculado, en tiempo constante.
+
+La instantánea de un worker que ya no la actualiza (reciclado, caído) la
+adopta el primer worker que la encuentra: la renombra, suma sus máquinas a
+las propias y la borra, de modo que el histórico sobrevive a los reinicios.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, Iterable, List, Optional
+
+# Posiciones de cada intervalo del buffer circular
+START, HEARTBEATS, SCANS, FAILURES, DETECT_SUM, DETECT_MAX, RSSI_MIN, HEAP_MIN = range(8)
+
+# Campos del último latido que se conservan tal cual
+HEARTBEAT_FIELDS = ("rssi", "free_heap", "uptime_s", "firmware")
+
+# Máquinas que se listan en cada categoría del resumen
+SUMMARY_TOP = 10
+
+SNAPSHOT_PREFIX = "telemetry-"
+
+
+def _min(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def _time(timestamp: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(timestamp) if timestamp is not None else None
+
+
+def _timed(entry: Optional[Dict]) -> Optional[Dict]:
+    """Copia de un último latido o error con ``at`` como fecha."""
+    return {**entry, "at": _time(entry["at"])} if entry else None
+
+
+def merge_bucket(into: List, other: List):
+    """Suma el intervalo ``other`` (mismo inicio) a ``into``."""
+    for i in (HEARTBEATS, SCANS, FAILURES, DETECT_SUM):
+        into[i] += other[i]
+    into[DETECT_MAX] = max(into[DETECT_MAX], other[DETECT_MAX])
+    into[RSSI_MIN] = _min(into[RSSI_MIN], other[RSSI_MIN])
+    into[HEAP_MIN] = _min(into[HEAP_MIN], other[HEAP_MIN])
+
+
+class DeviceTelemetry:
+    """Buffer circular de intervalos de una máquina."""
+
+    __slots__ = ("machine_id", "first_seen", "last_seen", "last", "last_error", "buckets")
+
+    def __init__(self, machine_id: str, buckets: int):
+        self.machine_id = machine_id
+        self.first_seen: Optional[float] = None
+        self.last_seen: Optional[float] = None
+        # Último latido y último error, con la hora a la que llegaron
+        self.last: Dict = {}
+        self.last_error: Optional[Dict] = None
+        self.buckets: Deque[List] = deque(maxlen=buckets)
+
+    def bucket(self, start: float) -> List:
+        if self.buckets and self.buckets[-1][START] >= start:
+            for bucket in reversed(self.buckets):
+                if bucket[START] == start:
+                    return bucket
+            # Escaneo atrasado sin intervalo propio: cuenta en el último
+            return self.buckets[-1]
+        bucket = [start, 0, 0, 0, 0.0, 0.0, None, None]
+        self.buckets.append(bucket)
+        return bucket
+
+    def to_snapshot(self) -> Dict:
+        return {
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "last": self.last,
+            "last_error": self.last_error,
+            "buckets": [list(bucket) for bucket in self.buckets],
+        }
+
+    def merge_snapshot(self, snapshot: Dict):
+        """Suma la instantánea de otro worker a esta máquina."""
+        self.first_seen = _min(self.first_seen, snapshot["first_seen"])
+        if self.last_seen is None or (snapshot["last_seen"] or 0) > self.last_seen:
+            self.last_seen = snapshot["last_seen"]
+        if snapshot["last"].get("at", 0) > self.last.get("at", 0):
+            self.last = snapshot["last"]
+        if snapshot["last_error"] and (
+            self.last_error is None or snapshot["last_error"]["at"] > self.last_error["at"]
+        ):
+            self.last_error = snapshot["last_error"]
+        merged = {bucket[START]: list(bucket) for bucket in self.buckets}
+        for bucket in snapshot["buckets"]:
+            if bucket[START] in merged:
+                merge_bucket(merged[bucket[START]], bucket)
+            else:
+                merged[bucket[START]] = list(bucket)
+        self.buckets = deque(
+            (merged[start] for start in sorted(merged)), maxlen=self.buckets.maxlen
+        )
+
+    def window(self, since: float) -> Dict:
+        """Totales de los intervalos que empiezan en ``since`` o después."""
+        scans = failures = heartbeats = 0
+        detect_sum = detect_max = 0.0
+        rssi_min = heap_min = None
+        for bucket in self.buckets:
+            if bucket[START] < since:
+                continue
+            heartbeats += bucket[HEARTBEATS]
+            scans += bucket[SCANS]
+            failures += bucket[FAILURES]
+            detect_sum += bucket[DETECT_SUM]
+            detect_max = max(detect_max, bucket[DETECT_MAX])
+            rssi_min = _min(rssi_min, bucket[RSSI_MIN])
+            heap_min = _min(heap_min, bucket[HEAP_MIN])
+        return {
+            "heartbeats": heartbeats,
+            "scans": scans,
+            "failures": failures,
+            "failure_rate": round(failures / scans, 4) if scans else 0.0,
+            "detect_ms_avg": round(detect_sum / scans, 1) if scans else None,
+            "detect_ms_max": detect_max if scans else None,
+            "rssi_min": rssi_min,
+            "free_heap_min": heap_min,
+        }
+
+
+class TelemetryAggregator:
+    """Telemetría de la flota agregada en memoria y compartida entre workers."""
+
+    def __init__(self, directory: str = "telemetry", bucket_seconds: int = 60, buckets: int = 60,
+                 offline_after: float = 180, summary_window: float = 900, publish_interval: float = 10):
+        self.directory = directory
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self.offline_after = offline_after
+        self.summary_window = summary_window
+        self.publish_interval = publish_interval
+        # Una instantánea sin actualizar durante este tiempo es de un worker que ya no está
+        self.stale_after = max(3 * publish_interval, 60)
+        self.path = os.path.join(directory, f"{SNAPSHOT_PREFIX}{os.getpid()}.json")
+        self._devices: Dict[str, DeviceTelemetry] = {}
+        self._lock = threading.Lock()
+        # Instantáneas de los demás workers: ruta -> (mtime, máquinas)
+        self._peers: Dict[str, tuple] = {}
+        # Resumen de la flota, recalculado en cada publicación
+        self._summary: Dict = self._build_summary({}, time.time())
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="telemetry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        try:
+            # La última instantánea la adopta otro worker o este mismo al reiniciar
+            self._write_snapshot()
+        except OSError as e:
+            logging.error(f"No se pudo guardar la telemetría: {e}")
+
+    def _loop(self):
+        while True:
+            try:
+                self.publish()
+            except Exception as e:
+                logging.error(f"Error publicando la telemetría: {e}")
+            if self._stop.wait(self.publish_interval):
+                break
+
+    def record(self, machine_id: str, heartbeat: Optional[Dict], scans: Iterable[Dict],
+               now: Optional[float] = None):
+        """Registra un lote de una máquina: latido opcional y escaneos ``{detect_ms, ok, error, age_s}``."""
+        now = time.time() if now is None else now
+        with self._lock:
+            device = self._devices.get(machine_id)
+            if device is None:
+                device = self._devices[machine_id] = DeviceTelemetry(machine_id, self.buckets)
+                device.first_seen = now
+            device.last_seen = now
+            if heartbeat is not None:
+                bucket = device.bucket(self._bucket_start(now))
+                bucket[HEARTBEATS] += 1
+                if heartbeat.get("rssi") is not None:
+                    bucket[RSSI_MIN] = _min(bucket[RSSI_MIN], heartbeat["rssi"])
+                if heartbeat.get("free_heap") is not None:
+                    bucket[HEAP_MIN] = _min(bucket[HEAP_MIN], heartbeat["free_heap"])
+                device.last = {
+                    "at": now,
+                    **{field: heartbeat.get(field) for field in HEARTBEAT_FIELDS},
+                }
+            for scan in scans:
+                at = now - scan.get("age_s", 0)
+                bucket = device.bucket(self._bucket_start(at))
+                bucket[SCANS] += 1
+                detect_ms = scan.get("detect_ms") or 0.0
+                bucket[DETECT_SUM] += detect_ms
+                bucket[DETECT_MAX] = max(bucket[DETECT_MAX], detect_ms)
+                if not scan.get("ok", True):
+                    bucket[FAILURES] += 1
+                    device.last_error = {"at": at, "error": scan.get("error")}
+
+    def _bucket_start(self, at: float) -> float:
+        return at - at % self.bucket_seconds
+
+    def summary(self) -> Dict:
+        """Resumen de la flota calculado en la última publicación."""
+        return self._summary
+
+    def device(self, machine_id: str) -> Optional[Dict]:
+        """Estado de una máquina con sus intervalos, sumando los de todos los workers."""
+        with self._lock:
+            local = self._devices.get(machine_id)
+            local = local.to_snapshot() if local is not None else None
+        snapshots = [local] if local is not None else []
+        snapshots += [devices[machine_id] for _, devices in self._peers.values() if machine_id in devices]
+        if not snapshots:
+            return None
+        device = DeviceTelemetry(machine_id, self.buckets)
+        for snapshot in snapshots:
+            device.merge_snapshot(snapshot)
+        now = time.time()
+        return {
+            **self._device_status(device, now),
+            "last_error": _timed(device.last_error),
+            "bucket_seconds": self.bucket_seconds,
+            "buckets": [
+                dict(zip(("start", "heartbeats", "scans", "failures", "detect_ms_sum",
+                          "detect_ms_max", "rssi_min", "free_heap_min"), (_time(bucket[START]), *bucket[1:])))
+                for bucket in device.buckets
+            ],
+        }
+
+    def publish(self, now: Optional[float] = None):
+        """Escribe la instantánea propia, lee las de los demás y recalcula el resumen."""
+        now = time.time() if now is None else now
+        os.makedirs(self.directory, exist_ok=True)
+        self._adopt_stale(now)
+        self._write_snapshot()
+        self._read_peers()
+        with self._lock:
+            snapshots = [{m: d.to_snapshot() for m, d in self._devices.items()}]
+        snapshots += [devices for _, devices in self._peers.values()]
+        fleet: Dict[str, DeviceTelemetry] = {}
+        for devices in snapshots:
+            for machine_id, snapshot in devices.items():
+                device = fleet.get(machine_id)
+                if device is None:
+                    device = fleet[machine_id] = DeviceTelemetry(machine_id, self.buckets)
+                device.merge_snapshot(snapshot)
+        self._summary = self._build_summary(fleet, now)
+
+    def _write_snapshot(self):
+        with self._lock:
+            devices = {m: d.to_snapshot() for m, d in self._devices.items()}
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"pid": os.getpid(), "devices": devices}, f)
+        os.replace(tmp_path, self.path)
+
+    def _snapshot_paths(self) -> List[str]:
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [
+            os.path.join(self.directory, name) for name in names
+            if name.startswith(SNAPSHOT_PREFIX) and name.endswith(".json")
+        ]
+
+    def _read_peers(self):
+        peers = {}
+        for path in self._snapshot_paths():
+            if path == self.path:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+                cached = self._peers.get(path)
+                if cached is not None and cached[0] == mtime:
+                    peers[path] = cached
+                    continue
+                with open(path) as f:
+                    peers[path] = (mtime, json.load(f)["devices"])
+            except (OSError, ValueError, KeyError) as e:
+                # Borrada o adoptada entre listdir y open, o a medio escribir
+                logging.debug(f"Instantánea de telemetría {path} ignorada: {e}")
+        self._peers = peers
+
+    def _adopt_stale(self, now: float):
+        for path in self._snapshot_paths():
+            if path == self.path:
+                continue
+            try:
+                if now - os.stat(path).st_mtime < self.stale_after:
+                    continue
+                # Solo un worker consigue renombrarla
+                claimed = f"{path}.{os.getpid()}.adopt"
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            try:
+                with open(claimed) as f:
+                    devices = json.load(f)["devices"]
+                with self._lock:
+                    for machine_id, snapshot in devices.items():
+                        device = self._devices.get(machine_id)
+                        if device is None:
+                            device = self._devices[machine_id] = DeviceTelemetry(machine_id, self.buckets)
+                        device.merge_snapshot(snapshot)
+                logging.info(f"Telemetría adoptada de {path}: {len(devices)} máquinas")
+            except (OSError, ValueError, KeyError) as e:
+                logging.error(f"No se pudo adoptar la telemetría de {path}: {e}")
+            finally:
+                try:
+                    os.remove(claimed)
+                except OSError:
+                    pass
+
+    def _device_status(self, device: DeviceTelemetry, now: float) -> Dict:
+        return {
+            "machine_id": device.machine_id,
+            "online": device.last_seen is not None and now - device.last_seen < self.offline_after,
+            "first_seen": _time(device.first_seen),
+            "last_seen": _time(device.last_seen),
+            "last_heartbeat": _timed(device.last),
+            **device.window(self._bucket_start(now - self.summary_window)),
+        }
+
+    def _build_summary(self, fleet: Dict[str, DeviceTelemetry], now: float) -> Dict:
+        statuses = [self._device_status(device, now) for device in fleet.values()]
+        active = [s for s in statuses if s["scans"]]
+        scans = sum(s["scans"] for s in active)
+        failures = sum(s["failures"] for s in active)
+        detect_sum = sum(s["detect_ms_avg"] * s["scans"] for s in active)
+        offline = sorted((s for s in statuses if not s["online"]), key=lambda s: s["last_seen"])
+
+        def brief(status: Dict) -> Dict:
+            return {k: status[k] for k in (
+                "machine_id", "last_seen", "scans", "failures", "failure_rate",
+                "detect_ms_avg", "rssi_min", "free_heap_min"
+            )}
+
+        def worst(candidates: List[Dict], key: str, reverse: bool = True) -> List[Dict]:
+            ranked = sorted((s for s in candidates if s[key] is not None), key=lambda s: s[key], reverse=reverse)
+            return [brief(s) for s in ranked[:SUMMARY_TOP]]
+
+        return {
+            "generated_at": _time(now),
+            "window_seconds": self.summary_window,
+            "devices": len(statuses),
+            "online": len(statuses) - len(offline),
+            "offline": len(offline),
+            "scans": scans,
+            "failures": failures,
+            "failure_rate": round(failures / scans, 4) if scans else 0.0,
+            "detect_ms_avg": round(detect_sum / scans, 1) if scans else None,
+            "offline_devices": [brief(s) for s in offline[:SUMMARY_TOP]],
+            "slowest": worst(active, "detect_ms_avg"),
+            "most_failures": worst([s for s in active if s["failures"]], "failure_rate"),
+            "weakest_signal": worst(statuses, "rssi_min", reverse=False),
+            "lowest_heap": worst(statuses, "free_heap_min", reverse=False),
+        }
@@ -0,0 +1,217 @@
+"""
+Pruebas de la repetición de respuestas del canal de lectores entre workers:
+dos ``DeviceIngestServer`` comparten un ``DeviceReplyStore``, como dos
+workers de gunicorn con el mismo puerto, y el reintento de un canje llega al
+segundo. MySQL se sustituye por SQLite con una capa que traduce los
+parámetros ``%s`` y los errores de clave duplicada.
+"""
+
+import asyncio
+import sqlite3
+import threading
+
+import mysql.connector
+from mysql.connector import errorcode
+from fastapi import HTTPException
+
+from device_auth import DeviceKey
+from device_ingest import DeviceIngestServer, encode_message, read_message
+from device_replies import DeviceReplyStore
+
+
+class SQLiteMySQL:
+    """Base de datos con la tabla device_replies, compartida entre hilos."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        db = self.connect()
+        db.raw.execute(
+            'CREATE TABLE device_replies (machine_id TEXT, seq INTEGER, qrcode_id TEXT, response TEXT, '
+            'claimed_at TIMESTAMP, PRIMARY KEY (machine_id, seq, qrcode_id))'
+        )
+        db.commit()
+        db.close()
+
+    def connect(self):
+        return SQLiteConnection(sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES))
+
+    def rows(self):
+        db = sqlite3.connect(self.path)
+        try:
+            return db.execute('SELECT machine_id, seq, qrcode_id, response FROM device_replies').fetchall()
+        finally:
+            db.close()
+
+
+class SQLiteConnection:
+    def __init__(self, raw):
+        self.raw = raw
+
+    def cursor(self):
+        return SQLiteCursor(self.raw.cursor())
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self.raw.close()
+
+
+class SQLiteCursor:
+    def __init__(self, raw):
+        self.raw = raw
+
+    def execute(self, sql, params=()):
+        try:
+            self.raw.execute(sql.replace("%s", "?"), tuple(params))
+        except sqlite3.IntegrityError as e:
+            raise mysql.connector.IntegrityError(msg=str(e), errno=errorcode.ER_DUP_ENTRY)
+
+    def fetchone(self):
+        return self.raw.fetchone()
+
+    @property
+    def rowcount(self):
+        return self.raw.rowcount
+
+    def close(self):
+        self.raw.close()
+
+
+class Codes:
+    """redeem_code reducido: el segundo canje de la misma máquina da 409."""
+
+    def __init__(self, *codes):
+        self.redeemed = {}
+        self.valid = set(codes)
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.release = None
+
+    async def redeem(self, device: DeviceKey, message):
+        self.calls += 1
+        if self.release is not None:
+            await self.release.wait()
+        qrcode_id = message["qrcode_id"]
+        with self.lock:
+            if self.redeemed.get(qrcode_id) == device.machine_id:
+                raise HTTPException(status_code=409, detail="El código ya fue canjeado por esta máquina")
+            if qrcode_id not in self.valid:
+                raise HTTPException(status_code=400, detail="QR code cannot be exchanged")
+            self.valid.discard(qrcode_id)
+            self.redeemed[qrcode_id] = device.machine_id
+        return {"status": "success", "message": "QR code exchanged successfully"}
+
+
+def authenticate(key, machine_id):
+    return DeviceKey("k1", machine_id, b"", None)
+
+
+def make_server(codes: Codes, store: DeviceReplyStore) -> DeviceIngestServer:
+    return DeviceIngestServer(authenticate, {"redeem": codes.redeem}, host="127.0.0.1", port=0,
+                              reply_store=store, replay_poll=0.01)
+
+
+async def start(server: DeviceIngestServer) -> int:
+    await server.start()
+    return server._server.sockets[0].getsockname()[1]
+
+
+async def exchange(port: int, *messages):
+    """Abre una conexión nueva (como un lector que se reconecta) y devuelve las respuestas."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(encode_message({"seq": 1, "op": "hello", "key": "k1.x", "machine_id": "M1"}))
+        assert (await read_message(reader, 16384))["ok"]
+        for message in messages:
+            writer.write(encode_message(message))
+        await writer.drain()
+        return [await read_message(reader, 16384) for _ in messages]
+    finally:
+        writer.close()
+
+
+def test_retry_on_other_worker_gets_stored_reply(tmp_path):
+    async def scenario():
+        store = DeviceReplyStore(SQLiteMySQL(tmp_path / "db.sqlite").connect)
+        codes = Codes("ABC123")
+        first, second = make_server(codes, store), make_server(codes, store)
+        port_a, port_b = await start(first), await start(second)
+        try:
+            [original] = await exchange(port_a, {"seq": 41, "op": "redeem", "qrcode_id": "ABC123"})
+            # La respuesta se perdió: el lector se reconecta y cae en el otro worker
+            [retry] = await exchange(port_b, {"seq": 41, "op": "redeem", "qrcode_id": "ABC123"})
+        finally:
+            await first.stop()
+            await second.stop()
+        return codes, original, retry, second
+
+    codes, original, retry, second = asyncio.run(scenario())
+    assert original["status"] == 200
+    assert retry == original
+    assert codes.calls == 1
+    assert second.replayed == 1
+
+
+def test_retry_waits_for_redeem_in_progress_on_other_worker(tmp_path):
+    async def scenario():
+        store = DeviceReplyStore(SQLiteMySQL(tmp_path / "db.sqlite").connect)
+        codes = Codes("ABC123")
+        codes.release = asyncio.Event()
+        first, second = make_server(codes, store), make_server(codes, store)
+        port_a, port_b = await start(first), await start(second)
+        try:
+            message = {"seq": 7, "op": "redeem", "qrcode_id": "ABC123"}
+            original = asyncio.create_task(exchange(port_a, message))
+            while codes.calls == 0:
+                await asyncio.sleep(0.01)
+            retry = asyncio.create_task(exchange(port_b, message))
+            await asyncio.sleep(0.1)
+            assert not retry.done()
+            codes.release.set()
+            return codes, (await original)[0], (await retry)[0]
+        finally:
+            await first.stop()
+            await second.stop()
+
+    codes, original, retry = asyncio.run(scenario())
+    assert original["status"] == retry["status"] == 200
+    assert codes.calls == 1
+
+
+def test_new_seq_and_other_code_are_not_replayed(tmp_path):
+    async def scenario():
+        store = DeviceReplyStore(SQLiteMySQL(tmp_path / "db.sqlite").connect)
+        codes = Codes("ABC123", "XYZ789")
+        first, second = make_server(codes, store), make_server(codes, store)
+        port_a, port_b = await start(first), await start(second)
+        try:
+            await exchange(port_a, {"seq": 3, "op": "redeem", "qrcode_id": "ABC123"})
+            # Un lector reiniciado que vuelve a usar el seq 3 con otro código
+            [other] = await exchange(port_b, {"seq": 3, "op": "redeem", "qrcode_id": "XYZ789"})
+            # Un canje nuevo del mismo código sí es un "ya canjeado"
+            [again] = await exchange(port_b, {"seq": 4, "op": "redeem", "qrcode_id": "ABC123"})
+        finally:
+            await first.stop()
+            await second.stop()
+        return other, again
+
+    other, again = asyncio.run(scenario())
+    assert other["status"] == 200
+    assert again["status"] == 409
+
+
+def test_server_errors_are_released(tmp_path):
+    server_db = SQLiteMySQL(tmp_path / "db.sqlite")
+    store = DeviceReplyStore(server_db.connect)
+    key = ("M1", 9, "ABC123")
+    assert store.claim(key)[0] == "claimed"
+    assert store.claim(key)[0] == "pending"
+    store.release(key)
+    assert store.claim(key)[0] == "claimed"
+    store.save(key, {"ok": True, "status": 200})
+    assert store.claim(key) == ("done", {"ok": True, "status": 200})
+    assert len(server_db.rows()) == 1
@@ -0,0 +1,265 @@
+"""
+Pruebas del journal de canjes: commit en grupo, aplicación a MySQL con marca
+de agua y recuperación tras una caída entre el commit de MySQL y el marcado
+del journal. MySQL se sustituye por ``FakeMySQL``, que entiende solo las
+consultas de ``RedemptionFlusher`` y confirma o descarta cada transacción
+entera.
+"""
+
+import copy
+import re
+import threading
+from datetime import date
+
+import pytest
+
+from redemption_journal import APPLIED, CONFLICT, PENDING, RedemptionFlusher, RedemptionJournal
+
+
+class FakeMySQL:
+    """Estado de qr_codes, qr_codes_archive, el contador de cambios y la marca de agua."""
+
+    def __init__(self, codes):
+        self.state = {
+            "codes": {qrcode_id: {"state": state, "creation_date": date(2026, 1, 1), "used_date": None,
+                                  "redeemed_machine_id": None, "change_seq": 0, "site_id": "S1"}
+                      for qrcode_id, state in codes.items()},
+            "archive": {},
+            "counter": 0,
+            "watermarks": {},
+        }
+        self.redeem_updates = 0
+
+    def connect(self):
+        return FakeConnection(self)
+
+    def archive(self, qrcode_id):
+        self.state["archive"][qrcode_id] = self.state["codes"].pop(qrcode_id)
+
+
+class FakeConnection:
+    def __init__(self, server: FakeMySQL):
+        self.server = server
+        self.tx = None
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def data(self):
+        if self.tx is None:
+            self.tx = copy.deepcopy(self.server.state)
+        return self.tx
+
+    def commit(self):
+        if self.tx is not None:
+            self.server.state = self.tx
+            self.tx = None
+
+    def rollback(self):
+        self.tx = None
+
+    def close(self):
+        self.tx = None
+
+
+class FakeCursor:
+    def __init__(self, conn: FakeConnection):
+        self.conn = conn
+        self.rows = []
+        self.rowcount = 0
+
+    def execute(self, query, params=()):
+        data = self.conn.data()
+        params = list(params)
+        query = " ".join(query.split())
+        if query.startswith("SELECT last_entry FROM qr_redemption_watermark"):
+            last = data["watermarks"].get(params[0])
+            self.rows = [(last,)] if last is not None else []
+        elif query.startswith("SELECT qrcode_id FROM qr_codes WHERE"):
+            half = len(params) // 2
+            self.rows = [(i,) for i in params[:half] if data["codes"].get(i, {}).get("state") == "usado"]
+            if "qr_codes_archive" in query:
+                self.rows += [(i,) for i in params[half:] if data["archive"].get(i, {}).get("state") == "usado"]
+        elif query.startswith("SELECT qrcode_id, creation_date, site_id, machine_id FROM qr_codes"):
+            self.rows = [(i, data["codes"][i]["creation_date"], data["codes"][i]["site_id"], None) for i in params
+                         if data["codes"].get(i, {}).get("state") == "valido"]
+        elif query.startswith('UPDATE qr_codes SET state = "usado"'):
+            count = len(re.findall("WHEN", query)) // 2
+            dates = dict(zip(params[0:2 * count:2], params[1:2 * count:2]))
+            machines = dict(zip(params[2 * count:4 * count:2], params[2 * count + 1:4 * count:2]))
+            for qrcode_id in params[4 * count:]:
+                data["codes"][qrcode_id].update(state="usado", used_date=dates[qrcode_id],
+                                                redeemed_machine_id=machines[qrcode_id])
+            self.conn.server.redeem_updates += 1
+        elif query.startswith("UPDATE qr_change_counter"):
+            data["counter"] += params[0]
+        elif query.startswith("SELECT LAST_INSERT_ID()"):
+            self.rows = [(data["counter"],)]
+        elif query.startswith("UPDATE qr_codes SET change_seq"):
+            pass
+        elif query.startswith("INSERT INTO qr_redemption_watermark"):
+            data["watermarks"][params[0]] = params[1]
+        else:
+            raise AssertionError(f"Consulta inesperada: {query}")
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = RedemptionJournal(str(tmp_path / "journal.db"))
+    yield journal
+    journal.close()
+
+
+def flusher_for(mysql: FakeMySQL, journal: RedemptionJournal) -> RedemptionFlusher:
+    return RedemptionFlusher(mysql.connect, journal, batch_size=2, journal_name="test")
+
+
+def flush(flusher: RedemptionFlusher):
+    report = {"rows": 0, "batches": 0}
+    flusher.run(report)
+    return report
+
+
+def test_group_commit_batches_queued_appends(journal):
+    groups = []
+    first_commit = threading.Event()
+    release = threading.Event()
+    commit_group = journal._commit_group
+
+    def recording_commit(conn, group):
+        groups.append(len(group))
+        if len(groups) == 1:
+            # El primer fsync tarda: lo que llega mientras tanto va en un solo commit
+            first_commit.set()
+            release.wait(5)
+        commit_group(conn, group)
+
+    journal._commit_group = recording_commit
+    futures = [journal.append("A0", 5.0, "VM1")]
+    assert first_commit.wait(5)
+    futures += [journal.append(f"A{i}", 5.0, "VM1") for i in range(1, 50)]
+    # El mismo código dos veces en el mismo grupo: solo vale el primero
+    futures.append(journal.append("A1", 5.0, "VM2"))
+    release.set()
+
+    results = [future.result(timeout=5) for future in futures]
+    assert results == [True] * 50 + [False]
+    assert groups == [1, 50]
+    assert journal.counts() == {PENDING: 50}
+    assert journal.redeemed_by("A1") == "VM1"
+
+
+def test_flush_applies_batches_and_advances_watermark(journal):
+    mysql = FakeMySQL({"A": "valido", "B": "valido", "C": "valido"})
+    for qrcode_id in ("A", "B", "C"):
+        assert journal.append(qrcode_id, 5.0, "VM1").result(timeout=5)
+
+    report = flush(flusher_for(mysql, journal))
+
+    assert report == {"rows": 3, "batches": 2}
+    assert {i: c["state"] for i, c in mysql.state["codes"].items()} == {"A": "usado", "B": "usado", "C": "usado"}
+    assert mysql.state["codes"]["B"]["redeemed_machine_id"] == "VM1"
+    assert mysql.state["watermarks"]["test"] == 3
+    assert mysql.state["counter"] == 3
+    assert journal.counts() == {APPLIED: 3}
+    assert journal.pending_redemptions(["A", "B", "C"]) == {}
+
+
+def test_redeemed_events_carry_the_code_scope(journal, monkeypatch):
+    published = []
+    monkeypatch.setattr("redemption_journal.broker.publish",
+                        lambda event, data, event_id=None: published.append((event, data)))
+    mysql = FakeMySQL({"A": "valido"})
+    journal.append("A", 5.0, "VM1").result(timeout=5)
+
+    flush(flusher_for(mysql, journal))
+
+    [(event, data)] = published
+    assert event == "redeemed"
+    assert (data["site_id"], data["machine_id"], data["redeemed_machine_id"]) == ("S1", None, "VM1")
+
+
+def test_changed_state_is_recorded_as_conflict(journal):
+    mysql = FakeMySQL({"A": "valido", "B": "invalidado"})
+    journal.append("A", 5.0).result(timeout=5)
+    journal.append("B", 5.0).result(timeout=5)
+
+    flush(flusher_for(mysql, journal))
+
+    assert journal.counts() == {APPLIED: 1, CONFLICT: 1}
+    assert mysql.state["codes"]["B"]["state"] == "invalidado"
+
+
+def crash_after_mysql_commit(journal: RedemptionJournal):
+    """El proceso muere tras el commit de MySQL y antes de marcar el journal."""
+    mark = journal.mark
+
+    def failing_mark(entry_ids, status, detail=None):
+        if entry_ids and status == APPLIED:
+            journal.mark = mark
+            raise RuntimeError("caída simulada")
+        mark(entry_ids, status, detail)
+
+    journal.mark = failing_mark
+
+
+def test_watermark_replay_does_not_apply_twice(journal):
+    mysql = FakeMySQL({"A": "valido", "B": "valido"})
+    journal.append("A", 5.0, "VM1").result(timeout=5)
+    journal.append("B", 5.0, "VM1").result(timeout=5)
+    crash_after_mysql_commit(journal)
+
+    with pytest.raises(RuntimeError):
+        flush(flusher_for(mysql, journal))
+    assert mysql.state["watermarks"]["test"] == 2
+    assert journal.counts() == {PENDING: 2}
+    # Mientras tanto las consultas ya ven los códigos como canjeados
+    assert set(journal.pending_redemptions(["A", "B"])) == {"A", "B"}
+
+    report = flush(flusher_for(mysql, journal))
+
+    assert report["rows"] == 0
+    assert mysql.redeem_updates == 1
+    assert mysql.state["counter"] == 2
+    assert journal.counts() == {APPLIED: 2}
+
+
+def test_recovery_finds_rows_already_archived(journal):
+    mysql = FakeMySQL({"A": "valido", "B": "valido"})
+    journal.append("A", 5.0).result(timeout=5)
+    journal.append("B", 5.0).result(timeout=5)
+    crash_after_mysql_commit(journal)
+    with pytest.raises(RuntimeError):
+        flush(flusher_for(mysql, journal))
+    # El Archiver mueve la fila antes de que el flusher vuelva a arrancar
+    mysql.archive("A")
+
+    flush(flusher_for(mysql, journal))
+
+    assert journal.counts() == {APPLIED: 2}
+
+
+def test_pending_entries_survive_restart(tmp_path):
+    path = str(tmp_path / "journal.db")
+    journal = RedemptionJournal(path)
+    assert journal.append("A", 5.0, "VM1").result(timeout=5)
+    journal.close()
+
+    reopened = RedemptionJournal(path)
+    try:
+        assert reopened.append("A", 5.0, "VM2").result(timeout=5) is False
+        mysql = FakeMySQL({"A": "valido"})
+        flush(flusher_for(mysql, reopened))
+        assert mysql.state["codes"]["A"]["redeemed_machine_id"] == "VM1"
+        assert reopened.counts() == {APPLIED: 1}
+    finally:
+        reopened.close()
@@ -0,0 +1,343 @@
+"""
+Comprueba que una copia de seguridad (volcado completo + segmentos de binlog)
+se puede restaurar.
+
+1. Verifica el sha256 de cada fichero contra su manifiesto y que los
+   segmentos de binlog sean consecutivos desde la posición del volcado.
+2. Restaura el volcado en una instancia MySQL de pruebas (nunca en la de
+   producción) y aplica con mysqlbinlog los segmentos anteriores a
+   ``stats_binlog_file``.
+3. Compara el número de filas y el checksum de cada tabla con los del
+   manifiesto del volcado. backup-mysql.sh los toma de una instantánea
+   abierta justo al empezar ese fichero de binlog, así que deben coincidir
+   exactamente.
+4. Aplica el resto de segmentos, que solo se comprueban por sha256 y
+   continuidad.
+
+Uso:
+    python verify_backup.py [--backups ./backups] [--full FICHERO] [--no-binlogs]
+                            [--hash-only] [--drop-existing]
+
+La instancia de pruebas se configura con SCRATCH_DB_HOST, SCRATCH_DB_PORT,
+SCRATCH_DB_USER y SCRATCH_DB_PASSWORD. Necesita los clientes mysql y
+mysqlbinlog (y zstd si las copias están comprimidas con zstd).
+"""
+
+import argparse
+import glob
+import gzip
+import hashlib
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+import mysql.connector
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+DB_NAME = os.getenv("DB_NAME", "waterDB")
+
+SCRATCH_CONFIG = {
+    "host": os.getenv("SCRATCH_DB_HOST", "127.0.0.1"),
+    "port": int(os.getenv("SCRATCH_DB_PORT", "3307")),
+    "user": os.getenv("SCRATCH_DB_USER", "root"),
+    "password": os.getenv("SCRATCH_DB_PASSWORD", ""),
+}
+
+
+class Manifest:
+    """Contenido de un fichero <copia>.manifest escrito por backup-mysql.sh."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.values: Dict[str, str] = {}
+        # tabla -> (filas, checksum)
+        self.tables: Dict[str, Tuple[int, Optional[int]]] = {}
+        with open(path) as f:
+            for line in f:
+                key, _, value = line.strip().partition("=")
+                if key == "table":
+                    name, rows, checksum = (value.split() + ["", ""])[:3]
+                    self.tables[name] = (int(rows), int(checksum) if checksum.isdigit() else None)
+                elif key:
+                    self.values[key] = value
+
+    @property
+    def kind(self) -> str:
+        return self.values["type"]
+
+    @property
+    def data_path(self) -> str:
+        return os.path.join(os.path.dirname(self.path), self.values["file"])
+
+    @property
+    def binlog_file(self) -> str:
+        return self.values["binlog_file"]
+
+    @property
+    def stats_binlog_file(self) -> Optional[str]:
+        """Fichero de binlog en cuyo inicio se tomaron las estadísticas (solo volcados)."""
+        return self.values.get("stats_binlog_file")
+
+
+def binlog_number(name: str) -> int:
+    return int(re.search(r"(\d+)$", name).group(1))
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def open_decompressed(path: str):
+    """Devuelve un fichero binario con el contenido descomprimido."""
+    if path.endswith(".zst"):
+        return subprocess.Popen(["zstd", "-dc", path], stdout=subprocess.PIPE).stdout
+    return gzip.open(path, "rb")
+
+
+def load_manifests(backups_dir: str) -> List[Manifest]:
+    return [Manifest(path) for path in sorted(glob.glob(os.path.join(backups_dir, "*.manifest")))]
+
+
+def select_chain(manifests: List[Manifest], full_name: Optional[str], with_binlogs: bool) -> List[Manifest]:
+    """
+    Volcado completo elegido (el más reciente por defecto) y los binlogs que
+    lo siguen. Sin with_binlogs, solo los necesarios para llegar a la
+    instantánea de las estadísticas.
+    """
+    fulls = [m for m in manifests if m.kind == "full"]
+    if full_name:
+        fulls = [m for m in fulls if m.values["file"] == os.path.basename(full_name)]
+    if not fulls:
+        raise SystemExit("No se ha encontrado ningún volcado completo")
+    full = max(fulls, key=lambda m: m.values["created"])
+    start = binlog_number(full.binlog_file)
+    segments = sorted(
+        (m for m in manifests if m.kind == "binlog" and binlog_number(m.binlog_file) >= start),
+        key=lambda m: binlog_number(m.binlog_file)
+    )
+    if not with_binlogs:
+        stats_number = binlog_number(full.stats_binlog_file) if full.stats_binlog_file else start
+        segments = [m for m in segments if binlog_number(m.binlog_file) < stats_number]
+    return [full] + segments
+
+
+def split_at_stats(full: Manifest, segments: List[Manifest]) -> Tuple[List[Manifest], List[Manifest]]:
+    """Segmentos anteriores a la instantánea de las estadísticas y el resto."""
+    stats_number = binlog_number(full.stats_binlog_file)
+    before = [m for m in segments if binlog_number(m.binlog_file) < stats_number]
+    return before, segments[len(before):]
+
+
+def check_chain(chain: List[Manifest]) -> List[str]:
+    """Comprueba hashes y continuidad; devuelve la lista de errores."""
+    errors = []
+    expected = binlog_number(chain[0].binlog_file)
+    for manifest in chain:
+        path = manifest.data_path
+        if not os.path.exists(path):
+            errors.append(f"Falta el fichero {path}")
+            continue
+        actual = sha256_file(path)
+        if actual != manifest.values["sha256"]:
+            errors.append(f"sha256 distinto en {path}")
+        else:
+            logging.info(f"sha256 correcto: {manifest.values['file']}")
+        if manifest.kind == "binlog":
+            number = binlog_number(manifest.binlog_file)
+            if number != expected:
+                errors.append(f"Faltan segmentos de binlog entre {expected} y {number}")
+            expected = number + 1
+    return errors
+
+
+def segments_missing(full: Manifest, segments: List[Manifest]) -> bool:
+    """True si la cadena no llega hasta el fichero de las estadísticas."""
+    needed = binlog_number(full.stats_binlog_file) - 1
+    last = binlog_number(segments[-1].binlog_file) if segments else binlog_number(full.binlog_file) - 1
+    return last < needed
+
+
+def mysql_client_args() -> List[str]:
+    return ["mysql", "-h", SCRATCH_CONFIG["host"], "-P", str(SCRATCH_CONFIG["port"]), "-u", SCRATCH_CONFIG["user"]]
+
+
+def client_env() -> Dict[str, str]:
+    env = dict(os.environ)
+    env["MYSQL_PWD"] = SCRATCH_CONFIG["password"]
+    return env
+
+
+def pipe_into_mysql(source) -> None:
+    """Envía un flujo SQL al cliente mysql de la instancia de pruebas."""
+    process = subprocess.Popen(mysql_client_args(), stdin=subprocess.PIPE, env=client_env())
+    try:
+        shutil.copyfileobj(source, process.stdin, 1024 * 1024)
+    finally:
+        process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError("El cliente mysql ha terminado con error")
+
+
+def prepare_scratch(drop_existing: bool) -> None:
+    db = mysql.connector.connect(**SCRATCH_CONFIG)
+    cursor = db.cursor()
+    try:
+        cursor.execute("SHOW DATABASES LIKE %s", (DB_NAME,))
+        if cursor.fetchone():
+            if not drop_existing:
+                raise SystemExit(
+                    f"La base de datos {DB_NAME} ya existe en la instancia de pruebas; "
+                    "use --drop-existing para reemplazarla"
+                )
+            cursor.execute(f"DROP DATABASE `{DB_NAME}`")
+    finally:
+        cursor.close()
+        db.close()
+
+
+def restore_full(manifest: Manifest) -> None:
+    logging.info(f"Restaurando {manifest.values['file']}...")
+    with open_decompressed(manifest.data_path) as source:
+        pipe_into_mysql(source)
+
+
+def apply_binlogs(segments: List[Manifest], start_position: Optional[str] = None) -> None:
+    """Aplica los segmentos en orden, el primero desde start_position si se indica."""
+    if not segments:
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for manifest in segments:
+            target = os.path.join(tmp, manifest.binlog_file)
+            with open_decompressed(manifest.data_path) as source, open(target, "wb") as out:
+                shutil.copyfileobj(source, out, 1024 * 1024)
+            files.append(target)
+        logging.info(
+            f"Aplicando {len(files)} segmentos de binlog desde "
+            f"{segments[0].binlog_file}:{start_position or 'inicio'}"
+        )
+        # --start-position solo afecta al primer fichero
+        options = [f"--start-position={start_position}"] if start_position else []
+        binlog = subprocess.Popen(
+            ["mysqlbinlog", *options, f"--database={DB_NAME}", *files],
+            stdout=subprocess.PIPE
+        )
+        try:
+            pipe_into_mysql(binlog.stdout)
+        finally:
+            binlog.stdout.close()
+        if binlog.wait() != 0:
+            raise RuntimeError("mysqlbinlog ha terminado con error")
+
+
+def table_stats_sql(table: str, columns: List[str]) -> str:
+    """Filas y checksum de una tabla, calculados igual que en backup-mysql.sh."""
+    names = ", ".join(f"`{column}`" for column in columns)
+    nulls = ", ".join(f"ISNULL(`{column}`)" for column in columns)
+    return f"SELECT COUNT(*), COALESCE(BIT_XOR(CRC32(CONCAT_WS('#', {names}, CONCAT({nulls})))), 0) FROM `{table}`"
+
+
+def scratch_stats(tables: List[str]) -> Dict[str, Tuple[Optional[int], Optional[int]]]:
+    db = mysql.connector.connect(database=DB_NAME, **SCRATCH_CONFIG)
+    cursor = db.cursor()
+    stats = {}
+    try:
+        cursor.execute(
+            "SELECT c.TABLE_NAME, c.COLUMN_NAME FROM information_schema.COLUMNS c "
+            "JOIN information_schema.TABLES t ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME "
+            "WHERE c.TABLE_SCHEMA = %s AND t.TABLE_TYPE = 'BASE TABLE' "
+            "ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION",
+            (DB_NAME,)
+        )
+        columns: Dict[str, List[str]] = {}
+        for table, column in cursor.fetchall():
+            columns.setdefault(table, []).append(column)
+        for table in tables:
+            if table not in columns:
+                stats[table] = (None, None)
+                continue
+            cursor.execute(table_stats_sql(table, columns[table]))
+            rows, checksum = cursor.fetchone()
+            stats[table] = (rows, int(checksum))
+    finally:
+        cursor.close()
+        db.close()
+    return stats
+
+
+def compare(expected: Manifest, stats) -> List[str]:
+    """Compara filas y checksums; devuelve la lista de errores."""
+    errors = []
+    print(f"{'Tabla':<24} {'Esperadas':>10} {'Restauradas':>12}  Checksum")
+    for table, (rows, checksum) in sorted(expected.tables.items()):
+        restored_rows, restored_checksum = stats[table]
+        if restored_rows is None:
+            errors.append(f"Falta la tabla {table}")
+            print(f"{table:<24} {rows:>10} {'-':>12}  -")
+            continue
+        same_checksum = checksum is None or checksum == restored_checksum
+        print(f"{table:<24} {rows:>10} {restored_rows:>12}  {'ok' if same_checksum else 'distinto'}")
+        if restored_rows != rows:
+            errors.append(f"{table}: {restored_rows} filas restauradas, {rows} esperadas")
+        if not same_checksum:
+            errors.append(f"{table}: checksum distinto")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verifica que una copia de seguridad se puede restaurar")
+    parser.add_argument("--backups", default="./backups", help="Directorio de las copias")
+    parser.add_argument("--full", help="Volcado completo a verificar (por defecto el más reciente)")
+    parser.add_argument("--no-binlogs", action="store_true",
+                        help="Aplicar solo los binlogs necesarios para comparar las tablas")
+    parser.add_argument("--hash-only", action="store_true", help="Comprobar solo los sha256, sin restaurar")
+    parser.add_argument("--drop-existing", action="store_true",
+                        help="Reemplazar la base de datos si ya existe en la instancia de pruebas")
+    args = parser.parse_args()
+
+    chain = select_chain(load_manifests(args.backups), args.full, not args.no_binlogs)
+    full, segments = chain[0], chain[1:]
+    logging.info(f"Volcado {full.values['file']} con {len(segments)} segmentos de binlog")
+
+    errors = check_chain(chain)
+    if full.stats_binlog_file is None:
+        logging.warning("El manifiesto del volcado no tiene estadísticas de tablas; no se compararán")
+    elif segments_missing(full, segments):
+        errors.append(f"Faltan los segmentos de binlog anteriores a {full.stats_binlog_file}")
+    if not errors and not args.hash_only:
+        prepare_scratch(args.drop_existing)
+        restore_full(full)
+        if full.stats_binlog_file is None:
+            apply_binlogs(segments, full.values["binlog_pos"])
+        else:
+            before, after = split_at_stats(full, segments)
+            apply_binlogs(before, full.values["binlog_pos"])
+            errors += compare(full, scratch_stats(list(full.tables)))
+            apply_binlogs(after)
+
+    for error in errors:
+        logging.error(error)
+    if errors:
+        print("La copia NO es válida")
+        sys.exit(1)
+    print("Copia verificada correctamente")
+
+
+if __name__ == "__main__":
+    main()
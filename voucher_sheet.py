@@ -0,0 +1,204 @@
+"""
+Hojas imprimibles de vales QR (PDF de varias páginas o PNG por página).
+
+Cada página se dibuja en un proceso del pool (``render_page``): se genera el
+QR de cada vale a partir de su ``qrcode_id``, se coloca en la cuadrícula con
+su ID y su valor, y la página se devuelve ya comprimida. Para PDF la página
+es un raster de 1 bit comprimido con Flate, que ``build_pdf`` inserta tal
+cual como imagen; el proceso de la API solo concatena bytes.
+"""
+
+import io
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+
+# Tamaños de página en milímetros
+PAGE_SIZES_MM = {
+    "A4": (210.0, 297.0),
+    "Letter": (215.9, 279.4),
+}
+
+SHEET_FORMATS = ("pdf", "png")
+
+
+class SheetLayout(NamedTuple):
+    width: int          # ancho de página en píxeles
+    height: int         # alto de página en píxeles
+    dpi: int
+    columns: int
+    rows: int
+    margin: int         # margen en píxeles
+    font_path: Optional[str] = None
+
+    @property
+    def per_page(self) -> int:
+        return self.columns * self.rows
+
+
+def compute_layout(page_size: str, dpi: int, columns: int, rows: int, margin_mm: float) -> SheetLayout:
+    """Calcula las dimensiones en píxeles de la página y la cuadrícula."""
+    width_mm, height_mm = PAGE_SIZES_MM[page_size]
+    to_px = lambda mm: int(round(mm / 25.4 * dpi))
+    return SheetLayout(
+        width=to_px(width_mm),
+        height=to_px(height_mm),
+        dpi=dpi,
+        columns=columns,
+        rows=rows,
+        margin=to_px(margin_mm),
+        font_path=os.getenv("SHEET_FONT_PATH"),
+    )
+
+
+def _load_font(layout: SheetLayout, size: int):
+    for path in (layout.font_path, "DejaVuSans.ttf"):
+        if path:
+            try:
+                return ImageFont.truetype(path, size)
+            except OSError:
+                continue
+    return ImageFont.load_default()
+
+
+def _qr_image(data: str, size: int) -> Image.Image:
+    # Máscara fija: evaluar las 8 máscaras es la mayor parte del coste de
+    # generar cada QR y cualquier máscara es válida para los lectores.
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, border=2, mask_pattern=0)
+    qr.add_data(data)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    modules = len(matrix)
+    image = Image.new("1", (modules, modules), 1)
+    image.putdata([0 if dark else 1 for line in matrix for dark in line])
+    box = max(1, size // modules)
+    return image.resize((modules * box, modules * box), Image.NEAREST)
+
+
+def render_page(vouchers: List[Tuple[str, float, str]], layout: SheetLayout, output: str) -> bytes:
+    """
+    Dibuja una página de vales. ``vouchers`` son tuplas (qrcode_id, valor,
+    contenido del QR). Devuelve un PNG o, para PDF, el raster de 1 bit
+    comprimido con zlib.
+    """
+    page = Image.new("1", (layout.width, layout.height), 1)
+    draw = ImageDraw.Draw(page)
+    cell_w = (layout.width - 2 * layout.margin) // layout.columns
+    cell_h = (layout.height - 2 * layout.margin) // layout.rows
+    padding = max(2, cell_h // 20)
+    font_size = max(8, cell_h // 12)
+    font = _load_font(layout, font_size)
+    text_h = 2 * font_size + 3 * padding
+    qr_size = max(21, min(cell_w, cell_h - text_h) - 2 * padding)
+
+    for index, (qrcode_id, value, content) in enumerate(vouchers[:layout.per_page]):
+        x0 = layout.margin + (index % layout.columns) * cell_w
+        y0 = layout.margin + (index // layout.columns) * cell_h
+        # Línea de corte
+        draw.rectangle([x0, y0, x0 + cell_w - 1, y0 + cell_h - 1], outline=0)
+
+        qr = _qr_image(content, qr_size)
+        page.paste(qr, (x0 + (cell_w - qr.width) // 2, y0 + padding))
+
+        text_y = y0 + padding + qr.height + padding
+        for line in (qrcode_id, f"${value:.2f}"):
+            text_w = draw.textlength(line, font=font)
+            draw.text((x0 + (cell_w - text_w) / 2, text_y), line, font=font, fill=0)
+            text_y += font_size + padding
+
+    if output == "png":
+        buffer = io.BytesIO()
+        page.save(buffer, format="PNG", optimize=True, dpi=(layout.dpi, layout.dpi))
+        return buffer.getvalue()
+    return zlib.compress(page.tobytes(), 6)
+
+
+def build_pdf(pages: Iterable[bytes], page_count: int, layout: SheetLayout) -> Iterator[bytes]:
+    """
+    Genera un PDF con una imagen de página completa por página, a partir de
+    los rasters devueltos por ``render_page``. Se escribe en streaming.
+    """
+    width_pt = layout.width * 72.0 / layout.dpi
+    height_pt = layout.height * 72.0 / layout.dpi
+    offsets = []
+    position = 0
+
+    def emit(chunk: bytes) -> bytes:
+        nonlocal position
+        position += len(chunk)
+        return chunk
+
+    def obj(number: int, body: bytes) -> bytes:
+        offsets.append((number, position))
+        return emit(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+    yield emit(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    yield obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+    kids = b" ".join(b"%d 0 R" % (3 + 3 * i) for i in range(page_count))
+    yield obj(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, page_count))
+
+    for i, raster in enumerate(pages):
+        page_obj, content_obj, image_obj = 3 + 3 * i, 4 + 3 * i, 5 + 3 * i
+        yield obj(page_obj, (
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] "
+            b"/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>"
+        ) % (width_pt, height_pt, image_obj, content_obj))
+        content = b"q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q" % (width_pt, height_pt)
+        yield obj(content_obj, b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        yield obj(image_obj, (
+            b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+            b"/ColorSpace /DeviceGray /BitsPerComponent 1 /Filter /FlateDecode /Length %d >>\nstream\n"
+        ) % (layout.width, layout.height, len(raster)) + raster + b"\nendstream")
+
+    xref_position = position
+    total = 3 + 3 * page_count
+    xref = [b"xref\n0 %d\n" % total, b"0000000000 65535 f \n"]
+    for _, offset in sorted(offsets):
+        xref.append(b"%010d 00000 n \n" % offset)
+    yield emit(b"".join(xref))
+    yield emit(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (total, xref_position))
+
+
+# Memoria aproximada de un proceso de dibujo: intérprete, qrcode, Pillow y
+# una página A4 a 300 dpi en escala de grises
+SHEET_PROCESS_MB = 40
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def sheet_workers() -> int:
+    """
+    Procesos del pool de este worker de la API. Por defecto, los núcleos
+    repartidos entre los workers, sin pasar de ``SHEET_MEMORY_MB`` (memoria
+    para dibujar hojas en todo el contenedor) repartida igual.
+    """
+    configured = int(os.getenv("SHEET_WORKERS", "0"))
+    if configured:
+        return configured
+    api_workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    by_cpu = (os.cpu_count() or 1) // api_workers
+    by_memory = int(os.getenv("SHEET_MEMORY_MB", "40")) // api_workers // SHEET_PROCESS_MB
+    return max(1, min(by_cpu, by_memory))
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Pool de procesos para dibujar páginas (se crea al primer uso). Los
+    procesos se arrancan con spawn y solo importan este módulo.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=sheet_workers(), mp_context=get_context("spawn"))
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None